@@ -9,11 +9,38 @@
 #SBATCH --cpus-per-task=20      ## The number of threads the code will use
 #SBATCH --mem-per-cpu=250M     	## Real memory(MB) per CPU required by the job.
 #SBATCH --time=7-00:00:00		## Week limit
-	
+
+CODE=/accounts/projects/pkline/newslabor/Documents/Newspaper_2023/3_Data_processing/1-code/miguel-test
+OUTPUT=/accounts/projects/pkline/newslabor/Documents/Newspaper_2023/3_Data_processing/4-output
+NEWSPAPER=LAT
+NUM_SHARDS=${NUM_SHARDS:-16}
+
+## Sharded: `bash batch.sh` (not sbatch) submits this script as an array job of NUM_SHARDS
+## tasks, each resolving every NUM_SHARDS-th batch (see README), and a job that merges
+## the shards' batches (checking that none are missing) once all tasks have succeeded.
+## If any task fails, the merge job never starts: resubmit that task with e.g.
+## `sbatch --array=3 --output=resolve-3.log batch.sh` (it resumes from its manifest),
+## then the merge with `--dependency=afterok:<JOB_ID>` on it.
+if [ -z "$SLURM_JOB_ID" ]; then
+    ARRAY_JOB=$(sbatch --parsable --array=0-$((NUM_SHARDS - 1)) --output=resolve-%a.log "$0") || exit 1
+    ARRAY_JOB=${ARRAY_JOB%%;*}    ## Job ID, without the cluster
+    MERGE_JOB=$(sbatch --parsable --dependency=afterok:$ARRAY_JOB --job-name=merge \
+        --output=merge.log --partition=high --ntasks=1 --cpus-per-task=1 --mem=16G \
+        --time=1-00:00:00 --wrap="module load python; python $CODE/merge-batch.py \
+            --filepath=$OUTPUT/7-geolocation/$NEWSPAPER-extract-all.gzip \
+            --batch_dir=$OUTPUT/7-geolocation/ --suffix=resolve --num_shards=$NUM_SHARDS \
+            --stream=1 --output_dir=$OUTPUT/") || exit 1
+    echo "Submitted resolve of $NEWSPAPER as array job $ARRAY_JOB ($NUM_SHARDS shards), merged by job ${MERGE_JOB%%;*}."
+    exit 0
+fi
+
+## Unsharded: `sbatch batch.sh` resolves all batches in this one job (and assembles them).
+## Otherwise this is a task of the array job above, which resolves its shard's batches
+## (SLURM_ARRAY_TASK_ID of SLURM_ARRAY_TASK_COUNT) and leaves them to the merge job.
 ## Load the python interpreter
 module load python
 
-srun python /accounts/projects/pkline/newslabor/Documents/Newspaper_2023/3_Data_processing/1-code/miguel-test/resolve.py --filepath=/accounts/projects/pkline/newslabor/Documents/Newspaper_2023/3_Data_processing/4-output/7-geolocation/LAT-extract-all.gzip --nworkers=20 --multithreading=1 
-srun echo "Finished LAT (8.2M ads)"
+srun python $CODE/resolve.py --filepath=$OUTPUT/7-geolocation/$NEWSPAPER-extract-all.gzip --nworkers=20 --multithreading=1
+srun echo "Finished $NEWSPAPER"
 
-### TO RUN: sbatch -C mem768g job.sh
+### TO RUN: bash batch.sh (sharded, then merged), or sbatch -C mem768g batch.sh (one job)
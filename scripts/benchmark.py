@@ -0,0 +1,256 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import resource
+import sys
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from multiprocessing import get_context
+from common import ADDRESS_TYPE, load_helpers, time_now, write_parquet
+from extract import Newspaper, extract_batch, newspaper_memos, newspaper_pool
+from resolve import address_queries, resolve_batch
+
+
+def scale_ads(texts:list, n:int, mutate:float=0.0, seed:int=0):
+    ''' Synthetic sample of n ads: the ads repeated in turn, where (after the first copy)
+    each word is corrupted with probability mutate, as OCR would, by dropping, doubling
+    or swapping a letter, so that repeats are not all identical.
+    '''
+    rng = random.Random(seed)
+    def corrupt(word:str):
+        # Leave ad separators (e.g. 'NJG_classifiedad_...') intact
+        if '_' in word or rng.random() >= mutate: return word
+        i = rng.randrange(len(word))
+        edit = rng.randrange(3)
+        if edit == 0: return word[:i] + word[i+1:]
+        if edit == 1: return word[:i+1] + word[i:]
+        return word[:i] + word[i+1:i+2] + word[i] + word[i+2:]
+    scaled = []
+    for i in range(n):
+        text = texts[i % len(texts)]
+        if i >= len(texts) and mutate and text:
+            text = ' '.join(corrupt(word) if word else word for word in text.split(' '))
+        scaled.append(text)
+    return scaled
+
+def reset_memos(NEWSPAPER:Newspaper):
+    ''' Empty the token and spelling memos, so that each timing starts cold. '''
+    for memo in newspaper_memos(NEWSPAPER):
+        memo.entries.clear()
+        memo.drain()
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    ''' Peak resident set size (of this process, or its largest waited-for child). '''
+    return round(resource.getrusage(who).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10), 1)
+
+def summarize(latencies:list, elapsed:float):
+    latencies = np.array(latencies) * 1000
+    return {'ads':len(latencies), 'seconds':round(elapsed, 2),
+        'ads_per_sec':round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms':round(float(np.percentile(latencies, 50)), 3) if len(latencies) else None,
+        'p99_ms':round(float(np.percentile(latencies, 99)), 3) if len(latencies) else None}
+
+def time_stages(NEWSPAPER:Newspaper, texts:list):
+    ''' Per-ad latencies of each extraction stage, run serially (one stage at a time over
+    all ads, memos emptied before each), on the inputs the extractors give them. '''
+    paper, US_DATA, TEXT_HELP = NEWSPAPER.newspaper, NEWSPAPER.US_DATA, NEWSPAPER.TEXT_HELP
+    first_ads = [text.split("_classifiedad_")[0] for text in texts]
+    tokens = [TEXT_HELP.clean_tokenize(text, paper) or [] for text in texts]
+    stages = [
+        ('extract', NEWSPAPER.extract, texts),
+        ('employer_info', NEWSPAPER.employer_info, texts),
+        ('clean_tokenize', lambda text: TEXT_HELP.clean_tokenize(text, paper), texts),
+        ('clean_for_wage', TEXT_HELP.clean_for_wage, first_ads),
+        ('check_nearby_cities', US_DATA.check_nearby_cities, tokens),
+        ('check_nearby_states', US_DATA.check_nearby_states, tokens),
+    ]
+    results = {}
+    for stage, func, inputs in stages:
+        reset_memos(NEWSPAPER)
+        latencies = []
+        start_time = time.perf_counter()
+        for x in inputs:
+            ad_start = time.perf_counter()
+            func(x)
+            latencies.append(time.perf_counter() - ad_start)
+        results[stage] = summarize(latencies, time.perf_counter() - start_time)
+        print("Stage {}: {}".format(stage, results[stage]))
+    return results
+
+def time_resolve(addresses:pa.Array, US_DATA:object):
+    ''' Throughput of the local (network-free) part of resolve: building queries from the
+    addresses column, and resolving candidates without a street from local tables. '''
+    results = {}
+    start_time = time.perf_counter()
+    address_queries(addresses)
+    elapsed = time.perf_counter() - start_time
+    results['address_queries'] = {'ads':len(addresses), 'seconds':round(elapsed, 3),
+        'ads_per_sec':round(len(addresses) / elapsed, 1) if elapsed else None}
+    with contextlib.redirect_stdout(io.StringIO()):
+        start_time = time.perf_counter()
+        _, counts = resolve_batch(addresses, US_DATA, offline=2)
+        elapsed = time.perf_counter() - start_time
+    results['resolve_offline'] = {'ads':len(addresses), 'seconds':round(elapsed, 3),
+        'ads_per_sec':round(len(addresses) / elapsed, 1) if elapsed else None, **counts}
+    for stage, result in results.items(): print("Stage {}: {}".format(stage, result))
+    return results
+
+def run_workers(NEWSPAPER:Newspaper, texts:list, nworkers:int, nrows_golden:int, conn):
+    ''' Extract batch with nworkers (serially if 0) in a process of its own, so that its
+    peak memory (and its workers') is its own, and send back the timings and the
+    extractions of the first nrows_golden ads. '''
+    reset_memos(NEWSPAPER)
+    with contextlib.redirect_stdout(io.StringIO()):
+        start_time = time.perf_counter()
+        pool = newspaper_pool(NEWSPAPER, nworkers) if nworkers else None
+        extractions = extract_batch(pd.Series(texts), NEWSPAPER, pool,
+            extract_address=args.extract_address, extract_wage=args.extract_wage,
+            max_workers=nworkers or None, chunksize=args.chunksize, dedup=args.dedup)
+        if pool: pool.shutdown()
+        elapsed = time.perf_counter() - start_time
+    conn.send(({'nworkers':nworkers, 'ads':len(texts), 'seconds':round(elapsed, 2),
+        'ads_per_sec':round(len(texts) / elapsed, 1), 'peak_rss_mb':peak_rss_mb(),
+        'peak_worker_rss_mb':peak_rss_mb(resource.RUSAGE_CHILDREN) if nworkers else None},
+        extractions.iloc[:nrows_golden]))
+    conn.close()
+
+def time_workers(NEWSPAPER:Newspaper, texts:list, nworkers:int, nrows_golden:int):
+    context = get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=run_workers,
+        args=(NEWSPAPER, texts, nworkers, nrows_golden, sender))
+    process.start()
+    result, extractions = receiver.recv()
+    process.join()
+    print("Workers {}: {}".format(nworkers, result))
+    return result, extractions
+
+def normalize_addresses(addresses):
+    ''' Candidate addresses as comparable lists of dicts, whether extracted (fields
+    missing) or read back from parquet (fields null). '''
+    return [{field: value for field, value in address.items() if value is not None}
+        for address in addresses]
+
+def golden_diff(extractions:pd.DataFrame, golden:pd.DataFrame):
+    ''' Positions of the ads whose extractions differ from the golden ones, per column. '''
+    diffs = {}
+    for col in golden.columns:
+        if col not in extractions:
+            diffs[col] = list(range(len(golden)))
+            continue
+        if col == 'addresses':
+            same = [normalize_addresses(a) == normalize_addresses(b)
+                for a, b in zip(extractions[col], golden[col])]
+        else:
+            same = [(pd.isna(a) and pd.isna(b)) or a == b
+                for a, b in zip(extractions[col], golden[col])]
+        diffs[col] = [i for i, equal in enumerate(same) if not equal]
+    return {col: positions for col, positions in diffs.items() if positions}
+
+def main():
+    ''' Time extraction stages and workers on a (scaled) sample of ads, checking
+    extractions of the original ads against the golden output. '''
+    if args.golden and not args.write_golden and not os.path.isfile(args.golden):
+        print("No golden output '{}': write it with --write_golden 1 (or check nothing " \
+            "with --golden '').".format(args.golden))
+        sys.exit(1)
+    US_DATA, TEXT_HELP = load_helpers(args.aux_dir, args.snapshot)
+    paper = os.path.basename(args.filepath).split('.')[0].split('-')[0]
+    NEWSPAPER = Newspaper(newspaper=paper, US_DATA=US_DATA, TEXT_HELP=TEXT_HELP)
+    sample = pd.read_parquet(args.filepath, columns=['raw_content']) \
+        if not args.filepath.endswith('.csv') else \
+            pd.read_csv(args.filepath, usecols=['raw_content'])
+    texts = sample.raw_content.iloc[:args.nrows].fillna('').tolist()
+    scaled = scale_ads(texts, args.scale or len(texts), args.mutate, args.seed)
+    print("Benchmarking {} ads ({} original, {}% of words mutated in copies) at {}.".format(
+        len(scaled), len(texts), round(100 * args.mutate, 1), time_now()))
+    report = {'filepath':args.filepath, 'ads':len(scaled), 'original_ads':len(texts),
+        'mutate':args.mutate, 'seed':args.seed, 'dedup':args.dedup}
+
+    if args.stages:
+        report['stages'] = time_stages(NEWSPAPER, scaled[:args.stages_nrows])
+
+    # Worker runs, each of whose extractions of the original ads are checked against golden
+    golden = pd.read_parquet(args.golden) if args.golden and not args.write_golden else None
+    if golden is not None:
+        golden = golden[[col for col in golden.columns if col == 'addresses' and
+            args.extract_address or col == 'wage' and args.extract_wage]]
+        assert len(golden) == len(texts), "Golden output is of {} ads, not {}.".format(
+            len(golden), len(texts))
+    report['workers'], failures = [], {}
+    for nworkers in args.nworkers:
+        result, extractions = time_workers(NEWSPAPER, scaled, nworkers, len(texts))
+        if args.write_golden and golden is None:
+            golden = extractions.reset_index(drop=True)
+            write_parquet(golden, args.golden, types={'addresses':ADDRESS_TYPE}
+                if args.extract_address else None)
+            print("Wrote golden output '{}' of {} ads.".format(args.golden, len(golden)))
+        elif golden is not None:
+            diffs = golden_diff(extractions.reset_index(drop=True), golden)
+            result['golden_mismatches'] = {col: len(positions) for col, positions in diffs.items()}
+            if diffs: failures[nworkers] = diffs
+        report['workers'].append(result)
+
+    if args.resolve and args.extract_address:
+        addresses = pa.array(extractions.addresses.tolist(), ADDRESS_TYPE) if golden is None \
+            else pa.array([normalize_addresses(a) for a in golden.addresses], ADDRESS_TYPE)
+        report['resolve'] = time_resolve(addresses, NEWSPAPER.US_DATA)
+    report['peak_rss_mb'] = peak_rss_mb()
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(report) + '\n')
+        print("Appended report to '{}'.".format(args.output))
+    for nworkers, diffs in failures.items():
+        for col, positions in diffs.items():
+            print("MISMATCH with {} workers: {} of {} ads differ from golden in '{}', e.g. {}.".format(
+                nworkers, len(positions), len(texts), col, positions[:10]))
+    if failures: sys.exit(1)
+    print("Completed benchmark at {}.".format(time_now()))
+
+if __name__ == "__main__":
+    test_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_data')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--filepath', type=str, help="Filepath to newspaper ads.",
+        default=os.path.join(test_data, 'NJG-extract-all.gzip'))
+    parser.add_argument('-n', '--nrows', type=int, default=None, help="Maximum number of " \
+        "original ads.")
+    parser.add_argument('--scale', type=int, default=None, help="Number of ads to scale the " \
+        "original ads up to (e.g. 100000), by repeating them.")
+    parser.add_argument('--mutate', type=float, default=0.05, help="Share of words " \
+        "corrupted in repeated ads.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--extract_address', type=int, default=1)
+    parser.add_argument('--extract_wage', type=int, default=1)
+    parser.add_argument('-w', '--nworkers', type=str, default='0,2,4', help="Comma-separated " \
+        "worker counts to time (0 for serial).")
+    parser.add_argument('-c', '--chunksize', type=int, default=None)
+    parser.add_argument('--dedup', type=int, default=0, help="Extract repeated ads once " \
+        "(off by default, so that all ads are timed).")
+    parser.add_argument('--stages', type=int, default=1, help="Time each stage serially.")
+    parser.add_argument('--stages_nrows', type=int, default=None, help="Maximum number of " \
+        "ads to time stages on.")
+    parser.add_argument('--resolve', type=int, default=1, help="Time local resolve stages.")
+    parser.add_argument('--golden', type=str, help="Filepath to golden extractions of the " \
+        "original ads, which must exist unless written with --write_golden (or '' to check " \
+        "nothing).", default=os.path.join(test_data, 'NJG-benchmark-golden.gzip'))
+    parser.add_argument('--write_golden', type=int, default=0, help="Write the extractions " \
+        "of the first worker run as golden output, instead of checking against it.")
+    parser.add_argument('-o', '--output', type=str, default=None, help="Filepath to JSON " \
+        "lines file to append the report to.")
+    parser.add_argument('-a', '--aux_dir', type=str, help="Filepath to auxiliary directory.",
+        default="/accounts/projects/pkline/newslabor/Documents/Newspaper_2023/" \
+            "3_Data_processing/1-code/auxiliary_files")
+    parser.add_argument('--snapshot', type=str, default=None, help="Filepath to snapshot of " \
+        "helpers (default: in aux_dir).")
+    args = parser.parse_args()
+
+    assert os.path.isdir(args.aux_dir), 'Invalid filepath to auxilliary files.'
+    assert os.path.isfile(args.filepath), 'Invalid filepath to data file.'
+    args.nworkers = [int(n) for n in args.nworkers.split(',')]
+    main()
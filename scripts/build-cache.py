@@ -0,0 +1,29 @@
+import argparse
+import os
+import time
+from common import HELPERS_SNAPSHOT, load_helpers, save_helpers_snapshot
+
+def main():
+    ''' Build text and geo helpers once and snapshot them for extract.py and resolve.py. '''
+    start_time = time.time()
+    save_helpers_snapshot(args.aux_dir, args.snapshot)
+    print("Saved snapshot '{}' ({} MB) in {} seconds.".format(args.snapshot,
+        round(os.path.getsize(args.snapshot) / 1e6, 1), round(time.time() - start_time, 1)))
+
+    # Check that it loads
+    start_time = time.time()
+    load_helpers(args.aux_dir, args.snapshot)
+    print("Loaded snapshot in {} seconds.".format(round(time.time() - start_time, 2)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-a', '--aux_dir', type=str, help="Filepath to auxiliary files.",
+        default="/accounts/projects/pkline/newslabor/Documents/Newspaper_2023/" \
+            "3_Data_processing/1-code/auxiliary_files")
+    parser.add_argument('--snapshot', type=str, default=None, help="Filepath to snapshot " \
+        "(default: '{}' in aux_dir).".format(HELPERS_SNAPSHOT))
+    args = parser.parse_args()
+
+    assert os.path.isdir(args.aux_dir), 'Invalid filepath to auxilliary files.'
+    args.snapshot = args.snapshot or os.path.join(args.aux_dir, HELPERS_SNAPSHOT)
+    main()
@@ -1,24 +1,611 @@
+import gc
+import io
 import os
 import re
+import glob
+import copy
+import json
+import time
+import hashlib
+import pickle
+import pstats
+import socket
+import cProfile
+import sqlite3
+import threading
+import functools
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from statistics import mode
-from pyzipcode import ZipCodeDatabase
+from collections import Counter, OrderedDict, namedtuple
+from contextlib import contextmanager
+from pyzipcode import ZipCodeDatabase, ZipCode
 from nltk import ConditionalFreqDist, pos_tag, word_tokenize
-from symspellpy import SymSpell
+from symspellpy import SymSpell, Verbosity
+from symspellpy.helpers import is_acronym, try_parse_int64
 # from jamspell import TSpellCorrector
-from thefuzz import process, fuzz
-from spacy.lang.en.stop_words import STOP_WORDS
+from rapidfuzz import process as rf_process, fuzz as rf_fuzz
+from rapidfuzz.utils import default_process
 from string import capwords
 from pytz import timezone
 from datetime import datetime
 
 
+def array_shard(shard_index:int=None, num_shards:int=None):
+    ''' (index, count) of the shard this run is: as given, or else this task's of a SLURM 
+    array job (e.g. `sbatch --array=0-15`), or else the one and only shard. '''
+    if num_shards is None: 
+        num_shards = int(os.environ.get('SLURM_ARRAY_TASK_COUNT', 1))
+    if shard_index is None:
+        shard_index = (int(os.environ.get('SLURM_ARRAY_TASK_ID', 0)) - int(os.environ.get(
+            'SLURM_ARRAY_TASK_MIN', 0))) // int(os.environ.get('SLURM_ARRAY_TASK_STEP', 1))
+    assert 0 <= shard_index < num_shards, "Invalid shard {} of {}.".format(shard_index, num_shards)
+    return shard_index, num_shards
+
+def in_shard(batch_idx:int, shard_index:int, num_shards:int):
+    ''' Whether batch is the shard's. Batches are dealt round-robin, so that shards get as 
+    many batches (give or take one) from all over the data, e.g. of every year. '''
+    return batch_idx % num_shards == shard_index
+
+def shard_suffix(suffix:str, shard_index:int, num_shards:int):
+    return suffix if num_shards == 1 else '{}-shard-{}-of-{}'.format(suffix, shard_index, num_shards)
+
 def add_filepath_suffix(dirpath:str, newspaper:str, suffix:str='extract', n:int=None, ext:str='gzip'):
     filename = '{}-{}-{}.{}'.format(newspaper, suffix, str(n or 'all'), ext)
     filepath = os.path.join(dirpath, filename)
     print("Will save to '{}'.".format(filepath))
     return filepath
 
+# Fields of extracted address candidates, in the order pandas writes them
+ADDRESS_FIELDS = ['city','county','housenumber','state','street','zipcode']
+ADDRESS_TYPE = pa.list_(pa.struct([(field, pa.string()) for field in ADDRESS_FIELDS]))
+
+
+def csv_dtypes(filepath:str, batch_size:int, nrows:int=None, columns:list=None):
+    ''' Types of the CSV's columns that pandas infers differently from chunk to chunk
+    (of batch_size rows), to read them as in all chunks: e.g. integers in one chunk and 
+    floats (with NAs) in another, or strings in one and floats in another, where the column 
+    is all NAs or numbers. Numeric columns get their common type, columns of booleans 
+    the nullable boolean type and any others str, so that chunks share one schema.
+    '''
+    seen, all_na, bools = {}, set(), {}
+    for chunk in pd.read_csv(filepath, nrows=nrows, usecols=columns, index_col=[0], 
+            chunksize=batch_size):
+        for col, dtype in chunk.dtypes.items():
+            notna = chunk[col].notna()
+            if not notna.any():
+                all_na.add(col)
+                continue
+            seen.setdefault(col, set()).add(dtype)
+            if dtype == object:
+                # Parsed as booleans only if all of the chunk's values are
+                bools[col] = bools.get(col, True) and isinstance(chunk[col][notna].iloc[0], bool)
+    dtypes = {}
+    for col, types in seen.items():
+        if len(types) == 1 and col not in all_na: continue
+        if all(pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+                for dtype in types):
+            dtypes[col] = np.result_type(*types, *([np.float64] if col in all_na else []))
+        elif all(pd.api.types.is_bool_dtype(dtype) or bools.get(col) for dtype in types):
+            dtypes[col] = 'boolean'
+        else:
+            dtypes[col] = str
+    return dtypes
+
+def read_batches(filepath:str, batch_size:int, nrows:int=None, columns:list=None, 
+        dtypes:dict=None):
+    ''' Yield the data in DataFrames of (at most) batch_size rows, reading CSV
+    in chunks (with `dtypes` of columns, see csv_dtypes) and parquet by record batches, 
+    so the full file is never in memory.
+    '''
+    if filepath.endswith('.csv'):
+        chunks = pd.read_csv(filepath, nrows=nrows, usecols=columns, index_col=[0], 
+            chunksize=batch_size, dtype=dtypes)
+        for chunk in chunks:
+            yield chunk
+        return
+    parquet = pq.ParquetFile(filepath)
+    index_columns = (parquet.schema_arrow.pandas_metadata or {}).get('index_columns', [])
+    if columns:
+        columns = columns + [col for col in index_columns if isinstance(col, str)]
+    offset = 0
+    for batch in parquet.iter_batches(batch_size=batch_size, columns=columns):
+        if nrows is not None and offset >= nrows: break
+        if nrows is not None: batch = batch.slice(0, nrows - offset)
+        chunk = pa.Table.from_batches([batch]).to_pandas()
+        # Range indices are stored as metadata only, so rebuild them per batch
+        if index_columns and not isinstance(index_columns[0], str):
+            start, step = index_columns[0].get('start', 0), index_columns[0].get('step', 1)
+            chunk.index = pd.RangeIndex(start + offset*step, start + (offset + len(chunk))*step, step)
+        offset += len(chunk)
+        yield chunk
+
+
+class ParquetStreamWriter(object):
+    ''' Append DataFrames to a single parquet file, one row group at a time.
+    Schema is fixed by the first write (with `types` overriding inferred column
+    types), later writes are cast to it.
+    '''
+    def __init__(self, filepath:str, types:dict=None, compression:str='gzip'):
+        self.filepath = filepath
+        self.types = types or {}
+        self.compression = compression
+        self.writer = None
+        self.nrows = 0
+
+    def _schema(self, table:pa.Table):
+        fields = []
+        for field in table.schema:
+            if field.name in self.types:
+                field = field.with_type(self.types[field.name])
+            elif pa.types.is_null(field.type):
+                field = field.with_type(pa.string())
+            fields.append(field)
+        return pa.schema(fields, metadata=table.schema.metadata)
+
+    def _conform(self, table:pa.Table):
+        assert set(table.column_names) <= set(self.schema.names), \
+            "Unexpected columns: {}".format(set(table.column_names) - set(self.schema.names))
+        columns = []
+        for field in self.schema:
+            if field.name not in table.column_names:
+                columns.append(pa.nulls(len(table), field.type))
+                continue
+            column = table[field.name]
+            if column.type != field.type:
+                column = pa.nulls(len(table), field.type) if column.null_count == len(column) \
+                    else column.cast(field.type)
+            columns.append(column)
+        return pa.Table.from_arrays(columns, schema=self.schema)
+
+    def write(self, df:pd.DataFrame):
+        arrays = {col: pa.array(df[col], type=self.types[col], from_pandas=True)
+            for col in df.columns if col in self.types}
+        table = pa.Table.from_pandas(df.drop(columns=list(arrays)), preserve_index=True)
+        for col, array in arrays.items():
+            table = table.append_column(col, array)
+        # Typed columns back in place (before any index columns)
+        if arrays:
+            columns = [str(col) for col in df.columns]
+            table = table.select(columns + [col for col in table.column_names if col not in columns])
+        if self.writer is None:
+            self.schema = self._schema(table)
+            self.writer = pq.ParquetWriter(self.filepath, self.schema, compression=self.compression)
+        self.writer.write_table(self._conform(table))
+        self.nrows += len(df)
+
+    def close(self):
+        if self.writer is not None: 
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_parquet(df:pd.DataFrame, filepath:str, types:dict=None, compression:str='gzip'):
+    ''' Write DataFrame to parquet, with `types` (e.g. ADDRESS_TYPE for addresses) 
+    overriding the column types pandas would infer. '''
+    if not types: 
+        return df.to_parquet(filepath, compression=compression)
+    with ParquetStreamWriter(filepath, types=types, compression=compression) as writer:
+        writer.write(df)
+
+
+def batch_types(filepaths:list, types:dict=None):
+    ''' Arrow types of the batch files' columns, unified over all batches (as e.g. nested 
+    requests, or columns all NAs in a batch, are inferred per batch), with `types` overriding 
+    those of the columns they have. Columns of incompatible types (e.g. numbers in a batch 
+    written by an earlier run, text in others) are unified as strings. '''
+    schemas = [pq.read_schema(filepath) for filepath in filepaths]
+    index_columns = {col for schema in schemas for col in 
+        (schema.pandas_metadata or {}).get('index_columns', []) if isinstance(col, str)}
+    fields = {}
+    for schema in schemas:
+        for field in schema:
+            if field.name not in index_columns: fields.setdefault(field.name, []).append(field)
+    unified = {}
+    for name, versions in fields.items():
+        try:
+            unified[name] = pa.unify_schemas([pa.schema([field]) for field in versions], 
+                promote_options='permissive').field(name).type
+        except (pa.ArrowTypeError, pa.ArrowInvalid):
+            unified[name] = pa.string()
+    unified.update({col: dtype for col, dtype in (types or {}).items() if col in unified})
+    return unified
+
+def concat_parquet(filepaths:list, output_filepath:str, types:dict=None, csv_filepath:str=None):
+    ''' Concatenate parquet files into one, streaming them row group by row group. '''
+    with ParquetStreamWriter(output_filepath, types=types) as writer:
+        for filepath in filepaths:
+            parquet = pq.ParquetFile(filepath)
+            for i in range(parquet.num_row_groups):
+                df = parquet.read_row_group(i).to_pandas()
+                if csv_filepath:
+                    df.to_csv(csv_filepath, mode='a' if writer.nrows else 'w', header=not writer.nrows)
+                writer.write(df)
+    return writer.nrows
+
+
+class Manifest(object):
+    ''' Checkpoint of a batched run: the row range, row count and output path 
+    of every completed batch, rewritten atomically after each batch. A restarted
+    run with the same parameters skips completed batches and redoes the rest.
+    Batches are written with `types` overriding inferred column types. A run of another
+    `version` of the rules (recorded in params) starts afresh rather than resuming.
+    '''
+    def __init__(self, filepath:str, params:dict=None, types:dict=None):
+        self.filepath = filepath
+        self.params = params or {}
+        self.types = types
+        self.batches = []
+        if os.path.isfile(filepath):
+            with open(filepath) as f:
+                manifest = json.load(f)
+            if params and manifest['params'].get('version') != params.get('version'):
+                print("Starting afresh: manifest '{}' is of version {}, not {}.".format(
+                    filepath, manifest['params'].get('version'), params.get('version')))
+                return
+            assert not params or manifest['params'] == params, "Manifest '{}' was written " \
+                "with parameters {}, not {}.".format(filepath, manifest['params'], params)
+            self.params, self.batches = manifest['params'], manifest['batches']
+            print("Loaded manifest '{}' of {} completed batches ({} rows).".format(
+                filepath, len(self.batches), self.nrows))
+
+    @property
+    def nrows(self):
+        return sum(batch['nrows'] for batch in self.batches)
+
+    def completed(self, start:int, end:int):
+        ''' Return record of batch if completed (and output still there), else None. '''
+        for batch in self.batches:
+            if batch['start'] == start and batch['end'] == end and os.path.isfile(batch['path']):
+                return batch
+        return None
+
+    def write_batch(self, df:pd.DataFrame, start:int, filepath:str):
+        ''' Write batch to parquet and record it, each step atomic, so that a crash
+        mid-batch leaves neither a partial file nor a record of it. '''
+        write_parquet(df, filepath + '.tmp', types=self.types)
+        os.replace(filepath + '.tmp', filepath)
+        self.batches = [batch for batch in self.batches if batch['start'] != start]
+        self.batches.append({'start':start, 'end':start + len(df), 'nrows':len(df), 'path':filepath})
+        self.batches.sort(key=lambda batch: batch['start'])
+        self.save()
+
+    def save(self):
+        with open(self.filepath + '.tmp', 'w') as f:
+            json.dump({'params':self.params, 'batches':self.batches}, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.filepath + '.tmp', self.filepath)
+
+    @classmethod
+    def combine(cls, filepaths:list, num_shards:int=None):
+        ''' Manifest of a (sharded) run from the manifests of its shards, checking that they 
+        are of the same run and that none are missing. '''
+        manifests = [cls(filepath) for filepath in filepaths]
+        params = [{key: value for key, value in manifest.params.items() if key != 'shard_index'} 
+            for manifest in manifests]
+        assert all(run == params[0] for run in params), "Manifests {} are of different " \
+            "runs, choose one.".format(filepaths)
+        num_shards = num_shards or params[0].get('num_shards', 1)
+        shards = sorted(manifest.params.get('shard_index', 0) for manifest in manifests)
+        assert shards == list(range(num_shards)), "Have manifests of shards {}, not of all " \
+            "{} shards.".format(shards, num_shards)
+        combined = cls.__new__(cls)
+        combined.filepath, combined.params, combined.types = ', '.join(filepaths), params[0], None
+        combined.batches = sorted((batch for manifest in manifests for batch in manifest.batches), 
+            key=lambda batch: batch['start'])
+        return combined
+
+    def paths(self):
+        ''' Output paths of completed batches in row order, checking they are contiguous. '''
+        for prev, batch in zip(self.batches, self.batches[1:]):
+            assert prev['end'] == batch['start'], "Rows {}-{} missing from manifest '{}'.".format(
+                prev['end'], batch['start'], self.filepath)
+        return [batch['path'] for batch in self.batches]
+
+
+class SQLiteCache(object):
+    ''' Persistent key-value cache of (pickled) results in SQLite, organized by 
+    namespace. One lock-guarded connection is shared across threads, and the WAL
+    journal lets several processes and later runs share the same file.
+    '''
+    def __init__(self, filepath:str):
+        self.filepath = filepath
+        self.hits, self.misses = Counter(), Counter()
+        self._connect()
+
+    def _connect(self):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.filepath, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cache (namespace TEXT, key TEXT, " \
+            "value BLOB, PRIMARY KEY (namespace, key))")
+        self.conn.commit()
+
+    def __getstate__(self):
+        # Connections can't be pickled, so each process opens its own
+        return {'filepath':self.filepath, 'hits':self.hits, 'misses':self.misses}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._connect()
+
+    def get(self, namespace:str, key:str, default=None):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM cache WHERE namespace=? AND key=?",
+                (namespace, key)).fetchone()
+        if row is None:
+            self.misses[namespace] += 1
+            return default
+        self.hits[namespace] += 1
+        return pickle.loads(row[0])
+
+    def set(self, namespace:str, key:str, value):
+        value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)", 
+                (namespace, key, value))
+            self.conn.commit()
+
+    def get_many(self, namespace:str, keys:list):
+        ''' Dict of the keys found in namespace to their values. '''
+        keys, found = list(dict.fromkeys(keys)), {}
+        if not keys: return found
+        with self.lock:
+            # In chunks, below SQLite's limit on query parameters
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i+500]
+                found.update(self.conn.execute("SELECT key, value FROM cache WHERE namespace=? " \
+                    "AND key IN ({})".format(','.join('?'*len(chunk))), [namespace] + chunk).fetchall())
+        self.hits[namespace] += len(found)
+        self.misses[namespace] += len(keys) - len(found)
+        return {key: pickle.loads(value) for key, value in found.items()}
+
+    def set_many(self, namespace:str, items:dict):
+        ''' Set many keys in namespace at once (in one transaction). '''
+        rows = [(namespace, key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+            for key, value in items.items()]
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)", rows)
+            self.conn.commit()
+
+    def stats(self):
+        ''' Hits, misses and hit rate per namespace (since opened). '''
+        return {namespace: {'hits':self.hits[namespace], 'misses':self.misses[namespace],
+            'hit_rate':round(self.hits[namespace] / (self.hits[namespace] + self.misses[namespace]), 3)}
+            for namespace in sorted(set(self.hits) | set(self.misses))}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class LRUMemo(object):
+    ''' Bounded in-memory memo (least recently used evicted first) of per-token 
+    results, organized by namespace, with hit/miss counters. Entries added since 
+    the last drain() can be shipped from pool workers and merged into the parent, 
+    which saves them to disk for workers of later runs to start from. Saved memos are
+    tagged with the version given at load (e.g. of the helpers whose results they hold), 
+    and memos of any other version are discarded rather than loaded.
+    '''
+    def __init__(self, maxsize:int=500000):
+        self.maxsize = maxsize
+        self.version = None
+        self.entries = OrderedDict()
+        self.new_entries = {}
+        self.hits, self.misses = Counter(), Counter()
+
+    def get(self, namespace:str, key, default=None):
+        try:
+            value = self.entries[(namespace, key)]
+        except KeyError:
+            self.misses[namespace] += 1
+            return default
+        self.entries.move_to_end((namespace, key))
+        self.hits[namespace] += 1
+        return value
+
+    def set(self, namespace:str, key, value):
+        self._insert(namespace, key, value)
+        # Bounded like entries: a worker drains them after each chunk, the parent never
+        self.new_entries[(namespace, key)] = value
+        while len(self.new_entries) > self.maxsize:
+            del self.new_entries[next(iter(self.new_entries))]
+
+    def _insert(self, namespace:str, key, value):
+        self.entries[(namespace, key)] = value
+        self.entries.move_to_end((namespace, key))
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def drain(self):
+        ''' Return (and reset) entries added and hits/misses counted since last drain. '''
+        delta = (self.new_entries, self.hits, self.misses)
+        self.new_entries, self.hits, self.misses = {}, Counter(), Counter()
+        return delta
+
+    def merge(self, delta):
+        ''' Merge a drained delta (e.g. of a pool worker) into this memo, whose entries 
+        are then not new (they are already saved with this memo, not to be drained). '''
+        new_entries, hits, misses = delta
+        for (namespace, key), value in new_entries.items():
+            self._insert(namespace, key, value)
+        self.hits.update(hits)
+        self.misses.update(misses)
+
+    def stats(self):
+        ''' Hits, misses and hit rate per namespace (since loaded or last drained). '''
+        return {namespace: {'hits':self.hits[namespace], 'misses':self.misses[namespace],
+            'hit_rate':round(self.hits[namespace] / (self.hits[namespace] + self.misses[namespace]), 3)}
+            for namespace in sorted(set(self.hits) | set(self.misses))}
+
+    def load(self, filepath:str, version:str=None):
+        self.version = version
+        if not os.path.isfile(filepath): return self
+        with open(filepath, 'rb') as f:
+            saved = pickle.load(f)
+        # Memos saved before they were versioned are lists of entries
+        saved_version = saved.get('version') if isinstance(saved, dict) else None
+        if saved_version != version:
+            print("Discarded memo '{}' of version {}, not {}.".format(filepath, 
+                saved_version, version))
+            return self
+        self.entries.update(saved['entries'] if isinstance(saved, dict) else saved)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        print("Loaded memo '{}' of {} entries.".format(filepath, len(self.entries)))
+        return self
+
+    def save(self, filepath:str):
+        # Least recently used first, so that reloading keeps the recency order. Shards (on 
+        # any node) may save the same memo at once, each through its own temporary file.
+        tmp_filepath = '{}.{}-{}.tmp'.format(filepath, socket.gethostname(), os.getpid())
+        with open(tmp_filepath, 'wb') as f:
+            pickle.dump({'version':self.version, 'entries':list(self.entries.items())}, f, 
+                protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filepath, filepath)
+
+
+class StageTimer(object):
+    ''' Cumulative seconds and calls per stage, off unless enabled. Stages are either 
+    methods wrapped (on their class, so also in forked pool workers) by instrument(), or 
+    blocks timed with time(). Like LRUMemo, what was timed since the last drain() can 
+    be shipped from pool workers and merged into the parent. Nested stages (e.g. fuzzy 
+    matching within city_state_options) are each timed in full.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.seconds, self.calls = Counter(), Counter()
+        self.total_seconds, self.total_calls = Counter(), Counter()
+        # Running totals of each Prometheus textfile, per series (i.e. labels)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage:str, seconds:float, calls:int=1):
+        if not self.enabled: return
+        with self.lock:
+            self.seconds[stage] += seconds
+            self.calls[stage] += calls
+
+    @contextmanager
+    def time(self, stage:str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def timed(self, stage:str, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        wrapper.stage = stage
+        return wrapper
+
+    def instrument(self, methods:list):
+        ''' Enable timing, of each (stage, class, method name) in methods among others. '''
+        for stage, cls, name in methods:
+            if not hasattr(cls.__dict__[name], 'stage'):
+                setattr(cls, name, self.timed(stage, cls.__dict__[name]))
+        self.enabled = True
+        return self
+
+    def drain(self):
+        ''' Return (and reset) seconds and calls per stage timed since last drain. '''
+        with self.lock:
+            delta = (self.seconds, self.calls)
+            self.seconds, self.calls = Counter(), Counter()
+        return delta
+
+    def merge(self, delta):
+        ''' Merge a drained delta (e.g. of a pool worker) into this timer. '''
+        seconds, calls = delta
+        with self.lock:
+            self.seconds.update(seconds)
+            self.calls.update(calls)
+
+    def emit(self, filepath:str, labels:dict, **fields):
+        ''' Drain what was timed (e.g. during a batch) into filepath: appended as a JSON
+        line along with labels and fields, or for a '.prom' filepath, added to the running 
+        totals of the labels' series (e.g. of one newspaper, as extract-all.py runs several 
+        in turn), which are all rewritten as a Prometheus textfile. 
+        '''
+        seconds, calls = self.drain()
+        self.total_seconds.update(seconds)
+        self.total_calls.update(calls)
+        if filepath.endswith('.prom'):
+            series = self.series.setdefault(filepath, {})
+            series_seconds, series_calls = series.setdefault(tuple(labels.items()), 
+                (Counter(), Counter()))
+            series_seconds.update(seconds)
+            series_calls.update(calls)
+            lines = []
+            for metric, which, help in [('stage_seconds_total', 0, 
+                    'Cumulative seconds spent in stage.'), ('stage_calls_total', 1, 
+                    'Cumulative calls of stage.')]:
+                lines += ['# HELP newspaper_{} {}'.format(metric, help), 
+                    '# TYPE newspaper_{} counter'.format(metric)]
+                for series_labels, totals in series.items():
+                    lines += ['newspaper_{}{{{}}} {}'.format(metric, ','.join('{}="{}"'.format(
+                        label, value) for label, value in dict(series_labels, stage=stage).items()), 
+                            round(totals[which][stage], 6)) for stage in sorted(totals[which])]
+            with open(filepath + '.tmp', 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(filepath + '.tmp', filepath)
+            return
+        with open(filepath, 'a') as f:
+            f.write(json.dumps(dict(labels, **fields, time=time_now(), stages={stage: 
+                {'seconds':round(seconds[stage], 6), 'calls':calls[stage]} 
+                    for stage in sorted(seconds)})) + '\n')
+
+
+# Timings of stages, enabled by instrument() (see extract.py and resolve.py)
+STAGE_TIMER = StageTimer()
+
+
+@contextmanager
+def profiled(profile:str=None):
+    ''' Profile the block with cProfile, if profile is given, into a part of profile 
+    (one per process and block) to be combined by combine_profiles. '''
+    if not profile:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats('{}.part-{}-{}'.format(profile, os.getpid(), time.time_ns()))
+
+def combine_profiles(profile:str, nlines:int=40):
+    ''' Combine the parts of profile (e.g. of each pool worker) into profile, readable 
+    with pstats or snakeviz, with its top nlines functions by cumulative time as text. '''
+    parts = glob.glob(glob.escape(profile) + '.part-*')
+    if not parts: return
+    stats = pstats.Stats(*parts)
+    stats.dump_stats(profile)
+    summary = io.StringIO()
+    stats.stream = summary
+    stats.sort_stats('cumulative').print_stats(nlines)
+    with open(profile + '.txt', 'w') as f:
+        f.write(summary.getvalue())
+    for part in parts: os.remove(part)
+    print("Saved profile '{}' (summary in '{}.txt').".format(profile, profile))
+
+
 def time_now(tz:str='America/New_York'):
     return datetime.now(timezone(tz)).strftime("%m/%d/%Y %H:%M:%S")
 
@@ -27,9 +614,30 @@ def first_digit(word:str):
         if ch.isdigit(): return ch
     return None
 
-def _wage_candidate_array(tokens, start, end, prefix=True):
-    candidate_arr = [token.lower() for token in tokens[start:end] if \
-        token.lower() not in (STOP_WORDS - set(["per", "every"]))]
+# Wage text normalization (see TextWrapper.clean_for_wage), in order of application
+WAGE_SPACES = re.compile(' {2,}')
+WAGE_DIGIT_GAPS = [    # consecutive digits, e.g. '1 000' (applied in turn)
+    re.compile(r'(?<=\s\d)\s+(?=\d+\s)'),
+    re.compile(r'(?<=\s\d\d)\s+(?=\d+\s)'),
+    re.compile(r'(?<=\s\d\d\d)\s+(?=\d+\s)'),
+    re.compile(r'(\s\$?\s?\d+)\s?(\d+\$?\s)')]
+WAGE_DECIMALS = re.compile(r'(\s\$?\s?\d+)\s?(\.|,)\s?(\d{1,3}\$?\s)')
+WAGE_DOLLARS_BEFORE = re.compile(r'\s[s|t|f|F|S|\$]\s?(\d+[,|\.]?\d*)\$?\s')
+WAGE_DOLLARS_AFTER = re.compile(r'\s(\d+[,|\.]?\d*)[s|t|f|F|S|\$]\s')
+WAGE_DASHES = re.compile(r'\s-\s|\s-\$?\d+|\d+-\s')
+WAGE_PUNCTUATION = str.maketrans('', '', '!"#%&\'()*+/:;<>?@[\\]^_`{|}~')
+WAGE_LOOSE_PUNCTUATION = re.compile(r'\s\.\s|\s,\s|\s-|-\s')
+# House number (not all zeros, e.g. "1805" or "12A") and up to two words, before a street 
+# marker
+HOUSE_NUMBER = r'(?<!\w)0*[1-9]\d*[A-Za-z]?(?!\w)(?:\W+\w+){0,2}\W+'
+# Salary-like tokens, e.g. '$500' or '12.50-', unless phone numbers
+SALARY = re.compile(r'\$?\d+\.?\d{1,2}?\$?[-\s]')
+PHONE_NUMBER = re.compile(r'\d{0,3}-?\s?\d{3}-?\s?\d{4}')
+
+
+def _wage_candidate_array(tokens, start, end, stop_words:set, prefix=True):
+    candidate_arr = [token for token in map(str.lower, tokens[start:end]) if \
+        token not in stop_words]
     if prefix and "hours" in candidate_arr: 
         return None # signifies schedule, not wage
     if len(candidate_arr) == 1: # If all stop words minus wage
@@ -46,13 +654,21 @@ class TextWrapper(object):
         self.checker.load_dictionary(dictionary_filepath, 0, 1)
         assert self.checker, "SymSpell not loaded."
         self.dictionary = self.checker.words
+        # Memo of spelling corrections (of sentences, segments and word pairs)
+        self.CORRECTIONS = LRUMemo()
         self.CARDINAL_DIRECTIONS = ["east","e","west","w","north","n","south","s"]
         self.REAL_ESTATE = ["decorated","refurbish","remodel","bedroom","bathroom", 
                          "tenant","furniture","deluxe","furnish","apartment",
                          "realtor","realty","garage","backyard","vacant","for sale"]
         self.STREET_MARKERS_ABBREV = ["rd","blvd","st","ct","ave","av"]
         self.STREET_MARKERS_FULL = ["road","boulevard","street","circuit","avenue","lane"]
-        self.STREET_MARKERS = self.STREET_MARKERS_ABBREV + self.STREET_MARKERS_FULL
+        self.STREET_MARKERS = frozenset(self.STREET_MARKERS_ABBREV + self.STREET_MARKERS_FULL)
+        # OCR misreadings of street markers, e.g. "Stre et" or "Bivd", only taken for one 
+        # after a house number (e.g. "1805 Airline Bivd"): misreadings also turn up in junk
+        self.STREET_MARKER_VARIANTS = {"stre et":"street","str eet":"street","st reet":"street",
+                                    "stree t":"street","strect":"street","bivd":"blvd"}
+        self.STREET_MATCHER = KeywordMatcher(dict({marker:marker for marker in 
+            self.STREET_MARKERS}, **self.STREET_MARKER_VARIANTS), variant_context=HOUSE_NUMBER)
         self.NUMBERS_SUFFIX = {"1":"st", "2":"nd", "3":"rd"}
         self.WAGE_MARKERS = {"salary","sal","pays","pay","payment","rate","start",
                                 "starting","earn","begins","beginning"}
@@ -64,7 +680,17 @@ class TextWrapper(object):
         self.RATES_SINGLE = {"annually","yearly","monthly","weekly","daily","hourly"}
         self.TIMES = {'hour','week','day','daily','month','year'}
         self.TIMES_ABBREV = {'hr','wk','mo','yr'}
+        self.ALL_TIMES = self.TIMES | self.TIMES_ABBREV
+        # Tokens that are (part of) a time or a time abbreviation
+        self.TIME_PARTS = {time[i:j] for time in self.TIMES for i in range(len(time)) 
+            for j in range(i, len(time) + 1)} | self.TIMES_ABBREV
+        self.RATES = re.compile('|'.join(re.escape(rate) for rate in 
+            sorted(self.RATES_SINGLE | self.RATES_DOUBLE)))
         self.NOT_RE = ["hiring", "salary", "equal opportunity", "employer", "employee"]
+        # Imported here, as spaCy is slow to import (and not needed when loaded from snapshot)
+        from spacy.lang.en.stop_words import STOP_WORDS
+        self.STOP_WORDS = frozenset(STOP_WORDS)
+        self.WAGE_STOP_WORDS = self.STOP_WORDS - {"per", "every"}
         print("Loaded text functions.")
 
     def _correct_street(self, addr:list):    
@@ -81,32 +707,86 @@ class TextWrapper(object):
         return capwords(' '.join(corrected))
 
     def _correct_sentence(self, words:str, edit_dist=2, ignore_non_words=False):
-        return self.checker.lookup_compound(words, split_by_space=ignore_non_words,
+        key = (words, edit_dist, ignore_non_words)
+        corrected = self.CORRECTIONS.get('sentence', key)
+        if corrected is None:
+            corrected = self.checker.lookup_compound(words, split_by_space=ignore_non_words,
                     max_edit_distance=edit_dist, ignore_non_words=ignore_non_words,
                     ignore_term_with_digits=ignore_non_words)[0].term
+            self.CORRECTIONS.set('sentence', key, corrected)
+        return corrected
+
+    def _can_combine(self, word:str, next_word:str, edit_dist=2):
+        # Whether lookup_compound could merge the two (i.e. has a correction of both together)
+        key = (word + next_word, edit_dist)
+        combinable = self.CORRECTIONS.get('combine', key)
+        if combinable is None:
+            combinable = bool(self.checker.lookup(word + next_word, Verbosity.TOP, edit_dist))
+            self.CORRECTIONS.set('combine', key, combinable)
+        return combinable
+
+    def _correct_segments(self, words:str, edit_dist=2):
+        ''' Same as _correct_sentence(words, edit_dist, ignore_non_words=True), but
+        corrects (and memoizes) segments of words separately. A segment starts at every
+        spell-checked (i.e. not numeric or acronym) word that can't be merged with the 
+        previous one, which lookup_compound corrects the same way alone as in context.
+        '''
+        terms, lowered = words.split(), words.lower().split()
+        segments, start = [], 0
+        for i in range(1, len(terms)):
+            if try_parse_int64(lowered[i]) is None and not is_acronym(terms[i], True) and \
+                    not self._can_combine(lowered[i-1], lowered[i], edit_dist):
+                segments.append(' '.join(terms[start:i]))
+                start = i
+        segments.append(' '.join(terms[start:]))
+        return ' '.join(self._correct_sentence(segment, edit_dist, ignore_non_words=True)
+            for segment in segments if segment)
 
     def _is_word(self, word:str):
         return word.lower() in self.dictionary or word.title() in self.dictionary
 
     def potential_salary(self, word:str):
-        if not re.findall('^\$?\d+\.?\d{1,2}?\$?[-\s]', word + " "):
+        if not SALARY.match(word + " "):
             return False       
         if first_digit(word) == '0': 
             return False
-        if re.findall('\d{0,3}-?\s?\d{3}-?\s?\d{4}', word): 
+        if PHONE_NUMBER.search(word): 
             return False
         return True
 
+    def salary_indices(self, tokens:list):
+        ''' Indices of potential salaries among tokens, in one scan. Only tokens 
+        starting with a digit (or a dollar sign and digit) can be one. '''
+        return [i for i, token in enumerate(tokens) if (token[:1].isdigit() or (token[:1] == '$' 
+            and token[1:2].isdigit())) and self.potential_salary(token)]
+
+    def street_marker_indices(self, tokens:list):
+        ''' Indices of street markers among tokens, but the first (with no street before it). '''
+        return [i for i, token in enumerate(tokens) if i and token.lower() in self.STREET_MARKERS]
+
     def clean_tokenize(self, text:str, newspaper:str, exclude_RE:bool=True, min_token_length:int=3):
         ''' Basic ad text cleaning. Firstly ensures that we consider only
         first ad, then removes punctuation and extra whitespace. 
         '''
         first = text.split("{}_classifiedad_".format(newspaper))[0]
-        if exclude_RE and any(re in first for re in self.REAL_ESTATE): return None
-        cleaned = re.sub(' +', ' ', re.sub(r'[^\w\s]', ' ', first)).strip().split()
+        if exclude_RE and self.is_real_estate(first): return None
+        return self.tokenize(first, min_token_length)
+
+    def tokenize(self, text:str, min_token_length:int=3):
+        ''' Remove punctuation and extra whitespace, and keep tokens that are long enough, 
+        words, numbers or cardinal directions. Misread street markers are corrected. '''
+        text = self.STREET_MATCHER.normalize(text)
+        cleaned = re.sub(' +', ' ', re.sub(r'[^\w\s]', ' ', text)).strip().split()
         return [token for token in cleaned if (len(token) >= min_token_length or 
                 self._is_word(token) or token.isdigit() or token.lower() in self.CARDINAL_DIRECTIONS)]
 
+    def is_real_estate(self, text:str):
+        return any(term in text for term in self.REAL_ESTATE)
+
+    def is_labor(self, text:str):
+        # Labor terms, under which real estate terms don't rule out a (job) ad
+        return any(word in text for word in self.NOT_RE)
+
     def extract_pos_employer(self, text):
         ''' TODO: find employer names from text. '''
         employers = []
@@ -126,7 +806,7 @@ class TextWrapper(object):
         # First, try to find rate (e.g. hourly) following potential salary
         for i in range(idx+2, idx+4):
             if i > len(tokens): continue
-            candidate_arr = _wage_candidate_array(tokens, idx, i)
+            candidate_arr = _wage_candidate_array(tokens, idx, i, self.WAGE_STOP_WORDS)
             if not candidate_arr: continue
             candidate = ' '.join(candidate_arr)
             # Case when e.g. "$500 WEEKLY" or e.g. "$500 PER WEEK"
@@ -138,7 +818,7 @@ class TextWrapper(object):
                     potential_candidate = candidate
                 break
             # Case when e.g. "$50 hour"
-            if any(time in candidate_arr for time in (self.TIMES | self.TIMES_ABBREV)):
+            if not self.ALL_TIMES.isdisjoint(candidate_arr):
                 if '$' in tokens[idx]: 
                     potential_candidate = potential_candidate or candidate
                 else: 
@@ -147,18 +827,17 @@ class TextWrapper(object):
         # Second, if prior text indicates a salary (though no rate) consider
         for i in range(idx-1, idx-4, -1):
             if i < 0: continue
-            candidate_arr = _wage_candidate_array(tokens, i, idx+1, prefix=False)
+            candidate_arr = _wage_candidate_array(tokens, i, idx+1, 
+                self.WAGE_STOP_WORDS, prefix=False)
             if not candidate_arr: continue
             candidate = ' '.join(candidate_arr)
             if candidate_arr[0] in self.WAGE_MARKERS:
                 potential = candidate
                 if idx+2 < len(tokens):
-                    if any(tokens[idx+2] in time for time in self.TIMES) or \
-                        tokens[idx+2] in self.TIMES_ABBREV:
+                    if tokens[idx+2] in self.TIME_PARTS:
                         potential = ' '.join(tokens[i:idx+3])
                 elif idx+1 < len(tokens):
-                    if any(tokens[idx+1] in time for time in self.TIMES) or \
-                        tokens[idx+1] in self.TIMES_ABBREV:
+                    if tokens[idx+1] in self.TIME_PARTS:
                         potential = ' '.join(tokens[i:idx+2])
                 if '$' in potential or len(candidate_arr) == 2: 
                     potential_candidate = potential_candidate or potential
@@ -171,23 +850,21 @@ class TextWrapper(object):
 
     def clean_for_wage(self, text:str):
         # Addl spaces
-        spaces = ' ' + re.sub(' {2,}', ' ', text).strip() + ' '
-        # Consecutive digits
-        d = re.sub('(?<=\s\d)\s+(?=\d+\s)', '', spaces)
-        d = re.sub('(?<=\s\d\d)\s+(?=\d+\s)', '', d)
-        d = re.sub('(?<=\s\d\d\d)\s+(?=\d+\s)', '', d)
-        d = re.sub('(\s\$?\s?\d+)\s?(\d+\$?\s)', r'\1\2', d)
-        # Decimals
-        x = re.sub('(\s\$?\s?\d+)\s?(\.|,)\s?(\d{1,3}\$?\s)', r'\1\2\3', d)
-        # Dollar digits
-        x = re.sub('\s[s|t|f|F|S|\$]\s?(\d+[,|\.]?\d*)\$?\s',r' $\1 ', x)
-        x = re.sub('\s(\d+[,|\.]?\d*)[s|t|f|F|S|\$]\s',r' \1$ ', x)
+        x = ' ' + WAGE_SPACES.sub(' ', text).strip() + ' '
+        # Consecutive digits and decimals (only ever found around digits)
+        if any(ch.isdigit() for ch in x):
+            for pattern in WAGE_DIGIT_GAPS[:3]:
+                x = pattern.sub('', x)
+            x = WAGE_DIGIT_GAPS[3].sub(r'\1\2', x)
+            x = WAGE_DECIMALS.sub(r'\1\2\3', x)
+            # Dollar digits
+            x = WAGE_DOLLARS_BEFORE.sub(r' $\1 ', x)
+            x = WAGE_DOLLARS_AFTER.sub(r' \1$ ', x)
         # Colons
-        x = re.sub('\s-\s|\s-\$?\d+|\d+-\s', '-', x)
+        x = WAGE_DASHES.sub('-', x)
         # Extra punctuation
-        punct = x.translate(str.maketrans('', '', '!"#%&\'()*+/:;<>?@[\\]^_`{|}~'))
-        punct = re.sub('\s\.\s|\s,\s|\s-|-\s',' ',punct)
-        return self._correct_sentence(punct.lower(), ignore_non_words=True)
+        punct = WAGE_LOOSE_PUNCTUATION.sub(' ', x.translate(WAGE_PUNCTUATION))
+        return self._correct_segments(punct.lower())
 
     def find_street(self, tokens_list:str, idx:int):
         ''' Return (house)number and street.
@@ -223,7 +900,7 @@ class TextWrapper(object):
                 addr.pop(0)
         while len(addr) > 1:
             if addr[0][0].isdigit() or (addr[0].lower() in self.CARDINAL_DIRECTIONS and 
-                    addr[1] not in STOP_WORDS): 
+                    addr[1] not in self.STOP_WORDS): 
                 break
             addr.pop(0)
         
@@ -236,19 +913,6 @@ class TextWrapper(object):
         structured['street'] = self._correct_street(addr) + ' ' + marker
         return structured
 
-    def find_street_markers(self, text:str, short_thresh:int=100, long_thresh:int=80):
-        ''' Identifies possible street markers. '''
-        street_tokens = []
-        matches = process.extract(text, STREET_MARKERS_FULL, scorer=fuzz.partial_ratio)
-        for match in matches:
-            if match[1] >= long_thresh:
-                street_tokens.append(match[0])
-        matches = process.extract(text, STREET_MARKERS_ABBREV, scorer=fuzz.token_set_ratio)
-        for match in matches:
-            if match[1] >= short_thresh:
-                street_tokens.append(match[0])
-        return street_tokens 
-
     def find_tags(self, tag_prefix:str, tagged_text:list):
         ''' Find tokens matching the specified tag_prefix. '''
         cfd = ConditionalFreqDist((tag, word) for (word, tag) in tagged_text
@@ -256,11 +920,95 @@ class TextWrapper(object):
         return dict((tag, list(cfd[tag].keys())) for tag in cfd.conditions())
 
 
+class KeywordMatcher(object):
+    ''' Finds whole-word keywords in one pass over a text, ignoring case, with their 
+    positions. Keywords are given as {variant: keyword}, so that variants (e.g. OCR 
+    misreadings, possibly split in two) are found as their keyword, if given, only where 
+    the text just before them matches variant_context. 
+    '''
+    def __init__(self, keywords:dict, variant_context:str=None):
+        self.KEYWORDS = {' '.join(variant.lower().split()):keyword 
+            for variant, keyword in keywords.items()}
+        def any_of(variants):
+            # Longest first, and matching split variants across any whitespace
+            return r'(?<!\w)(?:{})(?!\w)'.format('|'.join(r'\s+'.join(map(re.escape, 
+                variant.split())) for variant in sorted(variants, key=len, reverse=True)))
+        self.pattern = re.compile(any_of(self.KEYWORDS), re.IGNORECASE)
+        self.variant_pattern = re.compile(any_of([variant for variant, keyword in 
+            self.KEYWORDS.items() if variant != keyword.lower()]), re.IGNORECASE)
+        self.variant_context = re.compile(r'(?:{})$'.format(variant_context), 
+            re.IGNORECASE) if variant_context else None
+
+    def keyword(self, match):
+        variant = ' '.join(match.group().lower().split())
+        keyword = self.KEYWORDS.get(variant)
+        if keyword and self.variant_context and variant != keyword.lower() and not \
+                self.variant_context.search(match.string, max(match.start() - 80, 0), 
+                    match.start()):
+            return None
+        return keyword
+
+    def find(self, text:str):
+        ''' (start, end, keyword) of each keyword found in text. '''
+        return [(match.start(), match.end(), self.keyword(match)) for match in 
+            self.pattern.finditer(text) if self.keyword(match)]
+
+    def normalize(self, text:str):
+        ''' Text with variants replaced by their keywords. '''
+        return self.variant_pattern.sub(lambda match: self.keyword(match) or match.group(), text)
+
+
+class FuzzyMatcher(object):
+    ''' Scores batches of tokens against a fixed list of choices at once (rapidfuzz
+    cdist), giving the same matches and (rounded) scores as thefuzz's 
+    process.extract/extractOne with scorer=fuzz.ratio over the same choices. 
+    '''
+    def __init__(self, choices):
+        self.choices = list(choices)   # fixes order, which breaks score ties
+
+    def scores(self, queries:list, score_cutoff:float=0):
+        # Both sides go through thefuzz's default processor; float scores as extract sorts them
+        return rf_process.cdist(queries, self.choices, scorer=rf_fuzz.ratio, 
+            processor=default_process, score_cutoff=score_cutoff, dtype=np.float64)
+
+    def extract(self, queries:list, limit:int=5, threshold:int=0):
+        ''' For each query, the up to limit best (choice, score) with score >= threshold,
+        best first, as process.extract(query, choices, scorer=fuzz.ratio, limit) 
+        truncated at the first score below threshold. 
+        '''
+        if not queries: return []
+        scores = self.scores(queries, score_cutoff=max(threshold - 0.5, 0))
+        rounded = np.rint(scores)     # round half to even, as int(round(score))
+        results = []
+        for row, row_rounded in zip(scores, rounded):
+            idxs = np.flatnonzero(row_rounded >= threshold)
+            best = idxs[np.argsort(-row[idxs], kind='stable')][:limit]
+            results.append([(self.choices[i], int(row_rounded[i])) for i in best])
+        return results
+
+    def extract_one(self, queries:list):
+        ''' For each query, the best (choice, score), as process.extractOne(query, 
+        choices, scorer=fuzz.ratio). 
+        '''
+        if not queries: return []
+        scores = self.scores(queries)
+        best = scores.argmax(axis=1)   # first of equal scores, as extractOne
+        return [(self.choices[i], int(np.rint(row[i]))) for i, row in zip(best, scores)]
+
+
+# Candidate zipcodes: 5-digit numbers
+FIVE_DIGITS = re.compile(r"\D(\d{5})\D")
+
+# Row of US_CITIES, as held in USGeoData's indexes
+CityRow = namedtuple('CityRow', ['city','state_id','state_name','county_name','zips','population'])
+
+
 class USGeoData(object):
-    def __init__(self, states_fp, cities_fp, nearby_fp):
+    def __init__(self, states_fp, cities_fp, nearby_fp, crosswalk_fp=None):
         # Database of US states and state abbreviations
         self.US_STATES = pd.read_csv(states_fp).rename(
             {"State":"state_name","Abbreviation":"state_id"}, axis='columns')
+        self.STATE_NAMES = dict(zip(self.US_STATES.state_id, self.US_STATES.state_name))
         # Database of US cities and city-level information from SimpleMaps
         self.US_CITIES = pd.read_csv(cities_fp)[
             ['city','state_id','state_name','county_name','zips','population']
@@ -273,42 +1021,114 @@ class USGeoData(object):
             "BoG":"MA","ChT":"IL","HaC":"CT","LAS":"CA","LAT":"CA","NJG":"VA",
             "NYr":"NY","NYT":"NY","WaP":"DC"}
         self.ZIPCODE_DB = ZipCodeDatabase()
+        # Whole zipcode table, read at once instead of a database query per zipcode
+        self.ZIPCODES = {}
+        for row in self.ZIPCODE_DB.conn_manager.query("SELECT * FROM ZipCodes"):
+            self.ZIPCODES.setdefault(row[0], ZipCode(*row))
+        self.NEIGHBOR_IDS = {}
+        for state_id, neighbor_id in zip(self.NEIGHBOR_STATES.state_id, 
+                self.NEIGHBOR_STATES.neighbor_id):
+            self.NEIGHBOR_IDS.setdefault(state_id, []).append(neighbor_id)
+        # Indexes of cities by name and by zipcode (rows kept in US_CITIES order)
+        self.CITIES_BY_NAME, self.CITIES_BY_ZIP, self.CITY_STATES = {}, {}, {}
+        for row in self.US_CITIES.itertuples(index=False):
+            row = CityRow(row.city, row.state_id, row.state_name, row.county_name, row.zips, 
+                0 if pd.isna(row.population) else row.population)
+            self.CITIES_BY_NAME.setdefault(row.city, []).append(row)
+            self.CITY_STATES.setdefault(row.city, set()).add(row.state_name)
+            for zipcode in dict.fromkeys(row.zips.split()):
+                self.CITIES_BY_ZIP.setdefault(zipcode, []).append(row)
+        # Zipcode (ZCTA) to (state ID, county) crosswalk, for zipcodes no city lists
+        self.ZIP_COUNTIES = {}
+        if crosswalk_fp:
+            crosswalk = pd.read_csv(crosswalk_fp, dtype={'ZCTA5':str})
+            for state_id, county, zipcode in zip(crosswalk.state, crosswalk.county, 
+                    crosswalk.ZCTA5.str.zfill(5)):
+                self.ZIP_COUNTIES.setdefault(zipcode, (state_id, capwords(county)))
+        # Memo of fuzzy matches per token, shared by newspapers (scoped by nearby states)
+        self.TOKEN_MEMO = LRUMemo()
         print("Loaded USA geo-data.")
 
     def load(self, newspaper:str, min_pop=50000):
-        self.state_id = self.NEWSPAPER_TO_STATE_ID[newspaper] 
-        self.state_name = self.state_id_to_state_name(self.state_id)
-        self.nearby_state_ids = self.nearby_state_ids(self.state_id)
-        self.nearby_states = self.nearby_state_names(self.nearby_state_ids)
-        self.biggest_nearby_cities = self.biggest_nearby_cities(
-            self.nearby_state_ids, min_pop=min_pop)
+        ''' Geo-data of newspaper: a shallow copy with its (nearby) states and cities, 
+        sharing the tables, indexes and token memo, so that one instance serves all papers. '''
+        paper = copy.copy(self)
+        paper.state_id = self.NEWSPAPER_TO_STATE_ID[newspaper] 
+        paper.state_name = self.state_id_to_state_name(paper.state_id)
+        paper.nearby_state_ids = self.state_ids_near(paper.state_id)
+        paper.nearby_states = self.nearby_state_names(paper.nearby_state_ids)
+        paper.biggest_nearby_cities = self.biggest_cities_in(
+            paper.nearby_state_ids, min_pop=min_pop)
+        paper.nearby_state_set = set(paper.nearby_states)
+        paper.nearby_state_id_set = set(paper.nearby_state_ids)
+        # Zipcodes of nearby states, so that detecting them is a lookup
+        paper.nearby_zipcodes = {zipcode: row for zipcode, row in self.ZIPCODES.items() 
+            if row.state in paper.nearby_state_id_set}
+        # Fuzzy matchers over the (fixed) nearby choices, whose results are memoized by scope
+        paper.memo_scope = (tuple(paper.nearby_state_ids), min_pop)
+        paper.city_matcher = FuzzyMatcher(paper.biggest_nearby_cities)
+        paper.state_name_matcher = FuzzyMatcher(paper.nearby_states)
+        paper.state_id_matcher = FuzzyMatcher(paper.nearby_state_ids)
         print("Loaded newspaper-state data.")
-        return self
+        return paper
+
+    def local_county(self, address_fields:dict):
+        ''' Resolve county of candidate address without geocoding, from its zipcode
+        or else its city (and state). Candidates with a street are left to geocoding.
+
+        Returns:
+            None if candidate has a street, else (address, county, zipcode)
+            with address and county None if not found
+        '''
+        if address_fields.get('street'): return None
+        city, state = address_fields.get('city'), address_fields.get('state')
+        zipcode, county = address_fields.get('zipcode'), None
+        if zipcode:
+            options = [row for row in self.CITIES_BY_ZIP.get(zipcode, []) if 
+                not state or row.state_name == state]
+            if options:
+                best = max(options, key=lambda row: row.population)
+                city, state, county = city or best.city, state or best.state_name, best.county_name
+            elif zipcode in self.ZIP_COUNTIES:
+                state_id, county = self.ZIP_COUNTIES[zipcode]
+                state = state or self.STATE_NAMES.get(state_id)
+        elif city:
+            options = [row for row in self.CITIES_BY_NAME.get(city, []) if 
+                (row.state_name == state if state else row.state_name in self.nearby_state_set)]
+            if options:
+                best = max(options, key=lambda row: row.population)
+                state, county = best.state_name, best.county_name
+        # Counties missing from the tables (NaN) are not found either
+        if not county or pd.isna(county): return None, None, None
+        return ', '.join(filter(None, [city, state, zipcode])) + ', USA', county, zipcode
 
     def counties_from_zips(self, zipcodes:list):
         if not zipcodes: return None
+        zipcode = mode(zipcodes)
+        if isinstance(zipcode, str) and len(zipcode) == 5 and zipcode.isdigit():
+            return [row.county_name for row in self.CITIES_BY_ZIP.get(zipcode, [])]
+        # Irregular zipcodes (e.g. ZIP+4) still need substring matching
         return list(self.US_CITIES.loc[self.US_CITIES.zips.str.contains(
-            mode(zipcodes)), 'county_name'].values) 
+            zipcode), 'county_name'].values) 
 
     def state_id_to_state_name(self, state_id:str):
-        assert state_id in self.US_STATES.state_id.to_list()
-        return self.US_STATES.state_name[self.US_STATES.state_id == state_id].iloc[0]
+        assert state_id in self.STATE_NAMES
+        return self.STATE_NAMES[state_id]
 
-    def nearby_state_ids(self, state_id:str):
+    def state_ids_near(self, state_id:str):
         # Adjacent (and home newspaper) state IDs (i.e. abbreviations)
-        return self.NEIGHBOR_STATES.loc[
-            self.NEIGHBOR_STATES.state_id == state_id].neighbor_id.to_list() + [state_id]
+        return self.NEIGHBOR_IDS.get(state_id, []) + [state_id]
 
     def nearby_state_names(self, nearby_state_ids:list):
-        return self.US_STATES.loc[
-            self.US_STATES.state_id.isin(nearby_state_ids)].state_name.to_list()
+        nearby_state_ids = set(nearby_state_ids)
+        return [name for state_id, name in self.STATE_NAMES.items() if state_id in nearby_state_ids]
 
     def big_cities_in_state(self, state_name:str, min_pop:int=50000):
         return self.US_CITIES[(self.US_CITIES.state_name == state_name) & (
             self.US_CITIES.population >= min_pop)].sort_values(
                 by=['population'], ascending=False).city.to_list()
 
-    def biggest_nearby_cities(self, nearby_state_ids:list, min_pop:int=50000):
+    def biggest_cities_in(self, nearby_state_ids:list, min_pop:int=50000):
         ''' Return list of biggest cities in given states. '''
         biggest_cities = []
         for state_id in nearby_state_ids:
@@ -316,14 +1136,13 @@ class USGeoData(object):
                     (self.US_CITIES.population >= min_pop)].city.to_list())
         return set(biggest_cities)
 
-    def find_nearby_zipcodes(self, text:str, nearby_state_ids:list):
+    def find_nearby_zipcodes(self, text:str):
         ''' Matches 5-digit to plausible (nearby-state) zipcodes. '''
-        zips = re.findall(r"\D(\d{5})\D", " " + text + " ")
-        return [self.ZIPCODE_DB[z] for z in zips if (self.ZIPCODE_DB.get(z) and 
-            self.ZIPCODE_DB[z].state in nearby_state_ids)]
+        zips = FIVE_DIGITS.findall(" " + text + " ")
+        return [self.nearby_zipcodes[z] for z in zips if z in self.nearby_zipcodes]
 
-    def city_objects(self, city:str):
-        return self.US_CITIES[self.US_CITIES.city == city]
+    def city_rows(self, city:str):
+        return self.CITIES_BY_NAME.get(city, [])
 
     def possible_city_state(self, state_name:str, nearby_states:list, cities_dict_dict:dict, states_dict_dict:dict):
         ''' Return possible city and state of address.
@@ -333,9 +1152,9 @@ class USGeoData(object):
         added_city_state = False
         for city_object in cities_dict_dict.values():
             added_city = False
+            city_states = self.CITY_STATES.get(city_object['name'], ())
             for state in nearby_states:
-                if state in self.US_CITIES[
-                        self.US_CITIES.city == city_object['name']].state_name.to_list():
+                if state in city_states:
                     suffixes.append({'city':city_object['name'], 'state':state})
                     added_city = True
                     added_city_state = True
@@ -353,43 +1172,120 @@ class USGeoData(object):
         Returns
             matches: dict from words in tokens to dicts of correct word and confidence
         '''
+        for token in tokens: assert token, tokens
+        # exact match by priority, otherwise probable matches (memoized, else scored in one batch)
+        best = {}
+        for title in dict.fromkeys(token.title() for token in tokens):
+            if title not in self.biggest_nearby_cities:
+                best[title] = self.TOKEN_MEMO.get('city', (self.memo_scope, title, threshold))
+        missing = [title for title, match in best.items() if match is None]
+        for title, title_matches in zip(missing, self.city_matcher.extract(missing, 
+                limit=5, threshold=threshold)):
+            # weakest of the top matches above threshold, if any
+            best[title] = title_matches[-1] if title_matches else ()
+            self.TOKEN_MEMO.set('city', (self.memo_scope, title, threshold), best[title])
         matches = {}
         for token in tokens:
-            assert token, tokens
-            # exact match by priority
             if token.title() in self.biggest_nearby_cities:
                 matches[token] = {'name':token.title(), 'conf':100}
-                continue
-            # otherwise probable matches
-            cities = process.extract(token.title(), self.biggest_nearby_cities, 
-                scorer=fuzz.ratio, limit=5)
-            for (city, score) in cities:
-                if score < threshold: break
+            elif best[token.title()]:
+                (city, score) = best[token.title()]
                 matches[token] = {'name':city, 'conf':score}
         return matches
 
+    def best_matches(self, namespace:str, matcher:FuzzyMatcher, queries:list):
+        ''' Best (choice, score) of each query, memoized, else scored in one batch. '''
+        best = {query: self.TOKEN_MEMO.get(namespace, (self.memo_scope, query)) 
+            for query in dict.fromkeys(queries)}
+        missing = [query for query, match in best.items() if match is None]
+        for query, match in zip(missing, matcher.extract_one(missing)):
+            best[query] = match
+            self.TOKEN_MEMO.set(namespace, (self.memo_scope, query), match)
+        return best
+
     def check_nearby_states(self, tokens_list:list, name_thresh:int=80, id_thresh:int=90):
         ''' Given list of potential states, return possible true states
         as dict of dicts mapping state name to state name and confidence. 
         '''
+        for token in tokens_list: assert token, tokens_list
+        best_names = self.best_matches('state_name', self.state_name_matcher, 
+            [token.title() for token in tokens_list])
+        best_ids = self.best_matches('state_id', self.state_id_matcher, 
+            [token.upper() for token in tokens_list])
         matches = {}
         for token in tokens_list:
-            assert token, tokens
             # exact (nearby state) matches
-            if token.title() in set(self.nearby_states):
+            if token.title() in self.nearby_state_set:
                 matches[token.title()] = {'name':token.title(),'conf':100,'type':'name'}
-            if token.upper() in set(self.nearby_state_ids):
+            if token.upper() in self.nearby_state_id_set:
                 token_name = self.state_id_to_state_name(token.upper())
                 if not token_name in matches: 
                     matches[token_name] = {'name':token_name,'conf':100,'type':'id'}
             # probable matches
-            (state, score) = process.extractOne(token.title(), self.nearby_states, scorer=fuzz.ratio)
+            (state, score) = best_names[token.title()]
             if score >= name_thresh and not state in matches: 
                 matches[state] = {'name':state,'conf':score,'type':'name'}
-            (abbrev, score) = process.extractOne(token.upper(), self.nearby_state_ids, scorer=fuzz.ratio)
+            (abbrev, score) = best_ids[token.upper()]
             if score >= id_thresh: 
                 abbrev_name = self.state_id_to_state_name(abbrev)
                 if not abbrev_name in matches: 
                     matches[abbrev_name] = {'name':abbrev_name,'conf':score,'type':'id'}
         return matches
 
+
+# Auxiliary files the helper classes are built from, and snapshot of both once built
+HELPER_SOURCES = ["dictionary_list.txt", "states.csv", "simplemaps/uscities.csv", 
+    "neighbors-states.csv", "countyzipcrosswalk.csv"]
+HELPERS_SNAPSHOT = "helpers-snapshot.pkl"
+
+
+def helpers_version(aux_dir:str):
+    ''' Hash of the auxiliary files and of this module (which builds the helpers). '''
+    sha = hashlib.sha256()
+    for filepath in [os.path.join(aux_dir, source) for source in HELPER_SOURCES] + [__file__]:
+        with open(filepath, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+def build_helpers(aux_dir:str, text_help:bool=True):
+    US_DATA = USGeoData(
+        os.path.join(aux_dir, "states.csv"),
+        os.path.join(aux_dir, "simplemaps/uscities.csv"),
+        os.path.join(aux_dir, "neighbors-states.csv"),
+        os.path.join(aux_dir, "countyzipcrosswalk.csv")
+    )
+    TEXT_HELP = TextWrapper(os.path.join(aux_dir, "dictionary_list.txt")) if text_help else None
+    return US_DATA, TEXT_HELP
+
+
+def save_helpers_snapshot(aux_dir:str, filepath:str):
+    ''' Build helpers and pickle them after their version: USGeoData first, so that 
+    it can be loaded without (the much bigger) TextWrapper. '''
+    US_DATA, TEXT_HELP = build_helpers(aux_dir)
+    with open(filepath + '.tmp', 'wb') as f:
+        for obj in (helpers_version(aux_dir), US_DATA, TEXT_HELP):
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(filepath + '.tmp', filepath)
+    return US_DATA, TEXT_HELP
+
+
+def load_helpers(aux_dir:str, snapshot_fp:str=None, text_help:bool=True):
+    ''' Return USGeoData and (if text_help) TextWrapper, from snapshot if there is one
+    built from the current auxiliary files and code, else built from the files. 
+    '''
+    snapshot_fp = snapshot_fp or os.path.join(aux_dir, HELPERS_SNAPSHOT)
+    if os.path.isfile(snapshot_fp):
+        with open(snapshot_fp, 'rb') as f:
+            if pickle.load(f) == helpers_version(aux_dir):
+                # Garbage collection only slows down unpickling millions of objects
+                gc.disable()
+                try:
+                    US_DATA = pickle.load(f)
+                    TEXT_HELP = pickle.load(f) if text_help else None
+                finally:
+                    gc.enable()
+                print("Loaded helpers from snapshot '{}'.".format(snapshot_fp))
+                return US_DATA, TEXT_HELP
+        print("Snapshot '{}' is out of date (rebuild with build-cache.py).".format(snapshot_fp))
+    return build_helpers(aux_dir, text_help)
@@ -0,0 +1,124 @@
+import copy
+import json
+import os
+import time
+from glob import glob
+from collections import Counter
+from common import SQLiteCache, STAGE_TIMER, array_shard, helpers_version, load_helpers, \
+    shard_suffix, time_now
+from extract import EXTRACT_STAGES, Newspaper, argument_parser, extract_file, newspaper_pool, \
+    rules_version
+
+
+def paper_files(input_dir:str, pattern:str, papers:list):
+    ''' Input file of each newspaper found in input_dir, largest first. '''
+    files = {}
+    for paper in papers:
+        found = sorted(glob(os.path.join(input_dir, pattern.format(paper))))
+        assert len(found) <= 1, "Several inputs of {} found, choose one of {}.".format(
+            paper, found)
+        if not found:
+            print("No input of {} found in '{}', skipping it.".format(paper, input_dir))
+            continue
+        files[paper] = found[0]
+    return sorted(files.items(), key=lambda item: os.path.getsize(item[1]), reverse=True)
+
+def main():
+    ''' Extract all newspapers in one job, from helpers loaded once: each newspaper gets its
+    own geo-data from them, and all share one pool of workers, memos and ad store. The
+    largest newspapers go first, so that the job's length is set by them rather than by
+    whichever is left last, and the throughput of each is reported. '''
+    US_DATA, TEXT_HELP = load_helpers(args.aux_dir, args.snapshot)
+    papers = args.papers.split(',') if args.papers else list(US_DATA.NEWSPAPER_TO_STATE_ID)
+    files = paper_files(args.input_dir, args.pattern, papers)
+    assert files, "No inputs found in '{}'.".format(args.input_dir)
+    print("Will extract {} newspapers, in order: {}.".format(len(files), ', '.join(
+        '{} ({} MB)'.format(paper, round(os.path.getsize(filepath) / 1e6, 1))
+            for paper, filepath in files)))
+
+    # All Newspapers are built before the pool, whose workers then inherit them all
+    NEWSPAPERS = {paper: Newspaper(newspaper=paper, US_DATA=US_DATA, TEXT_HELP=TEXT_HELP)
+        for paper, _ in files}
+
+    # Preload memoized token matches and spelling corrections (shared by all newspapers)
+    memo_paths = {}
+    if args.token_memo: memo_paths[US_DATA.TOKEN_MEMO] = \
+        args.token_memo_path or os.path.join(args.output_dir, 'token-memo.pkl')
+    if args.spell_memo: memo_paths[TEXT_HELP.CORRECTIONS] = \
+        args.spell_memo_path or os.path.join(args.output_dir, 'spell-memo.pkl')
+    # Memos hold results of the helpers, so are only reused if these haven't changed since
+    memo_version = helpers_version(args.aux_dir)
+    for memo, memo_path in memo_paths.items(): memo.load(memo_path, memo_version)
+
+    if args.instrument: STAGE_TIMER.instrument(EXTRACT_STAGES)
+    shard_index, num_shards = array_shard(args.shard_index, args.num_shards)
+
+    print("Beginning {}extractions using {} processing ({} workers){} at {}.".format(
+        'streamed ' if args.stream else '', 'multi' if args.multiprocessing else 'serial',
+        args.nworkers or 1, ' for shard {} of {}'.format(shard_index, num_shards) if
+            num_shards > 1 else '', time_now()))
+    start_time = time.time()
+    pool = newspaper_pool(list(NEWSPAPERS.values()), args.nworkers) \
+        if args.multiprocessing else None
+    store = SQLiteCache(args.ad_store_path or os.path.join(args.output_dir,
+        shard_suffix('ad-store', shard_index, num_shards) + '.sqlite')) if args.ad_store else None
+    version = rules_version(args.aux_dir)
+    report_path = args.report_path or os.path.join(args.output_dir,
+        shard_suffix('extract-all-throughput', shard_index, num_shards) + '.jsonl')
+
+    throughputs = []
+    for paper, filepath in files:
+        print("Beginning {} ('{}') at {}.".format(paper, filepath, time_now()))
+        paper_args = copy.copy(args)
+        paper_args.filepath = filepath
+        dedup_counts = Counter()
+        paper_start = time.time()
+        nrows = extract_file(paper_args, NEWSPAPERS[paper], pool, store, memo_paths,
+            dedup_counts, version)
+        elapsed = time.time() - paper_start
+        throughput = {'newspaper':paper, 'filepath':filepath, 'time':time_now(),
+            'ads':nrows, 'seconds':round(elapsed, 1),
+            'ads_per_second':round(nrows / elapsed, 1) if elapsed else None,
+            'repeats':dedup_counts['repeats'], 'stored':dedup_counts['stored'],
+            'extracted':dedup_counts['extracted']}
+        throughputs.append(throughput)
+        with open(report_path, 'a') as f:
+            f.write(json.dumps(throughput) + '\n')
+        print("Completed {}: {} ads in {} minutes ({} ads per second).".format(paper, nrows,
+            round(elapsed / 60, 2), throughput['ads_per_second']))
+    if pool: pool.shutdown()
+    if store: store.close()
+
+    print("Throughput by newspaper (appended to '{}'):".format(report_path))
+    for throughput in throughputs:
+        print("  {newspaper}: {ads} ads in {seconds} seconds ({ads_per_second} ads per " \
+            "second, {repeats} repeats, {stored} found in store).".format(**throughput))
+    if args.instrument:
+        print("Stage timings (seconds): {}.".format(', '.join('{}: {}'.format(stage,
+            round(seconds, 1)) for stage, seconds in STAGE_TIMER.total_seconds.most_common())))
+    print("Token memo:", US_DATA.TOKEN_MEMO.stats())
+    print("Spelling memo:", TEXT_HELP.CORRECTIONS.stats())
+
+    elapsed = time.time() - start_time
+    nrows = sum(throughput['ads'] for throughput in throughputs)
+    print("Completed extractions of {} ads at {} in {} minutes ({} ads per second).".format(
+        nrows, time_now(), round(elapsed / 60, 2), round(nrows / elapsed, 1) if elapsed else None))
+
+if __name__ == "__main__":
+    parser = argument_parser(filepath=False)
+    parser.add_argument('-i', '--input_dir', type=str, help="Filepath to directory of " \
+        "newspaper ads.", default="/accounts/projects/pkline/newslabor/Documents/" \
+            "Newspaper_2023/3_Data_processing/4-output/6-final-datasets/")
+    parser.add_argument('--pattern', type=str, default='{}.csv', help="Filename of a " \
+        "newspaper's ads in input_dir, with '{}' for the newspaper (globs allowed).")
+    parser.add_argument('-p', '--papers', type=str, default=None, help="Comma-separated " \
+        "newspapers to extract (default: all, e.g. ASA,ATC,...,WaP).")
+    parser.add_argument('-r', '--report_path', type=str, default=None, help="Filepath to " \
+        "append each newspaper's throughput to as JSON lines (default: " \
+        "'extract-all-throughput.jsonl' in output_dir).")
+    args = parser.parse_args()
+
+    assert os.path.isdir(args.aux_dir), 'Invalid filepath to auxilliary files.'
+    assert os.path.isdir(args.input_dir), 'Invalid filepath to input directory.'
+    assert os.path.isdir(args.output_dir), 'Invalid filepath to output directory.'
+    main()
@@ -1,10 +1,18 @@
+import re
 import time
 import os 
 import argparse
+import hashlib
+import functools
 import pandas as pd
 from math import ceil
-from common import TextWrapper, USGeoData, add_filepath_suffix, time_now
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import Counter
+from multiprocessing import get_context, get_all_start_methods
+from common import Manifest, SQLiteCache, FuzzyMatcher, TextWrapper, USGeoData, ADDRESS_TYPE, \
+    FIVE_DIGITS, STAGE_TIMER, add_filepath_suffix, array_shard, batch_types, combine_profiles, \
+    concat_parquet, csv_dtypes, helpers_version, in_shard, load_helpers, profiled, read_batches, \
+    shard_suffix, time_now, write_parquet
+from concurrent.futures import ProcessPoolExecutor
 
 
 class Newspaper(object):
@@ -55,33 +63,36 @@ class Newspaper(object):
             return address_dicts_list
 
         tokens_list = self.TEXT_HELP.clean_tokenize(ad_text, self.newspaper)
+        return self.extract_tokens(ad_text, tokens_list)
+
+    def extract_tokens(self, ad_text:str, tokens_list:list):
+        ''' Extract possible addresses, given the ad's (cleaned) tokens. '''
+        address_dicts_list = []
         if not tokens_list: return address_dicts_list
 
         # Upon detecting street marker, form extracted geolocation
-        for i, word in enumerate(tokens_list):
-            if i == 0: continue
-            if word.lower() in self.TEXT_HELP.STREET_MARKERS:
-                prefix = self.TEXT_HELP.find_street(tokens_list, i)
-                suffixes = self.city_state_options(tokens_list, i) 
-                assert suffixes
-                for suffix in suffixes:
-                    address = prefix | suffix
-                    if not address in address_dicts_list: 
-                        address_dicts_list.append(address)
+        for i in self.TEXT_HELP.street_marker_indices(tokens_list):
+            prefix = self.TEXT_HELP.find_street(tokens_list, i)
+            suffixes = self.city_state_options(tokens_list, i) 
+            assert suffixes
+            for suffix in suffixes:
+                address = prefix | suffix
+                if not address in address_dicts_list: 
+                    address_dicts_list.append(address)
 
         # Complement that with zipcodes (which also lead directly to county)
-        zipcode_objects = self.US_DATA.find_nearby_zipcodes(ad_text, self.US_DATA.nearby_state_ids)
+        zipcode_objects = self.US_DATA.find_nearby_zipcodes(ad_text)
         zipcodes, added_zipcodes = [z.zip for z in zipcode_objects], []
         
         # For detected cities, check if detected zipcodes found in said cities
         for city_object in self.US_DATA.check_nearby_cities(tokens_list).values():
-            for i, row in self.US_DATA.city_objects(city_object['name']).iterrows():
-                for matched_zipcode in set(zipcodes) & set(row['zips'].split()):
+            for row in self.US_DATA.city_rows(city_object['name']):
+                for matched_zipcode in set(zipcodes) & set(row.zips.split()):
                     added_zipcodes.append(matched_zipcode)
                     address_dicts_list.append({
                         'city':city_object['name'],
-                        'state':row['state_name'],
-                        'county':row['county_name'],
+                        'state':row.state_name,
+                        'county':row.county_name,
                         'zipcode':matched_zipcode}
                     )
         address_dicts_list.extend([{'zipcode':z} for z in zipcodes if z not in added_zipcodes])
@@ -91,17 +102,23 @@ class Newspaper(object):
         ''' Mirror extract, find *EMPLOYER NAME* and *OFFERED WAGE*.
         In theory would've done both at same time.
         '''
-        employer_dict = {'wage':None}
-        if sandbox: employer_dict.update(
-            {'_wage_pred_strong':[],'_wage_pred_maybe':[],'_wage_pred_weak':[]})
+        employer_dict = self.empty_employer_dict(sandbox)
         if not ad_text or not isinstance(ad_text, str): return employer_dict
 
         # Keep only first ad and skip over non-labor ads
         text = ad_text.split("_classifiedad_")[0]
-        if any(term in text for term in self.TEXT_HELP.REAL_ESTATE) and not any(
-            word in text for word in self.TEXT_HELP.NOT_RE): 
+        if self.TEXT_HELP.is_real_estate(text) and not self.TEXT_HELP.is_labor(text): 
             return employer_dict
+        return self.employer_info_text(text, employer_dict, sandbox, extract_employer)
+
+    def empty_employer_dict(self, sandbox=False):
+        employer_dict = {'wage':None}
+        if sandbox: employer_dict.update(
+            {'_wage_pred_strong':[],'_wage_pred_maybe':[],'_wage_pred_weak':[]})
+        return employer_dict
 
+    def employer_info_text(self, text:str, employer_dict:dict, sandbox=False, extract_employer=False):
+        ''' Find employer name and wage in (first, labor) ad text, into employer_dict. '''
         # Try to extract employer name
         if extract_employer:
             employer_dict['employer'] = self.TEXT_HELP.extract_pos_employer(text)
@@ -111,13 +128,12 @@ class Newspaper(object):
 
         tokens_list = text.split()
         best_candidates, potential_candidates, weak_candidates = [], [], []
-        for i, word in enumerate(tokens_list):
-            # When find potential salary, format
-            if self.TEXT_HELP.potential_salary(word):
-                best, potential, weak = self.TEXT_HELP.format_wage_candidate(tokens_list, i)
-                if best: best_candidates.append(best)
-                if potential: potential_candidates.append(potential)
-                if weak: weak_candidates.append(weak)
+        # When find potential salary, format
+        for i in self.TEXT_HELP.salary_indices(tokens_list):
+            best, potential, weak = self.TEXT_HELP.format_wage_candidate(tokens_list, i)
+            if best: best_candidates.append(best)
+            if potential: potential_candidates.append(potential)
+            if weak: weak_candidates.append(weak)
 
         # Output best choice
         def choose_best_salary(options:list):
@@ -129,7 +145,7 @@ class Newspaper(object):
                 options = [wage for i, wage in enumerate(options) if not any(wage in opt for opt in options[i+1:])]
                 for wage in options:
                     # Ensure best option has RATE
-                    if any(rate in wage for rate in (self.TEXT_HELP.RATES_SINGLE | self.TEXT_HELP.RATES_DOUBLE)):
+                    if self.TEXT_HELP.RATES.search(wage):
                         salary = wage
                         break
             return salary or options[0]
@@ -142,114 +158,470 @@ class Newspaper(object):
         
         return employer_dict
 
+    def extract_all(self, ad_text, extract_address:bool=True, extract_wage:bool=True, sandbox=False):
+        ''' Fused extract and employer_info, returning one record of 'addresses' and/or 
+        wage fields, with the first ad split out and screened for real estate once. 
+        '''
+        if not ad_text or not isinstance(ad_text, str):
+            record = {'addresses':self.extract(ad_text)} if extract_address else {}
+            if extract_wage: record.update(self.employer_info(ad_text, sandbox))
+            return record
 
+        # Wages are extracted from the first ad and addresses from before the paper's
+        # own separator, which is the same text if the ad has no separator at all
+        text = ad_text.split("_classifiedad_")[0]
+        first = text if len(text) == len(ad_text) else \
+            ad_text.split("{}_classifiedad_".format(self.newspaper))[0]
+        real_estate = self.TEXT_HELP.is_real_estate(text)
+        record = {}
+        if extract_address:
+            first_real_estate = real_estate if first is text else self.TEXT_HELP.is_real_estate(first)
+            record['addresses'] = self.extract_tokens(ad_text, 
+                None if first_real_estate else self.TEXT_HELP.tokenize(first))
+        if extract_wage:
+            employer_dict = self.empty_employer_dict(sandbox)
+            if not real_estate or self.TEXT_HELP.is_labor(text):
+                employer_dict = self.employer_info_text(text, employer_dict, sandbox)
+            record.update(employer_dict)
+        return record
 
-def multiprocessing(func, args, max_workers:int=None):
-    with ProcessPoolExecutor(max_workers) as ex:
-        res = ex.map(func, args)
-    return list(res)
 
 
-def multithreading(func, args, max_workers:int=None):
-    with ThreadPoolExecutor(max_workers) as ex:
-        res = ex.map(func, args)
-    return list(res)
+# Stages timed when instrumented, as (stage, class, method name)
+EXTRACT_STAGES = [
+    ('extract_all', Newspaper, 'extract_all'),
+    ('tokenize', TextWrapper, 'tokenize'),
+    ('street_detection', TextWrapper, 'street_marker_indices'),
+    ('find_street', TextWrapper, 'find_street'),
+    ('city_state_options', Newspaper, 'city_state_options'),
+    ('zipcode_scan', USGeoData, 'find_nearby_zipcodes'),
+    ('nearby_cities', USGeoData, 'check_nearby_cities'),
+    ('nearby_states', USGeoData, 'check_nearby_states'),
+    ('symspell', TextWrapper, '_correct_sentence'),
+    ('symspell', TextWrapper, '_can_combine'),
+    ('fuzzy_matching', FuzzyMatcher, 'scores'),
+    ('wage_normalization', TextWrapper, 'clean_for_wage'),
+    ('salary_scan', TextWrapper, 'salary_indices'),
+    ('wage_candidates', TextWrapper, 'format_wage_candidate'),
+]
 
 
-if __name__ == "__main__":
+# Newspapers held by each pool worker, by name, set once by `init_worker`
+WORKER_NEWSPAPERS = {}
+
+def init_worker(newspapers:list, instrumented:bool=False):
+    ''' Pool initializer: keep the Newspapers (sharing their text/geo helpers) per worker,
+    and time their stages if the parent does. '''
+    WORKER_NEWSPAPERS.update({newspaper.newspaper: newspaper for newspaper in newspapers})
+    if instrumented: STAGE_TIMER.instrument(EXTRACT_STAGES)
+    # Timings inherited from the parent (through fork) are its own
+    STAGE_TIMER.drain()
+
+def newspaper_memos(newspaper):
+    ''' Memos of fuzzy token matches and spelling corrections. '''
+    return [newspaper.US_DATA.TOKEN_MEMO, newspaper.TEXT_HELP.CORRECTIONS]
+
+def worker_state(newspaper):
+    ''' What pool workers learn and count, drained after each chunk and merged into
+    the parent: the newspaper's memos and stage timings. '''
+    return newspaper_memos(newspaper) + [STAGE_TIMER]
+
+def extract_all_chunk(jobs:list, newspaper:str, profile:str=None):
+    ''' Records of (ad text, extract address, extract wage) jobs in chunk of newspaper, and 
+    what the worker's memos learned (and counted), profiled into a part of profile if given. '''
+    NEWSPAPER = WORKER_NEWSPAPERS[newspaper]
+    with profiled(profile):
+        records = [NEWSPAPER.extract_all(ad_text, extract_address, extract_wage) 
+            for ad_text, extract_address, extract_wage in jobs]
+    return records, [state.drain() for state in worker_state(NEWSPAPER)]
+
+def newspaper_pool(newspapers, max_workers:int=None):
+    ''' Process pool whose workers are handed the Newspaper (or list of Newspapers, 
+    to share the pool) once at start-up, inherited through fork where available (pickled 
+    once per worker otherwise), instead of pickling it along with every ad.
+    '''
+    if isinstance(newspapers, Newspaper): newspapers = [newspapers]
+    context = get_context('fork') if 'fork' in get_all_start_methods() else None
+    return ProcessPoolExecutor(max_workers, mp_context=context,
+        initializer=init_worker, initargs=(newspapers, STAGE_TIMER.enabled))
+
+def multiprocessing(func, args, pool, max_workers:int=None, chunksize:int=None, memos:list=()):
+    ''' Map chunk function over args, sending rows to the pool in large chunks, 
+    and merge the workers' memo deltas into memos. '''
+    args = list(args)
+    if not args: return []
+    # By default, roughly four chunks per worker to even out slow ads
+    chunksize = chunksize or ceil(len(args) / ((max_workers or os.cpu_count()) * 4))
+    chunks = [args[i:i+chunksize] for i in range(0, len(args), chunksize)]
+    results = []
+    for chunk_res, memo_deltas in pool.map(func, chunks):
+        results.extend(chunk_res)
+        for memo, memo_delta in zip(memos, memo_deltas):
+            memo.merge(memo_delta)
+    return results
+
+def rules_version(aux_dir:str):
+    ''' Hash of the extraction rules: the helpers' (auxiliary files and common module) 
+    and this module. '''
+    sha = hashlib.sha256(helpers_version(aux_dir).encode())
+    with open(__file__, 'rb') as f:
+        sha.update(f.read())
+    return sha.hexdigest()[:16]
+
+def ad_keys(ad_text:str, newspaper:str, extract_address:bool=True, extract_wage:bool=True):
+    ''' Hashes of (exactly) what the address and wage extractors read of an ad, or None 
+    for those not extracted: its first ad by the paper's separator, along with the 5-digit 
+    numbers of the whole ad, and its first ad by any separator. '''
+    def digest(text:str):
+        return hashlib.sha1(text.encode('utf-8', 'surrogatepass')).hexdigest()
+    address_key = digest('{}\x00{}'.format(ad_text.split("{}_classifiedad_".format(newspaper))[0], 
+        ' '.join(FIVE_DIGITS.findall(" " + ad_text + " ")))) if extract_address else None
+    wage_key = digest(ad_text.split("_classifiedad_")[0]) if extract_wage else None
+    return address_key, wage_key
+
+def extract_batch(texts:pd.Series, NEWSPAPER:Newspaper, pool=None, extract_address:bool=True, 
+        extract_wage:bool=False, max_workers:int=None, chunksize:int=None, dedup:bool=True, 
+        store:SQLiteCache=None, version:str='', dedup_counts:Counter=None, profile:str=None):
+    ''' Extract addresses and/or wages for a batch of ad texts, serially or on pool,
+    in one pass over the ads that pass the batch screens. With dedup, repeated ads are 
+    extracted once, and with a store, results of previous runs (of the same rules
+    `version`) are reused and this batch's are added. With profile, the extractions 
+    are profiled (in each worker) and combined into that filepath.
+    '''
+    screens, skipped = screen_batch(texts, NEWSPAPER, extract_address, extract_wage)
+    print("Screens skipped {} extractions ({}).".format(' and '.join('{} of {} {}'.format(
+        (~screens[what]).sum(), len(texts), what) for what, extracted in 
+            [('address', extract_address), ('wage', extract_wage)] if extracted),
+        ', '.join('{}: {}'.format(screen, n) for screen, n in skipped.items())))
+
+    # Key each screened job by what its extractors read (or by position, without dedup)
+    jobs = list(zip(texts, screens.address, screens.wage))
+    keys = [(ad_keys(ad_text, NEWSPAPER.newspaper, address, wage) if (dedup or store) and 
+        isinstance(ad_text, str) else i) if address or wage else None 
+            for i, (ad_text, address, wage) in enumerate(jobs)]
+    unique = {}
+    for key, job in zip(keys, jobs):
+        if key is not None: unique.setdefault(key, job)
+
+    # Reuse stored results, so that only the extractions missing from the store are done
+    namespaces = {'address':'address:{}:{}'.format(NEWSPAPER.newspaper, version), 
+        'wage':'wage:{}'.format(version)}
+    stored = {'address':{}, 'wage':{}}
+    if store:
+        hashed = [key for key in unique if isinstance(key, tuple)]
+        for what, idx in [('address', 0), ('wage', 1)]:
+            stored[what] = store.get_many(namespaces[what], 
+                [key[idx] for key in hashed if key[idx] is not None])
+    def missing(key, job):
+        if not isinstance(key, tuple): return job
+        return (job[0], job[1] and key[0] not in stored['address'], 
+            job[2] and key[1] not in stored['wage'])
+    remaining = {key: missing(key, job) for key, job in unique.items()}
+    remaining = {key: job for key, job in remaining.items() if job[1] or job[2]}
+
+    if pool:
+        extracted = multiprocessing(functools.partial(extract_all_chunk, 
+            newspaper=NEWSPAPER.newspaper, profile=profile), list(remaining.values()), pool, 
+                max_workers, chunksize, memos=worker_state(NEWSPAPER))
+    else:
+        with profiled(profile):
+            extracted = [NEWSPAPER.extract_all(*job) for job in remaining.values()]
+    extracted = dict(zip(remaining, extracted))
+    if profile: combine_profiles(profile)
+    def record_of(key):
+        record = dict(extracted.get(key, {}))
+        if isinstance(key, tuple):
+            if key[0] in stored['address']: record['addresses'] = stored['address'][key[0]]
+            if key[1] in stored['wage']: record.update(stored['wage'][key[1]])
+        return record
+    if store:
+        # Addresses are stored per paper (as they depend on its nearby states), wages not
+        new = {'address':{}, 'wage':{}}
+        for key, record in extracted.items():
+            if not isinstance(key, tuple): continue
+            _, address, wage = remaining[key]
+            if address: new['address'][key[0]] = record['addresses']
+            if wage: new['wage'][key[1]] = {field: value for field, value in record.items() 
+                if field != 'addresses'}
+        for what, items in new.items(): store.set_many(namespaces[what], items)
+
+    n_screened = sum(key is not None for key in keys)
+    print("Extracted {} of {} screened ads ({} repeats, {} found in store).".format(len(extracted), 
+        n_screened, n_screened - len(unique), len(unique) - len(remaining)))
+    if dedup_counts is not None:
+        dedup_counts.update({'screened':n_screened, 'repeats':n_screened - len(unique), 
+            'stored':len(unique) - len(remaining), 'extracted':len(extracted)})
+
+    # Skipped extractions are what the extractors return when they find nothing
+    records = [record_of(key) if key is not None else {} for key in keys]
+    for record in records:
+        if extract_address: record.setdefault('addresses', [])
+        if extract_wage: 
+            for key, value in NEWSPAPER.empty_employer_dict().items(): record.setdefault(key, value)
+
+    extractions = pd.DataFrame(index=texts.index)
+    if extract_address:
+        extractions['addresses'] = pd.Series([record.pop('addresses') for record in records], 
+            index=texts.index, dtype=object)
+    if extract_wage:
+        extractions = extractions.join(pd.DataFrame(records, index=texts.index))
+    return extractions
+
+
+def screen_batch(texts:pd.Series, NEWSPAPER:Newspaper, extract_address:bool=True, 
+        extract_wage:bool=False):
+    ''' Screen a batch of ads with vectorized string operations for those from which
+    the extractors can't possibly get an address or a wage: real estate ads (as the 
+    extractors screen them), ads with neither a street marker nor a 5-digit number
+    (for addresses) and ads without any digit (for wages). 
+
+    Returns:
+        screens: DataFrame of whether each ad still needs address and wage extraction
+        skipped: dict from screens to number of extractions each skipped
+    '''
+    TEXT_HELP = NEWSPAPER.TEXT_HELP
+    def any_of(terms:list):
+        return '|'.join(re.escape(term) for term in terms)
+
+    # Non-strings are left to the extractors
+    strings = texts.map(lambda ad_text: isinstance(ad_text, str))
+    ad_texts = texts.where(strings, '')
+    screens = pd.DataFrame({'address':False, 'wage':False}, index=texts.index)
+    skipped = {}
+    if extract_address:
+        first = ad_texts.str.split('{}_classifiedad_'.format(NEWSPAPER.newspaper), n=1).str[0]
+        real_estate = first.str.contains(any_of(TEXT_HELP.REAL_ESTATE))
+        candidates = ad_texts.str.contains(TEXT_HELP.STREET_MATCHER.pattern) | \
+            ad_texts.str.contains(r'(?<!\d)\d{5}(?!\d)')
+        screens['address'] = ~strings | (~real_estate & candidates)
+        skipped['address real estate'] = (strings & real_estate).sum()
+        skipped['no street marker or zipcode'] = (strings & ~real_estate & ~candidates).sum()
+    if extract_wage:
+        text = ad_texts.str.split('_classifiedad_', n=1).str[0]
+        labor = ~text.str.contains(any_of(TEXT_HELP.REAL_ESTATE)) | \
+            text.str.contains(any_of(TEXT_HELP.NOT_RE))
+        digits = text.str.contains(r'\d')
+        screens['wage'] = ~strings | (labor & digits)
+        skipped['wage real estate'] = (strings & ~labor).sum()
+        skipped['no digits'] = (strings & labor & ~digits).sum()
+    return screens, skipped
+
+
+def extract_file(args, NEWSPAPER:Newspaper, pool=None, store:SQLiteCache=None, 
+        memo_paths:dict=None, dedup_counts:Counter=None, version:str=None):
+    ''' Extract the ads of args.filepath for newspaper batch by batch (this shard's, if 
+    sharded), checkpointing each batch in the run's manifest and saving the memos after 
+    it, then assemble the output unless sharded. Returns the number of ads extracted (i.e. 
+    not already in the manifest).
+    '''
+    paper = NEWSPAPER.newspaper
+    memo_paths = memo_paths or {}
+
+    # Stage timings, emitted after each batch
+    stages_path = args.instrument_path or add_filepath_suffix(args.output_dir, paper, 
+        suffix='extract-stages', n=args.nrows, ext='jsonl')
+    labels = {'script':'extract', 'newspaper':paper}
+    def profile_path(batch_idx:int):
+        return add_filepath_suffix(args.output_dir, paper, n=(batch_idx+1)*args.batch_size, 
+            suffix='extract-profile', ext='prof') if args.profile and \
+                batch_idx % args.profile == 0 else None
+
+    # Shard of an array job, doing every num_shards-th batch (see merge-batch.py to finalize)
+    shard_index, num_shards = array_shard(args.shard_index, args.num_shards)
+    sharded = num_shards > 1
+
+    version = version or rules_version(args.aux_dir)
+    kwargs = dict(pool=pool, max_workers=args.nworkers, chunksize=args.chunksize, 
+        dedup=args.dedup, store=store, version=version, dedup_counts=dedup_counts)
+
+    # Checkpoint of completed batches, so that a restarted run only redoes the rest (of 
+    # the same rules, as batches extracted by others are redone)
+    params = {'filepath':os.path.abspath(args.filepath), 'nrows':args.nrows, 
+        'batch_size':args.batch_size, 'stream':args.stream, 
+        'extract_address':args.extract_address, 'extract_wage':args.extract_wage,
+        'version':version}
+    if sharded: params.update({'shard_index':shard_index, 'num_shards':num_shards})
+    manifest = Manifest(add_filepath_suffix(args.output_dir, paper, ext='json', n=args.nrows,
+        suffix=shard_suffix('extract-manifest', shard_index, num_shards)), params=params, 
+        types={'addresses':ADDRESS_TYPE})
+
+    extracted = 0
+    if args.stream:
+        # Read, extract and write one batch at a time, so memory is bounded by batch size,
+        # with CSV columns of the same types in all batches (so that they can be assembled)
+        dtypes = csv_dtypes(args.filepath, args.batch_size, nrows=args.nrows) \
+            if args.filepath.endswith('.csv') else None
+        for batch_idx, batch in enumerate(read_batches(args.filepath, args.batch_size, 
+                nrows=args.nrows, dtypes=dtypes)):
+            start, end = batch_idx*args.batch_size, batch_idx*args.batch_size + len(batch)
+            if args.skip >= end or not in_shard(batch_idx, shard_index, num_shards) or \
+                manifest.completed(start, end): continue
+            batch.raw_content = batch.raw_content.fillna('')
+            batch = batch.join(extract_batch(batch.raw_content, NEWSPAPER, 
+                extract_address=args.extract_address, extract_wage=args.extract_wage, 
+                profile=profile_path(batch_idx), **kwargs))
+            with STAGE_TIMER.time('parquet_write'):
+                manifest.write_batch(batch, start, add_filepath_suffix(args.output_dir, paper, 
+                    n=(batch_idx+1)*args.batch_size, suffix='extract-batch'))
+            extracted += end - start
+            for memo, memo_path in memo_paths.items(): memo.save(memo_path)
+            if args.instrument: STAGE_TIMER.emit(stages_path, labels, batch=[start, end])
+            print("Processed ads {}-{} at {}...".format(start, end, time_now()))
+        # Assemble batches into final output, again one batch at a time
+        if not sharded:
+            with STAGE_TIMER.time('parquet_write'):
+                # Types unified over the batches, some of which a resumed run may not have read
+                paths = manifest.paths()
+                nrows = concat_parquet(paths, add_filepath_suffix(args.output_dir, paper, 
+                    n=args.nrows), types=batch_types(paths, {'addresses':ADDRESS_TYPE}), 
+                    csv_filepath=add_filepath_suffix(args.output_dir, paper, n=args.nrows, 
+                        ext='csv'))
+            print("Processed sample of {} observations.".format(nrows))
+    else:
+        # Load data
+        sample = pd.read_csv(args.filepath, nrows=args.nrows, index_col=[0])
+        sample.raw_content = sample.raw_content.fillna('')
+        print("Will process sample of {} observations.".format(len(sample)))
+
+        extractions = []
+        for batch_idx in range(ceil(len(sample) / args.batch_size)):
+            start, end = batch_idx*args.batch_size, min((batch_idx+1)*args.batch_size, len(sample))
+            if args.skip >= end or not in_shard(batch_idx, shard_index, num_shards): continue
+            completed = manifest.completed(start, end)
+            if completed:
+                extractions.append(pd.read_parquet(completed['path']))
+                continue
+            extractions_batch = extract_batch(sample.raw_content.iloc[start:end], NEWSPAPER, 
+                extract_address=args.extract_address, extract_wage=args.extract_wage, 
+                profile=profile_path(batch_idx), **kwargs)
+            with STAGE_TIMER.time('parquet_write'):
+                manifest.write_batch(extractions_batch, start, add_filepath_suffix(
+                    args.output_dir, paper, n=(batch_idx+1)*args.batch_size, suffix='extract-batch'))
+            extractions.append(extractions_batch)
+            extracted += end - start
+            for memo, memo_path in memo_paths.items(): memo.save(memo_path)
+            if args.instrument: STAGE_TIMER.emit(stages_path, labels, batch=[start, end])
+            print("Processed ads {}-{} at {}...".format(start, end, time_now()))
+        if extractions and not sharded:
+            sample = sample.join(pd.concat(extractions))
+            with STAGE_TIMER.time('parquet_write'):
+                write_parquet(sample, add_filepath_suffix(args.output_dir, paper, n=args.nrows), 
+                    types={'addresses':ADDRESS_TYPE})
+            sample.to_csv(add_filepath_suffix(args.output_dir, paper, n=args.nrows, ext='csv'))
+    if sharded:
+        print("Completed {} batches of shard {} of {} (merge all shards with merge-batch.py " \
+            "--suffix=extract).".format(len(manifest.batches), shard_index, num_shards))
+    if args.instrument: STAGE_TIMER.emit(stages_path, labels, batch='final')
+    return extracted
+
+def argument_parser(filepath:bool=True):
+    ''' Options of an extraction run (of one newspaper, at filepath, if asked). '''
     parser = argparse.ArgumentParser()
-    parser.add_argument('--filepath', type=str, help="Filepath to newspaper ads, e.g. " \
-        "/accounts/projects/pkline/newslabor/Documents/Newspaper_2023/" \
+    if filepath: parser.add_argument('--filepath', type=str, help="Filepath to newspaper " \
+        "ads, e.g. /accounts/projects/pkline/newslabor/Documents/Newspaper_2023/" \
         "3_Data_processing/4-output/6-final-datasets/ASA.csv")
     parser.add_argument('--extract_address', type=int, default=1)
     parser.add_argument('--extract_wage', type=int, default=0)
     parser.add_argument('-n', '--nrows', type=int, default=None, help="Maximum number of ads.")
     parser.add_argument('-m', '--multiprocessing', type=int, default=0, 
         help="Use multiprocessing.")
-    parser.add_argument('-s', '--skip', type=int, default=0, help="Ads to skip at beginning.")
+    parser.add_argument('-s', '--skip', type=int, default=0, help="Ads to skip at beginning " \
+        "(completed batches recorded in the run's manifest are skipped regardless).")
     parser.add_argument('-w', '--nworkers', type=int, default=None, help="Number workers to use.")
     parser.add_argument('-b', '--batch_size', type=int, default=100000, help="Batch size.")
+    parser.add_argument('--stream', type=int, default=0, help="Read, extract and write " \
+        "in batches (CSV chunks or parquet row groups) so memory stays bounded by batch size.")
+    parser.add_argument('-c', '--chunksize', type=int, default=None, 
+        help="Ads sent to a worker at a time (default: about four chunks per worker).")
+    parser.add_argument('--token_memo', type=int, default=1, help="Load fuzzy city/state " \
+        "matches of tokens saved by previous runs, and save this run's after each batch.")
+    parser.add_argument('--token_memo_path', type=str, default=None, 
+        help="Filepath to token memo (default: token-memo.pkl in output directory).")
+    parser.add_argument('--spell_memo', type=int, default=1, help="Load spelling " \
+        "corrections saved by previous runs, and save this run's after each batch.")
+    parser.add_argument('--spell_memo_path', type=str, default=None, 
+        help="Filepath to spelling memo (default: spell-memo.pkl in output directory).")
+    parser.add_argument('--dedup', type=int, default=0, help="Extract repeated ads " \
+        "(by the text the extractors read) once per batch.")
+    parser.add_argument('--ad_store', type=int, default=0, help="Reuse extractions of ads " \
+        "stored by previous runs (of any newspaper, for wages) with the same extraction rules, " \
+        "and store this run's.")
+    parser.add_argument('--ad_store_path', type=str, default=None, help="Filepath to ad " \
+        "store (default: ad-store.sqlite in output directory).")
+    parser.add_argument('--shard_index', type=int, default=None, help="Shard of the batches " \
+        "to extract, every num_shards-th from this one (default: SLURM_ARRAY_TASK_ID).")
+    parser.add_argument('--num_shards', type=int, default=None, help="Number of shards " \
+        "(default: SLURM_ARRAY_TASK_COUNT, else 1).")
+    parser.add_argument('--instrument', type=int, default=0, help="Time stages (tokenize, " \
+        "fuzzy matching, parquet write, ...) in all workers, emitted after each batch.")
+    parser.add_argument('--instrument_path', type=str, default=None, help="Filepath to " \
+        "append stage timings to as JSON lines, or if ending in '.prom', to write running " \
+        "totals to as a Prometheus textfile (default: JSON lines in output_dir).")
+    parser.add_argument('--profile', type=int, default=0, help="Profile every so many " \
+        "batches (e.g. 1 for all, 10 for every tenth) with cProfile, into output_dir.")
     parser.add_argument('-a', '--aux_dir', type=str, help="Filepath to auxiliary directory.",
         default="/accounts/projects/pkline/newslabor/Documents/Newspaper_2023/" \
             "3_Data_processing/1-code/auxiliary_files")
+    parser.add_argument('--snapshot', type=str, default=None, help="Filepath to snapshot of " \
+        "helpers built by build-cache.py (default: 'helpers-snapshot.pkl' in aux_dir).")
     parser.add_argument('-o', '--output_dir', type=str, help="Filepath to output directory.",
         default="/accounts/projects/pkline/newslabor/Documents/Newspaper_2023/" \
             "3_Data_processing/4-output/7-geolocation/")
-    args = parser.parse_args()
+    return parser
+
+
+if __name__ == "__main__":
+    args = argument_parser().parse_args()
 
     assert os.path.isdir(args.aux_dir), 'Invalid filepath to auxilliary files.'
-    assert os.path.isfile(args.filepath), 'Invalid filepath to data CSV.'
+    assert os.path.isfile(args.filepath), 'Invalid filepath to data file.'
     assert os.path.isdir(args.output_dir), 'Invalid filepath to output directory.'
 
-    # Load data
-    sample = pd.read_csv(args.filepath, nrows=args.nrows, index_col=[0])
-    sample.raw_content = sample.raw_content.fillna('')
-    print("Will process sample of {} observations.".format(len(sample)))
-
     # Load Newspaper class with helper classes
-    paper = os.path.splitext(args.filepath)[0].split('/')[-1]
-    NEWSPAPER = Newspaper(
-        newspaper=paper,  
-        US_DATA=USGeoData(          # Load US data helper class
-            os.path.join(args.aux_dir, "states.csv"),
-            os.path.join(args.aux_dir, "simplemaps/uscities.csv"),
-            os.path.join(args.aux_dir, "neighbors-states.csv")
-        ),   
-        TEXT_HELP=TextWrapper(    # Load text helper class
-            os.path.join(args.aux_dir, "dictionary_list.txt")
-        )
-    )
+    paper = os.path.basename(args.filepath).split('.')[0].split('-')[0]
+    US_DATA, TEXT_HELP = load_helpers(args.aux_dir, args.snapshot)
+    NEWSPAPER = Newspaper(newspaper=paper, US_DATA=US_DATA, TEXT_HELP=TEXT_HELP)
+
+    # Preload memoized token matches and spelling corrections (inherited by pool workers)
+    memo_paths = {}
+    if args.token_memo: memo_paths[NEWSPAPER.US_DATA.TOKEN_MEMO] = \
+        args.token_memo_path or os.path.join(args.output_dir, 'token-memo.pkl')
+    if args.spell_memo: memo_paths[NEWSPAPER.TEXT_HELP.CORRECTIONS] = \
+        args.spell_memo_path or os.path.join(args.output_dir, 'spell-memo.pkl')
+    # Memos hold results of the helpers, so are only reused if these haven't changed since
+    memo_version = helpers_version(args.aux_dir)
+    for memo, memo_path in memo_paths.items(): memo.load(memo_path, memo_version)
+
+    # Stage timings, in pool workers too
+    if args.instrument: STAGE_TIMER.instrument(EXTRACT_STAGES)
+    shard_index, num_shards = array_shard(args.shard_index, args.num_shards)
 
     # Predict
-    print("Beginning extractions using {} processing ({} workers) at {}.".format(
-        'multi' if args.multiprocessing else 'serial', args.nworkers or 1, time_now()))
+    print("Beginning {}extractions using {} processing ({} workers){} at {}.".format(
+        'streamed ' if args.stream else '', 'multi' if args.multiprocessing else 'serial', 
+        args.nworkers or 1, ' for shard {} of {}'.format(shard_index, num_shards) if 
+            num_shards > 1 else '', time_now()))
     start_time = time.time()
-    args.batch_size = min(args.batch_size, len(sample))
-    if args.multiprocessing:
-        if args.extract_address:
-            print("Extracting addresses...")
-            sample['addresses'] = multiprocessing(NEWSPAPER.extract, sample.raw_content.to_list())
-        if args.extract_wage:
-            print("Extracting wages...")
-            wages = pd.DataFrame()
-            for batch_idx in range(ceil(len(sample) / args.batch_size)):
-                if args.skip >= (batch_idx+1)*args.batch_size: continue
-                wages_batch = pd.DataFrame(multiprocessing(NEWSPAPER.employer_info, 
-                    sample.raw_content.iloc[batch_idx*args.batch_size:(batch_idx+1)*args.batch_size].to_list(),
-                    max_workers=args.nworkers),
-                    index=sample.index[batch_idx*args.batch_size:(batch_idx+1)*args.batch_size])
-                wages = pd.concat([wages, wages_batch])
-                print("Processed ads {}-{} at {}...".format(
-                    batch_idx*args.batch_size,(batch_idx+1)*args.batch_size, time_now()))
-                wages_batch.to_parquet(add_filepath_suffix(args.output_dir, paper, 
-                    n=(batch_idx+1)*args.batch_size, suffix='extract-batch'), compression='gzip')
-            sample = sample.join(wages)
-    else:
-        if args.extract_address:
-            print("Extracting addresses...")
-            sample['addresses'] = sample.raw_content.apply(NEWSPAPER.extract)
-        if args.extract_wage:
-            print("Extracting wages...")
-            wages = pd.DataFrame()
-            for batch_idx in range(ceil(len(sample) / args.batch_size)):
-                if args.skip >= (batch_idx+1)*args.batch_size: continue
-                wages_batch = pd.DataFrame(sample.raw_content.iloc[
-                    batch_idx*args.batch_size:(batch_idx+1)*args.batch_size].apply(
-                        NEWSPAPER.employer_info).to_list(),
-                    index=sample.index[batch_idx*args.batch_size:(batch_idx+1)*args.batch_size])
-                wages = pd.concat([wages, wages_batch])
-                print("Processed ads {}-{} at {}...".format(
-                    batch_idx*args.batch_size,(batch_idx+1)*args.batch_size, time_now()))
-                wages_batch.to_parquet(add_filepath_suffix(args.output_dir, paper, 
-                    n=(batch_idx+1)*args.batch_size, suffix='extract-batch'), compression='gzip')
-            sample = sample.join(wages)
-    
-    sample.to_parquet(add_filepath_suffix(args.output_dir, paper, n=args.nrows), 
-        compression='gzip')
-    sample.to_csv(add_filepath_suffix(args.output_dir, paper, n=args.nrows, ext='csv'))
+    pool = newspaper_pool(NEWSPAPER, args.nworkers) if args.multiprocessing else None
+    # Extractions of repeated ads, by hash of their text, kept across runs for the same rules
+    # (one store per shard, as SQLite can't be shared by nodes over a network file system)
+    store = SQLiteCache(args.ad_store_path or os.path.join(args.output_dir, 
+        shard_suffix('ad-store', shard_index, num_shards) + '.sqlite')) if args.ad_store else None
+    dedup_counts = Counter()
+    extract_file(args, NEWSPAPER, pool, store, memo_paths, dedup_counts)
+    if pool: pool.shutdown()
+    if store: store.close()
+    if args.instrument:
+        print("Stage timings (seconds): {}.".format(', '.join('{}: {}'.format(stage, 
+            round(seconds, 1)) for stage, seconds in STAGE_TIMER.total_seconds.most_common())))
+    if dedup_counts['screened']:
+        print("Repeated ads: {} of {} screened ({}%), {} found in store, {} extracted.".format(
+            dedup_counts['repeats'], dedup_counts['screened'], 
+            round(100 * dedup_counts['repeats'] / dedup_counts['screened'], 1), 
+            dedup_counts['stored'], dedup_counts['extracted']))
+    print("Token memo:", NEWSPAPER.US_DATA.TOKEN_MEMO.stats())
+    print("Spelling memo:", NEWSPAPER.TEXT_HELP.CORRECTIONS.stats())
+
     elapsed = time.time() - start_time
     print("Completed extractions at {} in {} minutes ({} seconds).".format(
         time_now(), round(elapsed / 60, 2), round(elapsed)))
-
-
-
@@ -1,13 +1,97 @@
 import argparse
+import json
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
-from common import add_filepath_suffix
+from glob import glob
+from common import Manifest, ParquetStreamWriter, ADDRESS_TYPE, add_filepath_suffix, \
+    batch_types, concat_parquet, csv_dtypes, read_batches
+
+class TemplateRows(object):
+    ''' Template data read in chunks, handed out a given number of rows at a time. '''
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = None
+
+    def take(self, n:int):
+        parts = []
+        while n:
+            if self.chunk is None or not len(self.chunk):
+                self.chunk = next(self.chunks, None)
+                if self.chunk is None: break
+            parts.append(self.chunk.iloc[:n])
+            self.chunk, n = self.chunk.iloc[n:], n - len(parts[-1])
+        return pd.concat(parts) if len(parts) > 1 else (parts[0] if parts else None)
+
+def template_nrows(filepath:str, batch_size:int, nrows:int=None):
+    ''' Rows of the template (at most nrows): of parquet from its metadata, and of CSV 
+    counted in chunks of its first (index) column only, so no other columns are parsed. '''
+    if not filepath.endswith('.csv'):
+        total = pq.ParquetFile(filepath).metadata.num_rows
+        return total if nrows is None else min(total, nrows)
+    return sum(len(chunk) for chunk in pd.read_csv(filepath, nrows=nrows, usecols=[0], 
+        chunksize=batch_size))
+
+def merge_stream(files:list, nrows:int, output_filepath:str, batch_nrows:list=None, 
+        template_batch_size:int=None):
+    ''' Join the template to the batches one batch (of at most batch_size rows) at a 
+    time, written to output_filepath as they go, so memory is bounded by the batch size.
+    The batches must continue each other and together cover the template exactly.
+    '''
+    for file, expected in zip(files, batch_nrows or [None] * len(files)):
+        assert expected is None or pq.ParquetFile(file).metadata.num_rows == expected, \
+            "Batch '{}' has {} rows, not {} as recorded.".format(file, 
+                pq.ParquetFile(file).metadata.num_rows, expected)
+    total = sum(pq.ParquetFile(file).metadata.num_rows for file in files)
+    print("Merging {} batches of {} rows.".format(len(files), total))
+
+    # Columns of CSV templates typed the same in all chunks, as by extract.py (in chunks 
+    # of the run's batch size if given, so as to type them as in its streamed output)
+    template_batch_size = template_batch_size or args.batch_size
+    dtypes = csv_dtypes(args.filepath, template_batch_size, nrows, args.cols) \
+        if args.filepath.endswith('.csv') else None
+    template = TemplateRows(read_batches(args.filepath, template_batch_size, nrows=nrows, 
+        columns=args.cols, dtypes=dtypes))
+    if args.skip: template.take(args.skip)
+    types = batch_types(files, {'addresses':ADDRESS_TYPE})
+    with ParquetStreamWriter(output_filepath, types=types) as writer:
+        for file in files:
+            for batch in read_batches(file, args.batch_size):
+                sample = template.take(len(batch))
+                assert sample is not None and len(sample) == len(batch), "Template has " \
+                    "fewer rows than the batches ({} merged).".format(writer.nrows)
+                assert sample.index.equals(batch.index), "Batch '{}' doesn't continue the " \
+                    "previous ones, its rows {}... aren't the template's {}...".format(file, 
+                        list(batch.index[:3]), list(sample.index[:3]))
+                if 'raw_content' in sample: sample.raw_content = sample.raw_content.fillna('')
+                writer.write(sample.join(batch))
+            print("After batch {}, have merged {} rows.".format(file, writer.nrows))
+    assert template.take(1) is None, "Template has more rows than the batches."
+    return writer.nrows
 
 def main():
     ''' Concatenate and join batched extractions. '''
 
     # Load data
     nrows = args.batch_size * args.nbatches if args.nbatches else None
+    newspaper = os.path.basename(args.filepath).split('.')[0].split('-')[0]
+    if args.stream:
+        files, batch_nrows, manifests, params = batch_files(newspaper, nrows)
+        n = sum(pq.ParquetFile(file).metadata.num_rows for file in files)
+        output_filepath = add_filepath_suffix(args.output_dir, newspaper, n=n,
+            suffix='{}-merged'.format(args.suffix))
+        if params.get('stream'):
+            # Batches of streamed extractions already have the template's columns
+            nrows_left = template_nrows(args.filepath, args.batch_size, nrows) - args.skip
+            assert n == nrows_left, "Template has {} rows, not {} as the batches.".format(
+                nrows_left, n)
+            concat_parquet(files, output_filepath, 
+                types=batch_types(files, {'addresses':ADDRESS_TYPE}))
+        else:
+            merge_stream(files, nrows, output_filepath, batch_nrows, params.get('batch_size'))
+        delete(files, manifests)
+        return
 
     if args.filepath.endswith('.gzip'):
         sample = pd.read_parquet(args.filepath, columns=args.cols)
@@ -20,23 +104,19 @@ def main():
         sample = sample.iloc[args.skip:]
     print("Loaded template data of {} rows.".format(len(sample)))
 
-    newspaper = args.filepath.split('/')[-1].split('-')[0]
+    files, _, manifests, params = batch_files(newspaper, len(sample))
 
     # Concatenate extraction batches
-    full_extractions = pd.DataFrame()
-    nbatches = args.nbatches or (len(sample) // args.batch_size + 1)
-    print("Iterating over {} batches.".format(nbatches))
-    for batch_idx in range(nbatches):
-        batch = args.batch_size * (batch_idx + 1) + args.skip
-        file = os.path.join(args.batch_dir, '-'.join([newspaper, args.suffix, 'batch', str(batch)]) + '.gzip')
-        if not os.path.isfile(file): 
-            print("File not found: '{}'".format(file))
-            break
-        full_extractions = pd.concat([full_extractions, pd.read_parquet(file)])
-        print("After batch {}, have extractions of shape {}.".format(file, full_extractions.shape))
+    full_extractions = []
+    for file in files:
+        full_extractions.append(pd.read_parquet(file))
+        print("After batch {}, have extractions of {} rows.".format(
+            file, sum(len(batch) for batch in full_extractions)))
+    full_extractions = pd.concat(full_extractions)
 
     assert len(full_extractions) == len(sample)
-    sample = sample.join(full_extractions)
+    # Batches of streamed extractions already have the template's columns
+    sample = full_extractions if params.get('stream') else sample.join(full_extractions)
 
     # Write full data to file
     # sample.to_csv(add_filepath_suffix(args.output_dir, newspaper, n=len(sample), suffix='extract-wage', ext='csv'))        
@@ -44,15 +124,70 @@ def main():
     sample.to_parquet(add_filepath_suffix(args.output_dir, newspaper, n=len(sample), 
         suffix='{}-merged'.format(args.suffix)), compression='gzip')
 
-    if args.delete:
-        for batch_idx in range(nbatches):
+    delete(files, manifests)
+
+def run_manifests(newspaper:str):
+    ''' Manifests in batch_dir of the run (or the shards of the run) on the template, 
+    and of --num_shards shards if given, leaving out those of other runs (e.g. earlier 
+    ones of other nrows or batch_size), which must not be combined with it. '''
+    runs = {}
+    found = sorted(glob(os.path.join(args.batch_dir, 
+        '{}-{}-manifest-*.json'.format(newspaper, args.suffix))))
+    for filepath in found:
+        with open(filepath) as f:
+            params = json.load(f)['params']
+        if params.get('filepath') != os.path.abspath(args.filepath) or \
+                (args.num_shards and params.get('num_shards', 1) != args.num_shards):
+            print("Leaving out manifest '{}' of another run.".format(filepath))
+            continue
+        run = json.dumps({key: value for key, value in params.items() if key != 'shard_index'}, 
+            sort_keys=True)
+        runs.setdefault(run, []).append(filepath)
+    assert len(runs) <= 1, "Manifests of {} runs on '{}' found, choose one with --manifest: " \
+        "{}.".format(len(runs), args.filepath, '; '.join(', '.join(filepaths) 
+            for filepaths in runs.values()))
+    assert runs or not found, "Manifests {} are all of other runs, give this run's with " \
+        "--manifest.".format(found)
+    return next(iter(runs.values()), [])
+
+def batch_files(newspaper:str, nrows:int=None):
+    ''' Batch files, from the run's manifest if there is one, or its shards' manifests if 
+    it was sharded (along with their recorded row counts), otherwise by filename, and the 
+    manifests found with the run's parameters. '''
+    manifests = args.manifest or run_manifests(newspaper)
+    params = {}
+    if manifests:
+        manifest = Manifest.combine(manifests, args.num_shards)
+        files, batch_nrows = manifest.paths(), [batch['nrows'] for batch in manifest.batches]
+        params = manifest.params
+        assert not manifest.batches or manifest.batches[0]['start'] == args.skip, "Rows " \
+            "{}-{} missing from manifests.".format(args.skip, manifest.batches[0]['start'])
+        print("Have {} batches of {} rows from {} manifest(s).".format(len(files), 
+            manifest.nrows, len(manifests)))
+    else:
+        files, batch_nrows = [], None
+        nbatches = args.nbatches or (nrows // args.batch_size + 1 if nrows else None)
+        print("Iterating over {} batches.".format(nbatches or 'all'))
+        batch_idx = 0
+        while nbatches is None or batch_idx < nbatches:
             batch = args.batch_size * (batch_idx + 1) + args.skip
             file = os.path.join(args.batch_dir, '-'.join([newspaper, args.suffix, 'batch', str(batch)]) + '.gzip')
             if not os.path.isfile(file): 
+                print("File not found: '{}'".format(file))
                 break
+            files.append(file)
+            batch_idx += 1
+    assert files, "No batches of '{}' found in '{}'.".format(args.suffix, args.batch_dir)
+    return files, batch_nrows, manifests, params
+
+def delete(files:list, manifests:list):
+    if args.delete:
+        for file in files:
             os.remove(file)
             print("Removed batch {}.".format(file))
-
+        for manifest in manifests:
+            os.remove(manifest)
+            print("Removed manifest {}.".format(manifest))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -62,7 +197,14 @@ if __name__ == "__main__":
             "3_Data_processing/4-output/7-geolocation/")
     parser.add_argument('-n', '--nbatches', type=int, default=None, help="Limit size.")
     parser.add_argument('-s', '--suffix', type=str, default='resolve', help="Batches of what.")
+    parser.add_argument('--manifest', action='append', default=None, help="Filepath to run " \
+        "manifest, or to each of its shards' (default: '<newspaper>-<suffix>-manifest-*.json' " \
+        "in batch_dir of the run on filepath, if any).")
+    parser.add_argument('--num_shards', type=int, default=None, help="Number of shards the " \
+        "run was split into, all of which must be there (default: as in the manifests).")
     parser.add_argument('-b', '--batch_size', type=int, default=10000, help="Batch size.")
+    parser.add_argument('--stream', type=int, default=0, help="Join the template to the " \
+        "batches and write them one batch at a time, so memory stays bounded by batch size.")
     parser.add_argument('--cols', action='append', default=None, help="Columns to read from batch.")
     parser.add_argument('-d', '--delete', type=int, default=1, help="Delete batches.")
     parser.add_argument('--skip', type=int, default=0)
@@ -0,0 +1,346 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import numpy as np
+import pandas as pd
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from common import load_helpers, time_now
+
+
+class AnswerTable(object):
+    ''' Deterministic answers to geocoding queries (as format_str_address), from the cities
+    of uscities.csv: the city (and state) or zipcode named in the query, else one picked
+    by hash of the query, at a lower confidence, as a real geocoder's best guess would be.
+    '''
+    def __init__(self, cities_fp:str):
+        cities = pd.read_csv(cities_fp, usecols=['city','state_id','state_name','county_name',
+            'lat','lng','population','zips'], dtype={'zips':str})
+        # Most populous first, so that it is the answer to ambiguous city names
+        cities = cities.sort_values('population', ascending=False, kind='stable')
+        self.rows = list(cities.itertuples(index=False))
+        self.by_city_state, self.by_city, self.by_state, self.by_zipcode = {}, {}, {}, {}
+        for row in self.rows:
+            self.by_city_state.setdefault((row.city.lower(), row.state_name.lower()), row)
+            self.by_city.setdefault(row.city.lower(), row)
+            self.by_state.setdefault(row.state_name.lower(), []).append(row)
+            for zipcode in str(row.zips).split():
+                self.by_zipcode.setdefault(zipcode, row)
+        print("Loaded answer table of {} cities and {} zipcodes.".format(len(self.rows),
+            len(self.by_zipcode)))
+
+    def answer(self, query:str):
+        ''' Address fields, coordinates, result type and confidence of the answer to query. '''
+        digest = int(hashlib.sha1(query.encode()).hexdigest(), 16)
+        # Queries are '[[number] street, ][city, ][state, ][zipcode, ]USA'
+        parts = [part.strip() for part in query.split(',') if part.strip() and 
+            part.strip().upper() not in {'USA', 'US'}]
+        zipcode = next((part for part in parts if part.isdigit() and len(part) == 5), None)
+        state = next((part.lower() for part in parts if part.lower() in self.by_state), None)
+        cities = [part.lower() for part in parts if part.lower() in self.by_city and 
+            part.lower() != state]
+        street = parts[0] if parts and parts[0] != zipcode and parts[0].lower() != state and \
+            parts[0].lower() not in cities else None
+        if cities and (cities[0], state) in self.by_city_state:
+            row, confidence = self.by_city_state[(cities[0], state)], 0.95
+        elif cities and not state:
+            row, confidence = self.by_city[cities[0]], 0.9
+        elif zipcode in self.by_zipcode:
+            row, confidence = self.by_zipcode[zipcode], 0.85
+        elif state:
+            # Somewhere among the state's biggest cities
+            biggest = self.by_state[state][:20]
+            row, confidence = biggest[digest % len(biggest)], 0.7 if street else 0.6
+        else:
+            row, confidence = self.rows[digest % len(self.rows)], 0.3
+        known_zipcode = zipcode in self.by_zipcode
+        if zipcode is None or zipcode not in str(row.zips).split():
+            zipcodes = str(row.zips).split()
+            zipcode = zipcodes[digest % len(zipcodes)] if zipcodes else None
+        housenumber = None
+        if street and street.split()[0].isdigit():
+            housenumber, street = street.split()[0], ' '.join(street.split()[1:]) or None
+        # Jitter, so that confidences aren't all tied
+        confidence = round(confidence - (digest % 100) / 1000, 3)
+        result_type = 'building' if housenumber else 'street' if street else 'city' if cities \
+            else 'postcode' if known_zipcode else 'state' if state else 'unknown'
+        fields = {'housenumber':housenumber, 'street':street, 'city':row.city,
+            'county':'{} County'.format(row.county_name), 'state':row.state_name,
+            'state_code':row.state_id, 'postcode':zipcode}
+        # Streets are somewhere in their city
+        lat = round(row.lat + ((digest >> 8) % 2000 - 1000) / 1e5, 6)
+        lon = round(row.lng + ((digest >> 20) % 2000 - 1000) / 1e5, 6)
+        return fields, lat, lon, result_type, confidence
+
+    def formatted(self, fields:dict):
+        street = ' '.join(field for field in [fields['housenumber'], fields['street']] if field)
+        return ', '.join(field for field in [street, fields['city'], '{} {}'.format(
+            fields['state_code'], fields['postcode'] or '').strip(), 'United States of America']
+                if field)
+
+    def geoapify(self, query:str):
+        ''' GeoApify /v1/geocode/search response (GeoJSON features). '''
+        fields, lat, lon, result_type, confidence = self.answer(query)
+        properties = {key: value for key, value in fields.items() if value}
+        properties.update({'country':'United States', 'country_code':'us', 'lat':lat,
+            'lon':lon, 'formatted':self.formatted(fields), 'result_type':result_type,
+            'rank':{'confidence':confidence, 'match_type':'full_match' if confidence > 0.5
+                else 'inner_part'}})
+        return {'type':'FeatureCollection', 'features':[{'type':'Feature',
+            'properties':properties, 'geometry':{'type':'Point', 'coordinates':[lon, lat]}}],
+            'query':{'text':query}}
+
+    def nominatum(self, query:str):
+        ''' Nominatim /search response (format=jsonv2, addressdetails=1). '''
+        fields, lat, lon, result_type, confidence = self.answer(query)
+        address = {'house_number':fields['housenumber'], 'road':fields['street'],
+            'city':fields['city'], 'county':fields['county'], 'state':fields['state'],
+            'postcode':fields['postcode'], 'country':'United States', 'country_code':'us'}
+        return [{'place_id':int(hashlib.sha1(query.encode()).hexdigest()[:8], 16),
+            'lat':str(lat), 'lon':str(lon), 'category':'place', 'type':result_type,
+            'importance':confidence, 'display_name':self.formatted(fields),
+            'address':{key: value for key, value in address.items() if value}}]
+
+
+def parse_latency(spec:str):
+    ''' Sampler of response latencies (seconds) from e.g. 'fixed:0.1', 'uniform:0.05,0.3',
+    'exponential:0.2' (mean) or 'lognormal:0.2,0.5' (median and sigma). '''
+    name, _, params = spec.partition(':')
+    params = [float(param) for param in params.split(',') if param]
+    samplers = {
+        'fixed': lambda rng: params[0],
+        'uniform': lambda rng: rng.uniform(params[0], params[1]),
+        'exponential': lambda rng: rng.expovariate(1 / params[0]),
+        'lognormal': lambda rng: params[0] * np.exp(params[1] * rng.gauss(0, 1)),
+    }
+    assert name in samplers, "Unknown latency distribution '{}'.".format(name)
+    return samplers[name]
+
+def parse_errors(spec:str):
+    ''' Probability of each injected error, from e.g. '429:0.02,500:0.01,timeout:0.005'. '''
+    errors = {}
+    for error in filter(None, spec.split(',')):
+        kind, probability = error.split(':')
+        errors[kind if kind == 'timeout' else int(kind)] = float(probability)
+    assert sum(errors.values()) <= 1, 'Error probabilities add up to more than 1.'
+    return errors
+
+
+class MockGeocoder(BaseHTTPRequestHandler):
+    ''' Serves GeoApify (/v1/geocode/search) and Nominatim (/search) requests from the
+    answer table, after a sampled latency, failing some as rate limited (429), with a
+    server error (5xx) or by not answering before the client times out. Served
+    requests are counted by status at /stats. '''
+    protocol_version = 'HTTP/1.1'   # keep-alive, as the real providers
+    table, latency, errors = None, None, {}
+    timeout_seconds, retry_after = 30, 1
+    rng, lock, counts = random.Random(0), threading.Lock(), Counter()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if url.path == '/stats':
+            return self.respond(200, dict(self.counts))
+        if url.path not in ('/v1/geocode/search', '/search'):
+            return self.respond(404, {'error':'Not Found'})
+        with self.lock:
+            delay, draw = self.latency(self.rng), self.rng.random()
+        error = None
+        for kind, probability in self.errors.items():
+            if draw < probability:
+                error = kind
+                break
+            draw -= probability
+        if error == 'timeout':
+            self.count('timeout')
+            time.sleep(self.timeout_seconds)
+            return self.respond(504, {'error':'Gateway Timeout'})
+        time.sleep(delay)
+        if error:
+            self.count(error)
+            return self.respond(error, {'error':'Too Many Requests' if error == 429 else
+                'Server Error'}, headers={'Retry-After':str(self.retry_after)}
+                    if error == 429 else {})
+        query = (params.get('text') or params.get('q') or [''])[0]
+        self.count(200)
+        self.respond(200, self.table.geoapify(query) if url.path == '/v1/geocode/search'
+            else self.table.nominatum(query))
+
+    def count(self, status):
+        with self.lock:
+            self.counts[str(status)] += 1
+
+    def respond(self, status:int, content, headers:dict=None):
+        body = json.dumps(content).encode()
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for header, value in (headers or {}).items(): self.send_header(header, value)
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass   # client gave up (e.g. timed out)
+
+    def log_message(self, *args):
+        pass
+
+def serve():
+    MockGeocoder.table = AnswerTable(os.path.join(args.aux_dir, 'simplemaps/uscities.csv'))
+    MockGeocoder.latency = staticmethod(parse_latency(args.latency))
+    MockGeocoder.errors = parse_errors(args.errors)
+    MockGeocoder.timeout_seconds, MockGeocoder.retry_after = args.timeout_seconds, args.retry_after
+    MockGeocoder.rng = random.Random(args.seed)
+    server = ThreadingHTTPServer((args.host, args.port), MockGeocoder)
+    server.daemon_threads = True
+    print("Serving mock geocoder at http://{}:{} ({} latency, errors {}) from {}.".format(
+        args.host, args.port, args.latency, args.errors or 'none', time_now()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Served: {}.".format(dict(MockGeocoder.counts)))
+
+
+def load_queries(US_DATA:object, n:int, seed:int=0):
+    ''' Queries to load the geocoder with: those of the addresses of an extract output,
+    or else made up from the newspaper's nearby cities, of all kinds of candidates. '''
+    if args.filepath:
+        import pyarrow.parquet as pq
+        from resolve import address_queries
+        queries = address_queries(pq.read_table(args.filepath, columns=['addresses']).column(
+            'addresses')).flatten().to_pylist()
+        return queries[:n]
+    rng = random.Random(seed)
+    cities = list(US_DATA.biggest_nearby_cities)
+    streets = ['Church St', 'Main St', 'Granby St', 'Brambleton Ave', 'Colley Ave',
+        'Princess Anne Rd', 'Boush St', 'Monticello Ave']
+    queries = []
+    for i in range(n):
+        city = rng.choice(cities)
+        row = US_DATA.city_rows(city)[0] if US_DATA.city_rows(city) else None
+        state = row.state_name if row else US_DATA.state_name
+        kind = i % 4
+        if kind == 0: queries.append('{} {}, {}, {}, USA'.format(rng.randint(1, 2999),
+            rng.choice(streets), city, state))
+        elif kind == 1: queries.append('{}, {}, USA'.format(rng.choice(streets), state))
+        elif kind == 2: queries.append('{}, {}, USA'.format(city, state))
+        else: queries.append('{}, USA'.format(rng.choice(row.zips.split()) if row else '23501'))
+    return queries
+
+def percentiles(values:list):
+    values = [value for value in values if value is not None]
+    if not values: return {}
+    return {'p{}'.format(p): round(float(np.percentile(values, p)), 3) for p in (50, 95, 99)}
+
+def load():
+    ''' Drive resolve_queries() (threads) or the asynchronous requests (event loop) of resolve.py
+    at a fixed rate against the geocoder at --url, and report achieved throughput,
+    statuses and latencies. '''
+    import resolve
+    os.environ['GEOAPIFY_URL'] = os.environ['NOMINATUM_URL'] = args.url.rstrip('/')
+    os.environ.setdefault('GEOAPIFY_API_KEY', 'mock')
+    US_DATA = load_helpers(args.aux_dir, args.snapshot, text_help=False)[0].load(args.newspaper)
+    queries = load_queries(US_DATA, args.nrequests, args.seed)
+    nominatum, geoapify = args.provider == 'nominatum', args.provider == 'geoapify'
+    print("Sending {} {} queries at {} per second ({}) at {}.".format(len(queries),
+        args.provider, args.qps, 'asynchronous, {} concurrent'.format(args.concurrency)
+            if args.asynchronous else '{} threads'.format(args.nworkers), time_now()))
+
+    start_time = time.perf_counter()
+    if args.asynchronous:
+        # One event loop, rate limited (and retrying) as resolve.py --asynchronous
+        results = asyncio.run(resolve._request_async([(args.provider, query) for query in
+            queries], US_DATA, concurrency=args.concurrency, rates={args.provider:args.qps},
+            timeout=args.timeout, retries=args.retries))
+        logs = [log for _, _, _, log in results]
+        lateness, sent = [], None
+    else:
+        # Open loop: the i-th query is due at i / qps, however long earlier ones take
+        def call(i, query):
+            due = start_time + i / args.qps
+            time.sleep(max(0, due - time.perf_counter()))
+            started = time.perf_counter()
+            output = resolve.resolve_queries([query], US_DATA, nominatum=nominatum, 
+                geoapify=geoapify)
+            return output['nom_requests' if nominatum else 'geo_requests'][0], \
+                started - due, started - start_time
+        with ThreadPoolExecutor(args.nworkers) as ex:
+            calls = list(ex.map(call, range(len(queries)), queries))
+        logs = [log for log, _, _ in calls]
+        lateness = [late for _, late, _ in calls]
+        # Rate at which requests went out, i.e. whether the threads kept up with qps
+        sent = len(calls) / max(started for _, _, started in calls) if len(calls) > 1 else None
+    elapsed = time.perf_counter() - start_time
+
+    statuses = Counter(str(log.get('status_code')) for log in logs)
+    report = {'provider':args.provider, 'asynchronous':args.asynchronous,
+        'nworkers':None if args.asynchronous else args.nworkers,
+        'concurrency':args.concurrency if args.asynchronous else None, 'target_qps':args.qps,
+        'queries':len(queries), 'seconds':round(elapsed, 2),
+        'sent_qps':round(sent, 1) if sent else None,
+        'completed_qps':round(len(queries) / elapsed, 1), 'statuses':dict(statuses),
+        'success_rate':round(statuses['200'] / max(len(logs), 1), 4),
+        'retried':sum(log.get('attempts', 1) > 1 for log in logs),
+        'request_seconds':percentiles([log.get('elapsed') for log in logs]),
+        'behind_schedule_seconds':percentiles(lateness)}
+    print(json.dumps(report, indent=1))
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(report) + '\n')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode', choices=['serve', 'load'], help="Serve mock geocoding " \
+        "requests, or load a (mock) geocoder with requests as resolve.py makes them.")
+    parser.add_argument('-a', '--aux_dir', type=str, help="Filepath to auxiliary files.",
+        default="/accounts/projects/pkline/newslabor/Documents/Newspaper_2023/" \
+            "3_Data_processing/1-code/auxiliary_files")
+    parser.add_argument('--seed', type=int, default=0)
+    # serve
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=8080)
+    parser.add_argument('--latency', type=str, default='lognormal:0.15,0.5', help="Response " \
+        "latency distribution (seconds): 'fixed:<s>', 'uniform:<min>,<max>', " \
+        "'exponential:<mean>' or 'lognormal:<median>,<sigma>'.")
+    parser.add_argument('--errors', type=str, default='', help="Probabilities of injected " \
+        "errors, e.g. '429:0.02,500:0.01,503:0.01,timeout:0.005'.")
+    parser.add_argument('--timeout_seconds', type=float, default=30, help="How long requests " \
+        "failed by timeout hang for.")
+    parser.add_argument('--retry_after', type=int, default=1, help="Retry-After (seconds) of " \
+        "rate-limited responses.")
+    # load
+    parser.add_argument('-u', '--url', type=str, default='http://127.0.0.1:8080',
+        help="Geocoder URL to load, for both providers.")
+    parser.add_argument('--provider', type=str, default='geoapify',
+        choices=['geoapify', 'nominatum'])
+    parser.add_argument('--newspaper', type=str, default='NJG', help="Newspaper whose " \
+        "nearby cities answers are checked against (and queries made up from).")
+    parser.add_argument('--filepath', type=str, default=None, help="Filepath to extract " \
+        "output whose addresses to query (default: made up from the nearby cities).")
+    parser.add_argument('-n', '--nrequests', type=int, default=1000)
+    parser.add_argument('--qps', type=float, default=20, help="Requests per second to send.")
+    parser.add_argument('-w', '--nworkers', type=int, default=20, help="Threads, each calling " \
+        "resolve_queries() for one query at a time.")
+    parser.add_argument('--asynchronous', type=int, default=0, help="Request from one event " \
+        "loop, as resolve.py --asynchronous, instead of threads.")
+    parser.add_argument('--concurrency', type=int, default=100,
+        help="Maximum requests in flight when asynchronous.")
+    parser.add_argument('--retries', type=int, default=4,
+        help="Retries of rate-limited, failed or timed out requests when asynchronous.")
+    parser.add_argument('--timeout', type=float, default=10, help="Request timeout (seconds) " \
+        "when asynchronous (threads use resolve.py's).")
+    parser.add_argument('--snapshot', type=str, default=None, help="Filepath to snapshot of " \
+        "helpers built by build-cache.py (default: 'helpers-snapshot.pkl' in aux_dir).")
+    parser.add_argument('-o', '--output', type=str, default=None, help="Filepath to JSON " \
+        "lines file to append the load report to.")
+    args = parser.parse_args()
+
+    assert os.path.isdir(args.aux_dir), 'Invalid filepath to auxilliary files.'
+    serve() if args.mode == 'serve' else load()
@@ -1,21 +1,34 @@
 from concurrent.futures import ThreadPoolExecutor
 import requests
 from requests.exceptions import RequestException, ReadTimeout
+import aiohttp
+import asyncio
+import threading
+import random
 from statistics import mode
 from math import ceil
 import argparse
+import hashlib
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import os
 import time
-import numpy as np
-from ast import literal_eval
-from common import USGeoData, add_filepath_suffix, time_now
+from common import Manifest, SQLiteCache, USGeoData, ADDRESS_TYPE, STAGE_TIMER, \
+    add_filepath_suffix, array_shard, combine_profiles, helpers_version, in_shard, \
+    load_helpers, profiled, shard_suffix, time_now, write_parquet
 
 
+# One keep-alive session per thread, rather than a new connection per request
+SESSIONS = threading.local()
+
 def get_wrapper(url, timeout=10):
     output = {'url':url, 'elapsed':None, 'content':{}, 'message':""}
+    if not hasattr(SESSIONS, 'session'): 
+        SESSIONS.session = requests.Session()
     try:
-        resp = requests.get(url, timeout=timeout)
+        resp = SESSIONS.session.get(url, timeout=timeout)
         output['content'] = resp.json()
     except ReadTimeout as err:
         output['message'] = str(err) or ""
@@ -33,11 +46,14 @@ def get_wrapper(url, timeout=10):
             output['elapsed'] = resp.elapsed.total_seconds()
         except:
             pass
+        STAGE_TIMER.add('http_{}'.format(output['status_code']), output['elapsed'] or 0)
     return output
 
-def nominatum_request(query, biggest_nearby_cities, timeout=10):
-    url = "https://nominatim.openstreetmap.org/search?addressdetails=1&q={}&format=jsonv2".format(query)
-    response = get_wrapper(url, timeout=timeout)
+def nominatum_url(query):
+    return os.environ.get('NOMINATUM_URL', "https://nominatim.openstreetmap.org") + \
+        "/search?addressdetails=1&q={}&format=jsonv2".format(query)
+
+def parse_nominatum(response, biggest_nearby_cities):
     assert isinstance(response, dict)
     counties, zipcodes, address = [], [], None
     if response.get('status_code') == 200:
@@ -54,10 +70,14 @@ def nominatum_request(query, biggest_nearby_cities, timeout=10):
                 address = verified['display_name']
     return address, mode(counties or [None]), mode(zipcodes or [None]), response
 
-def geoapify_request(query, biggest_nearby_cities, timeout=10):
-    url = os.environ['GEOAPIFY_URL'] + "/v1/geocode/search?text={}&apiKey={}".format(
+def nominatum_request(query, biggest_nearby_cities, timeout=10):
+    return parse_nominatum(get_wrapper(nominatum_url(query), timeout=timeout), biggest_nearby_cities)
+
+def geoapify_url(query):
+    return os.environ['GEOAPIFY_URL'] + "/v1/geocode/search?text={}&apiKey={}".format(
         query, os.environ['GEOAPIFY_API_KEY'])
-    response = get_wrapper(url, timeout=timeout)
+
+def parse_geoapify(response, biggest_nearby_cities):
     assert isinstance(response, dict)
     best_county, best_zipcode, address, best_conf = None, None, None, 0
     if response.get('status_code') == 200:
@@ -75,6 +95,15 @@ def geoapify_request(query, biggest_nearby_cities, timeout=10):
                 address = verified['properties']['formatted']
     return address, best_county, best_zipcode, response
 
+def geoapify_request(query, biggest_nearby_cities, timeout=10):
+    return parse_geoapify(get_wrapper(geoapify_url(query), timeout=timeout), biggest_nearby_cities)
+
+# Per provider: synchronous request, URL builder and response parser
+PROVIDERS = {
+    'nominatum': (nominatum_request, nominatum_url, parse_nominatum),
+    'geoapify': (geoapify_request, geoapify_url, parse_geoapify),
+}
+
 def format_str_address(address_fields:dict):
     assert isinstance(address_fields, dict)
     addr_str = ''
@@ -89,9 +118,99 @@ def format_str_address(address_fields:dict):
     addr_str += ', USA'
     return addr_str
 
-def resolve(address_dicts_list:list, US_DATA:object, nominatum=False, geoapify=True, verbose=False):
+def combine_chunks(addresses):
+    if not isinstance(addresses, pa.ChunkedArray): return addresses
+    return addresses.combine_chunks() if addresses.num_chunks else pa.array([], addresses.type)
+
+def address_queries(addresses):
+    ''' Queries of candidate addresses (as format_str_address), per ad, computed in
+    Arrow from the (list<struct>) addresses column, without building address dicts. '''
+    addresses = combine_chunks(addresses)
+    candidates = addresses.flatten()
+    fields = dict(zip([field.name for field in candidates.type], candidates.flatten()))
+    def field(name:str):
+        # Missing fields are empty, as are nulls
+        if name not in fields: return pa.array([''] * len(candidates), pa.string())
+        return fields[name].cast(pa.string()).fill_null('')
+    def has(values): 
+        return pc.not_equal(values, '')
+    number, street = field('housenumber'), field('street')
+    queries = pc.if_else(has(street), pc.if_else(has(number), 
+        pc.binary_join_element_wise(number, street, ' '), street), '')
+    for name in ['city', 'state', 'zipcode']:
+        values = field(name)
+        queries = pc.if_else(has(values), pc.if_else(has(queries), 
+            pc.binary_join_element_wise(queries, values, ', '), values), queries)
+    queries = pc.binary_join_element_wise(queries, ', USA', '')
+    offsets = addresses.offsets
+    return pa.ListArray.from_arrays(pc.subtract(offsets, offsets[0]), queries)
+
+def normalize_query(query:str):
+    return ' '.join(query.lower().split())
+
+def cache_get(cache, provider:str, query:str, US_DATA:object):
+    ''' Cached result of query, keyed per provider and home state, since parsing
+    depends on the newspaper's nearby cities. '''
+    if not cache: return None
+    cached = cache.get('{}_request/{}'.format(provider, US_DATA.state_id), normalize_query(query))
+    if cached is None: return None
+    address, county, zipcode, log = cached
+    return address, county, zipcode, dict(log, cached=True)
+
+def cache_set(cache, provider:str, query:str, US_DATA:object, result:tuple, cache_responses=True):
+    ''' Cache parsed result of query if request was successful. '''
+    address, county, zipcode, log = result
+    if not cache or log.get('status_code') != 200: return
+    cache.set('{}_request/{}'.format(provider, US_DATA.state_id), normalize_query(query), 
+        (address, county, zipcode, log if cache_responses else 
+            {'url':log['url'], 'status_code':log['status_code']}))
+
+class Throttle(object):
+    ''' Rate limiter spacing requests at least `interval` seconds apart across all the 
+    threads sharing it. '''
+    def __init__(self, interval:float):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = max(0, self.next - now)
+            self.next = max(now, self.next) + self.interval
+        time.sleep(delay)
+
+# Nominatim allows 1 request per second in all, however many threads make them
+NOMINATUM_THROTTLE = Throttle(1)
+
+def cached_request(provider:str, query:str, US_DATA:object, cache=None, cache_responses=True, 
+        throttle:Throttle=None):
+    ''' Look up query in the cache, or else request it (once throttle allows) and
+    cache the parsed result if successful.
+    '''
+    result = cache_get(cache, provider, query, US_DATA)
+    if result: return result
+    if throttle: throttle.wait()
+    result = PROVIDERS[provider][0](query, US_DATA.biggest_nearby_cities)
+    cache_set(cache, provider, query, US_DATA, result, cache_responses=cache_responses)
+    return result
+
+def resolve(address_dicts_list:list, US_DATA:object, nominatum=False, geoapify=True, 
+        verbose=False, cache=None, cache_responses=True):
+    ''' Resolve an ad's candidate addresses (as extracted) to its county. '''
+    return resolve_queries([format_str_address(addr) for addr in address_dicts_list], US_DATA, 
+        nominatum=nominatum, geoapify=geoapify, verbose=verbose, cache=cache, 
+        cache_responses=cache_responses)
+
+def resolve_queries(queries:list, US_DATA:object, nominatum=False, geoapify=True, 
+        verbose=False, cache=None, cache_responses=True, results:dict=None):
+    ''' Resolve an ad's candidate addresses (as queries, see format_str_address) to its 
+    county. Queries found in results, i.e. {(provider, normalized query): request output}, 
+    are not requested again.
+    '''
     st_time = time.time()
     output = {}
+    results = results or {}
 
     if nominatum:
         nom_counties, nom_zipcodes, nom_addresses, nom_logs, nom_time = [], [], [], [], 0
@@ -99,14 +218,13 @@ def resolve(address_dicts_list:list, US_DATA:object, nominatum=False, geoapify=T
     if geoapify:
         geo_counties, geo_zipcodes, geo_addresses, geo_logs, geo_time = [], [], [], [], 0
     
-    for addr in address_dicts_list:
-        query = format_str_address(addr)
-
+    for query in queries:
         if nominatum:
             nst = time.time()
-            time.sleep(1) # Avoid requests block
-            address, county, zipcode, log = nominatum_request(query,
-                US_DATA.biggest_nearby_cities)
+            # Throttle (only) actual requests to avoid requests block
+            address, county, zipcode, log = results.get(('nominatum', normalize_query(query))) or \
+                cached_request('nominatum', query, US_DATA, cache=cache, 
+                    cache_responses=cache_responses, throttle=NOMINATUM_THROTTLE)
             nom_addresses.append(address)
             nom_logs.append(log)
             if county: nom_counties.append(county)
@@ -115,8 +233,9 @@ def resolve(address_dicts_list:list, US_DATA:object, nominatum=False, geoapify=T
 
         if geoapify:
             gst = time.time()
-            address, county, zipcode, log = geoapify_request(query,
-                US_DATA.biggest_nearby_cities)
+            address, county, zipcode, log = results.get(('geoapify', normalize_query(query))) or \
+                cached_request('geoapify', query, US_DATA, cache=cache, 
+                    cache_responses=cache_responses)
             assert log 
             geo_addresses.append(address)
             geo_logs.append(log)
@@ -124,13 +243,13 @@ def resolve(address_dicts_list:list, US_DATA:object, nominatum=False, geoapify=T
             if zipcode: geo_zipcodes.append(zipcode)
             geo_time += time.time() - gst
            
-    if len(address_dicts_list) > 0 and verbose:
+    if len(queries) > 0 and verbose:
         if nominatum:
             print("Nominatum API: {} seconds per request.".format(
-                round(nom_time / len(address_dicts_list), 1)))
+                round(nom_time / len(queries), 1)))
         if geoapify:
             print("GeoApify API: {} seconds per request.".format(
-                round(geo_time / len(address_dicts_list), 1)))
+                round(geo_time / len(queries), 1)))
 
     if geoapify: 
         geo_zip_counties = US_DATA.counties_from_zips(geo_zipcodes)
@@ -151,10 +270,198 @@ def resolve(address_dicts_list:list, US_DATA:object, nominatum=False, geoapify=T
     return output
 
 
-def multithreading(func, addrs, geo, max_workers:int=None):
-    with ThreadPoolExecutor(max_workers) as ex:
-        res = ex.map(lambda x: func(x, geo), addrs)
-    return list(res)
+class TokenBucket(object):
+    ''' Asyncio rate limiter allowing `rate` requests per second on average, 
+    in bursts of at most `capacity`. '''
+    def __init__(self, rate:float, capacity:float=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+async def async_get_wrapper(session, url, limiter=None, timeout=10, retries=4, backoff=0.5,
+        max_delay=60):
+    ''' Asynchronous get_wrapper, retrying rate-limited (429), failed (5xx), timed out
+    and dropped (e.g. reset connection) requests with exponential backoff (or as told by 
+    Retry-After), waiting at most max_delay seconds before each retry.
+    '''
+    for attempt in range(retries + 1):
+        output = {'url':url, 'elapsed':None, 'content':{}, 'message':"", 'attempts':attempt + 1}
+        retry_after, transient = None, False
+        if limiter: await limiter.acquire()
+        st_time = time.time()
+        try:
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+                output.update({'status_code':resp.status, 'type':type(resp).__name__})
+                retry_after = resp.headers.get('Retry-After')
+                try:
+                    output['content'] = await resp.json(content_type=None)
+                except ValueError as err:
+                    # As get_wrapper, an answer that isn't JSON is a failed request (404), 
+                    # but rate-limited and failed (5xx) ones are still retried as such
+                    output['message'] = str(err) or ""
+                    if resp.status != 429 and resp.status < 500:
+                        output.update({'status_code':404, 'type':type(err).__name__})
+            output['elapsed'] = time.time() - st_time
+        except asyncio.TimeoutError as err:
+            output.update({'message':str(err) or "", 'elapsed':timeout, 
+                'status_code':404, 'type':type(err).__name__})
+            transient = True
+        except aiohttp.ClientError as err:
+            output.update({'message':str(err) or "", 'elapsed':time.time() - st_time, 
+                'status_code':404, 'type':type(err).__name__})
+            transient = True
+        STAGE_TIMER.add('http_{}'.format(output['status_code']), output['elapsed'])
+        if not transient and output['status_code'] != 429 and output['status_code'] < 500: 
+            return output
+        if attempt < retries:
+            delay = float(retry_after) if retry_after and retry_after.isdigit() else \
+                backoff * 2 ** attempt * (1 + random.random())
+            await asyncio.sleep(min(delay, max_delay))
+    return output
+
+
+async def _request_async(to_request:list, US_DATA:object, cache=None, cache_responses=True, 
+        concurrency:int=100, rates:dict=None, timeout=10, retries=4):
+    ''' Request (provider, query) pairs concurrently over pooled keep-alive connections, 
+    with at most concurrency in flight and each provider limited to its rate. '''
+    limiters = {provider: TokenBucket(rate) for provider, rate in (rates or {}).items() if rate}
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def request(provider, query):
+            result = cache_get(cache, provider, query, US_DATA)
+            if result: return result
+            _, url_func, parse_func = PROVIDERS[provider]
+            async with semaphore:
+                response = await async_get_wrapper(session, url_func(query), 
+                    limiter=limiters.get(provider), timeout=timeout, retries=retries)
+            result = parse_func(response, US_DATA.biggest_nearby_cities)
+            cache_set(cache, provider, query, US_DATA, result, cache_responses=cache_responses)
+            return result
+        return await asyncio.gather(*[request(provider, query) for provider, query in to_request])
+
+
+def offline_request(address_fields:dict, US_DATA:object):
+    ''' Resolve candidate from local tables, in the form of a (GeoApify) request output,
+    or return None if candidate has a street and so needs geocoding. '''
+    result = US_DATA.local_county(address_fields)
+    if result is None: return None
+    address, county, zipcode = result
+    log = {'url':None, 'elapsed':0, 'content':{'features':[]}, 'message':"", 
+        'status_code':200, 'type':'offline'}
+    return address, county, zipcode, log
+
+
+def resolve_version(aux_dir:str):
+    ''' Hash of the resolution rules: the helpers' (auxiliary files and common module) 
+    and this module. '''
+    sha = hashlib.sha256(helpers_version(aux_dir).encode())
+    with open(__file__, 'rb') as f:
+        sha.update(f.read())
+    return sha.hexdigest()[:16]
+
+
+# Stages timed when instrumented, as (stage, class, method name), besides HTTP requests 
+# (by status code) and parquet writes
+RESOLVE_STAGES = [
+    ('offline_lookup', USGeoData, 'local_county'),
+    ('cache_get', SQLiteCache, 'get'),
+    ('cache_set', SQLiteCache, 'set'),
+]
+
+def resolve_batch(address_lists:list, US_DATA:object, nominatum=False, geoapify=True, 
+        max_workers:int=None, cache=None, cache_responses=True, asynchronous=False, 
+        concurrency:int=100, rates:dict=None, retries:int=4, offline:int=0):
+    ''' Resolve a batch of ads, requesting each unique query (across all ads) only once,
+    then fanning results back out per ad. Requests are made either by max_workers threads
+    or, if asynchronous, by one event loop with up to concurrency requests in flight
+    and per-provider rates (requests per second) enforced.
+
+    If offline, candidates without a street (i.e. zipcode or city/state candidates) are 
+    instead resolved from local tables, in place of GeoApify unless the tables have no 
+    county for them, and if offline == 2 no requests are made at all.
+
+    Returns:
+        outputs: list of resolve outputs, one per ad
+        counts: dict of total and unique queries in batch, and if offline, of unique 
+            queries resolved offline (with a county) and not
+    '''
+    nominatum = nominatum and offline != 2
+    # Candidates are lists of address dicts, or an Arrow (list<struct>) addresses column,
+    # of which only the unique candidates resolved offline are built as dicts
+    if isinstance(address_lists, (pa.Array, pa.ChunkedArray)):
+        query_lists = address_queries(address_lists).to_pylist()
+        candidates = combine_chunks(address_lists).flatten()
+        def candidate(i): return candidates[i].as_py()
+    else:
+        query_lists = [[format_str_address(addr) for addr in address_dicts_list] 
+            for address_dicts_list in address_lists]
+        candidates = [addr for address_dicts_list in address_lists for addr in address_dicts_list]
+        def candidate(i): return candidates[i]
+    queries, fields = {}, {}
+    for i, query in enumerate(query for query_list in query_lists for query in query_list):
+        normalized = normalize_query(query)
+        if normalized not in queries:
+            queries[normalized], fields[normalized] = query, i
+    counts = {'queries':sum(len(query_list) for query_list in query_lists), 'unique':len(queries)}
+
+    # Answer what can be from local tables (with offline == 2, the rest as not found)
+    results = {}
+    if offline:
+        counts['offline'], counts['offline_misses'] = 0, 0
+        for query in queries:
+            result = offline_request(candidate(fields[query]), US_DATA)
+            if result is not None and result[1]:
+                counts['offline'] += 1
+            else:
+                counts['offline_misses'] += 1
+            if result is None and offline == 2: 
+                result = None, None, None, {'url':None, 'elapsed':0, 'content':{'features':[]},
+                    'message':"Needs geocoding.", 'status_code':404, 'type':'offline'}
+            # Otherwise only counties found locally, the misses being left to GeoApify
+            if result is not None and (result[1] or offline == 2): 
+                results[('geoapify', query)] = result
+
+    # (provider, normalized query) to request
+    to_request = [(provider, query) for provider, on in 
+        [('nominatum', nominatum), ('geoapify', geoapify)] if on 
+        for query in queries if (provider, query) not in results]
+    if not to_request:
+        responses = []
+    elif asynchronous:
+        responses = asyncio.run(_request_async([(provider, queries[query]) for 
+            provider, query in to_request], US_DATA, cache=cache, cache_responses=cache_responses,
+            concurrency=concurrency, rates=rates, retries=retries))
+    else:
+        # Throttle Nominatim (across all threads) to avoid requests block
+        throttle = Throttle(1 / rates['nominatum']) if rates and rates.get('nominatum') \
+            else NOMINATUM_THROTTLE
+        def request(args):
+            provider, query = args
+            return cached_request(provider, queries[query], US_DATA, cache=cache, 
+                cache_responses=cache_responses, 
+                throttle=throttle if provider == 'nominatum' else None)
+        with ThreadPoolExecutor(max_workers) as ex:
+            responses = list(ex.map(request, to_request))
+    results.update(zip(to_request, responses))
+
+    outputs = [resolve_queries(query_list, US_DATA, nominatum=nominatum, geoapify=geoapify,
+        results=results) for query_list in query_lists]
+    return outputs, counts
 
 
 
@@ -164,15 +471,50 @@ if __name__ == "__main__":
         "/accounts/projects/pkline/newslabor/Documents/Newspaper_2023/" \
         "3_Data_processing/4-output/6-final-datasets/ASA-extract.gzip")
     parser.add_argument('-n', '--nrows', type=int, default=None, help="Maximum number of ads.")
-    parser.add_argument('-s', '--skip', type=int, default=0, help="Ads to skip at beginning.")
+    parser.add_argument('-s', '--skip', type=int, default=0, help="Ads to skip at beginning " \
+        "(completed batches recorded in the run's manifest are skipped regardless).")
     parser.add_argument('-m', '--multithreading', type=bool, default=False, help="Use multithreads.")
     parser.add_argument('-w', '--nworkers', type=int, default=None, help="Number workers to use.")
     parser.add_argument('-b', '--batch_size', type=int, default=10000, help="Batch size.")
+    parser.add_argument('--offline', type=int, default=0, help="Resolve zipcode and " \
+        "city/state candidates from local tables, geocoding only street candidates and " \
+        "those the tables have no county for (1), or nothing at all (2).")
+    parser.add_argument('--asynchronous', type=int, default=0, help="Make requests from " \
+        "one event loop (pooled connections, rate limits and retries) instead of threads.")
+    parser.add_argument('--concurrency', type=int, default=100, 
+        help="Maximum requests in flight when asynchronous.")
+    parser.add_argument('--geoapify_rps', type=float, default=None, 
+        help="GeoApify requests per second when asynchronous (your plan's limit).")
+    parser.add_argument('--nominatum_rps', type=float, default=1, 
+        help="Nominatim requests per second when asynchronous.")
+    parser.add_argument('--retries', type=int, default=4, 
+        help="Retries of rate-limited (429), failed (5xx) or timed out requests when asynchronous.")
     parser.add_argument('-u', '--geoapify_url', type=str, default="https://api.geoapify.com", 
         help="GeoApify URL endpoint to ping.")
+    parser.add_argument('--nominatum_url', type=str, default=os.environ.get('NOMINATUM_URL', 
+        "https://nominatim.openstreetmap.org"), help="Nominatim URL endpoint to ping.")
+    parser.add_argument('--cache', type=int, default=1, help="Cache geocoding results on disk.")
+    parser.add_argument('--cache_path', type=str, default=None, 
+        help="Filepath to geocoding cache (default: 'geocode-cache.sqlite' in output_dir).")
+    parser.add_argument('--cache_responses', type=int, default=1, 
+        help="Also cache full responses, as recorded in 'geo_requests'.")
+    parser.add_argument('--shard_index', type=int, default=None, help="Shard of the batches " \
+        "to resolve, every num_shards-th from this one (default: SLURM_ARRAY_TASK_ID).")
+    parser.add_argument('--num_shards', type=int, default=None, help="Number of shards " \
+        "(default: SLURM_ARRAY_TASK_COUNT, else 1).")
+    parser.add_argument('--instrument', type=int, default=0, help="Time stages (HTTP " \
+        "requests by status code, cache, parquet write, ...), emitted after each batch.")
+    parser.add_argument('--instrument_path', type=str, default=None, help="Filepath to " \
+        "append stage timings to as JSON lines, or if ending in '.prom', to write running " \
+        "totals to as a Prometheus textfile (default: JSON lines in output_dir).")
+    parser.add_argument('--profile', type=int, default=0, help="Profile every so many " \
+        "batches (e.g. 1 for all, 10 for every tenth) with cProfile, into output_dir " \
+        "(of the main thread, i.e. of requests only when asynchronous).")
     parser.add_argument('-a', '--aux_dir', type=str, help="Filepath to auxiliary files.",
         default="/accounts/projects/pkline/newslabor/Documents/Newspaper_2023/" \
                 "3_Data_processing/1-code/auxiliary_files")
+    parser.add_argument('--snapshot', type=str, default=None, help="Filepath to snapshot of " \
+        "helpers built by build-cache.py (default: 'helpers-snapshot.pkl' in aux_dir).")
     parser.add_argument('-o', '--output_dir', type=str, help="Filepath to output directory.",
         default="/accounts/projects/pkline/newslabor/Documents/Newspaper_2023/" \
             "3_Data_processing/4-output/7-geolocation/")
@@ -188,56 +530,113 @@ if __name__ == "__main__":
     assert os.path.isfile(args.filepath)
     newspaper = args.filepath.split('/')[-1].split('-')[0]
 
-    sample = pd.read_parquet(args.filepath).iloc[:args.nrows]
-    assert sample.addresses.isna().sum() == 0, 'Have NAs in addresses, exiting.'
-    assert sample.addresses.dtype == 'object', 'Wrong addresses dtype, exiting.'
-    assert isinstance(sample.addresses.iloc[0], np.ndarray), 'Wrong addresses dtype, exiting.'
+    # Candidates are resolved from the Arrow addresses column, built as dicts only for output
+    table = pq.read_table(args.filepath).slice(0, args.nrows)
+    addresses = table.column('addresses')
+    assert pa.types.is_list(addresses.type) and pa.types.is_struct(addresses.type.value_type), \
+        'Wrong addresses dtype ({}), exiting.'.format(addresses.type)
+    assert addresses.null_count == 0, 'Have NAs in addresses, exiting.'
+    sample = table.drop_columns(['addresses']).to_pandas()
     print("Will resolve sample of {} observations from {}.".format(len(sample), newspaper))
 
     # Load US geo-data
-    US_DATA = USGeoData(          
-        os.path.join(args.aux_dir, "states.csv"),
-        os.path.join(args.aux_dir, "simplemaps/uscities.csv"),
-        os.path.join(args.aux_dir, "neighbors-states.csv")
-    ).load(newspaper)
+    US_DATA = load_helpers(args.aux_dir, args.snapshot, text_help=False)[0].load(newspaper)
 
     # GeoApify API key: move to environ!
     os.environ['GEOAPIFY_URL'] = args.geoapify_url # Note: pro URL would be 'https://bk01.geoapify.net'
     print("Will make requests to GeoApify URL: '{}'".format(os.environ['GEOAPIFY_URL']))
+    os.environ['NOMINATUM_URL'] = args.nominatum_url
+
+    # Shard of an array job, doing every num_shards-th batch (see merge-batch.py to finalize)
+    shard_index, num_shards = array_shard(args.shard_index, args.num_shards)
+    sharded = num_shards > 1
+    if sharded: print("Will resolve shard {} of {}.".format(shard_index, num_shards))
 
     # Predict
-    print("Beginning resolutions using {} threading ({} workers) at {}.".format(
-        'multi' if args.multithreading else 'mono', args.nworkers or 1, time_now()))
+    if args.asynchronous:
+        print("Beginning asynchronous resolutions ({} concurrent requests) at {}.".format(
+            args.concurrency, time_now()))
+    else:
+        print("Beginning resolutions using {} threading ({} workers) at {}.".format(
+            'multi' if args.multithreading else 'mono', args.nworkers or 1, time_now()))
     st_time = time.time()
-    counties = pd.DataFrame()
+    counties = []
+
+    # Geocoding results cache, shared by threads and later runs (one per shard, as SQLite 
+    # can't be shared by nodes over a network file system)
+    cache = SQLiteCache(args.cache_path or os.path.join(args.output_dir, 
+        shard_suffix('geocode-cache', shard_index, num_shards) + '.sqlite')) if args.cache else None
+
+    # Checkpoint of completed batches, so that a restarted run only redoes the rest (of 
+    # the same rules, as batches resolved by others are redone)
+    params = {'filepath':os.path.abspath(args.filepath), 'nrows':args.nrows, 
+        'batch_size':args.batch_size, 'version':resolve_version(args.aux_dir)}
+    if sharded: params.update({'shard_index':shard_index, 'num_shards':num_shards})
+    manifest = Manifest(add_filepath_suffix(args.output_dir, newspaper, n=args.nrows, ext='json',
+        suffix=shard_suffix('resolve-manifest', shard_index, num_shards)), params=params)
+
+    # Stage timings, emitted after each batch
+    if args.instrument: STAGE_TIMER.instrument(RESOLVE_STAGES)
+    stages_path = args.instrument_path or add_filepath_suffix(args.output_dir, newspaper, 
+        suffix='resolve-stages', n=args.nrows, ext='jsonl')
+    labels = {'script':'resolve', 'newspaper':newspaper}
 
     for batch_idx in range(ceil(len(sample) / args.batch_size)):
-        if args.skip >= (batch_idx+1)*args.batch_size: continue
-        batch = sample.addresses.iloc[batch_idx*args.batch_size:(batch_idx+1)*args.batch_size]
-        indices = sample.index[batch_idx*args.batch_size:(batch_idx+1)*args.batch_size]
-        if args.multithreading:
-            counties_batch = pd.DataFrame(multithreading(resolve, batch.to_list(), 
-                US_DATA, max_workers=args.nworkers), index=indices)
-        else:
-            counties_batch = pd.DataFrame(batch.apply(resolve, args=(US_DATA,)).to_list(),
-                index=indices)
+        start, end = batch_idx*args.batch_size, min((batch_idx+1)*args.batch_size, len(sample))
+        if args.skip >= end or not in_shard(batch_idx, shard_index, num_shards): continue
+        completed = manifest.completed(start, end)
+        if completed:
+            counties.append(pd.read_parquet(completed['path']))
+            continue
+        profile = add_filepath_suffix(args.output_dir, newspaper, n=(batch_idx+1)*args.batch_size, 
+            suffix='resolve-profile', ext='prof') if args.profile and \
+                batch_idx % args.profile == 0 else None
+        with profiled(profile), STAGE_TIMER.time('resolve_batch'):
+            outputs, counts = resolve_batch(addresses.slice(start, end - start), US_DATA, 
+                cache=cache, cache_responses=args.cache_responses, 
+                max_workers=args.nworkers if args.multithreading else 1,
+                asynchronous=args.asynchronous, concurrency=args.concurrency, 
+                retries=args.retries, offline=args.offline,
+                rates={'nominatum':args.nominatum_rps, 'geoapify':args.geoapify_rps})
+        if profile: combine_profiles(profile)
+        counties_batch = pd.DataFrame(outputs, index=sample.index[start:end])
+        print("Requested {} unique of {} queries ({}%).".format(counts['unique'], 
+            counts['queries'], round(100 * counts['unique'] / max(counts['queries'], 1), 1)))
+        if args.offline:
+            print("Resolved {} unique queries offline, {} not ({}% hit rate).".format(
+                counts['offline'], counts['offline_misses'], round(100 * counts['offline'] / 
+                    max(counts['offline'] + counts['offline_misses'], 1), 1)))
         try:
-            counties_batch.to_parquet(add_filepath_suffix(args.output_dir, newspaper, 
-                n=(batch_idx+1)*args.batch_size, suffix='resolve-batch'), compression='gzip')
+            with STAGE_TIMER.time('parquet_write'):
+                manifest.write_batch(counties_batch, start, add_filepath_suffix(args.output_dir, 
+                    newspaper, n=(batch_idx+1)*args.batch_size, suffix='resolve-batch'))
         except Exception as e:
             print(f"Batch save failed: {str(e)}")
             print(counties_batch.geo_requests.iloc[:5].to_list())
-        counties = pd.concat([counties, counties_batch])
-        print("Processed ads {}-{} at {}...".format(
-            batch_idx*args.batch_size,(batch_idx+1)*args.batch_size, time_now()))
-        
-    # sample = pd.merge(sample, counties, how='left')
-    # sample = sample.join(pd.DataFrame(counties, index=sample.index))
-    sample = sample.join(counties)
-    sample.to_parquet(add_filepath_suffix(args.output_dir, newspaper, n=args.nrows or len(sample), 
-        suffix='resolve'), compression='gzip')
-    sample.to_csv(add_filepath_suffix(args.output_dir, newspaper, n=args.nrows or len(sample), 
-        suffix='resolve', ext='csv'))    
+        counties.append(counties_batch)
+        if args.instrument: STAGE_TIMER.emit(stages_path, labels, batch=[start, end])
+        print("Processed ads {}-{} at {}...".format(start, end, time_now()))
+        if cache:
+            for namespace, stats in cache.stats().items():
+                print("Cache of {}: {} hits, {} misses ({}% hit rate).".format(namespace, 
+                    stats['hits'], stats['misses'], round(100 * stats['hit_rate'], 1)))
+
+    if sharded:
+        print("Completed {} batches of shard {} of {} (merge all shards with merge-batch.py " \
+            "--suffix=resolve).".format(len(manifest.batches), shard_index, num_shards))
+    else:
+        # sample = pd.merge(sample, counties, how='left')
+        # sample = sample.join(pd.DataFrame(counties, index=sample.index))
+        sample.insert([col for col in table.column_names if col in sample.columns or 
+            col == 'addresses'].index('addresses'), 'addresses', 
+            pd.Series(addresses.to_pandas().values, index=sample.index))
+        if counties: sample = sample.join(pd.concat(counties))
+        with STAGE_TIMER.time('parquet_write'):
+            write_parquet(sample, add_filepath_suffix(args.output_dir, newspaper, 
+                n=args.nrows or len(sample), suffix='resolve'), types={'addresses':ADDRESS_TYPE})
+        sample.to_csv(add_filepath_suffix(args.output_dir, newspaper, n=args.nrows or len(sample), 
+            suffix='resolve', ext='csv'))
+    if args.instrument: STAGE_TIMER.emit(stages_path, labels, batch='final')
     elapsed = time.time() - st_time
     print("Completed resolutions at {} in {} minutes ({} seconds).\n".format(
         time_now(), round(elapsed/60, 2), round(elapsed)))
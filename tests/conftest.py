@@ -0,0 +1,36 @@
+import os
+import sys
+import pandas as pd
+import pytest
+
+# Scripts import each other as top-level modules (e.g. `from common import ...`)
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+
+# Auxiliary files (of which simplemaps/uscities.csv is not in the repo, see README)
+AUX_DIR = os.environ.get('NEWSPAPER_AUX_DIR', os.path.join(ROOT, 'auxiliary_files'))
+SAMPLE = os.path.join(ROOT, 'test_data', 'NJG-extract-all.gzip')
+
+
+@pytest.fixture(scope='session')
+def helpers():
+    ''' USGeoData and TextWrapper, built once for all tests. '''
+    if not os.path.isfile(os.path.join(AUX_DIR, 'simplemaps', 'uscities.csv')):
+        pytest.skip("No auxiliary files in '{}' (set NEWSPAPER_AUX_DIR).".format(AUX_DIR))
+    from common import load_helpers
+    return load_helpers(AUX_DIR)
+
+@pytest.fixture
+def newspaper(helpers):
+    ''' NJG, from the shared helpers but with empty memos. '''
+    from common import LRUMemo
+    from extract import Newspaper
+    US_DATA, TEXT_HELP = helpers
+    NEWSPAPER = Newspaper(newspaper='NJG', US_DATA=US_DATA, TEXT_HELP=TEXT_HELP)
+    NEWSPAPER.US_DATA.TOKEN_MEMO, TEXT_HELP.CORRECTIONS = LRUMemo(), LRUMemo()
+    return NEWSPAPER
+
+@pytest.fixture(scope='session')
+def sample_ads():
+    ''' Raw texts of the first 300 NJG sample ads. '''
+    return pd.read_parquet(SAMPLE, columns=['raw_content']).raw_content.iloc[:300].fillna('')
@@ -0,0 +1,135 @@
+import os
+import subprocess
+import sys
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from common import Manifest, batch_types, concat_parquet, csv_dtypes, read_batches, \
+    write_parquet
+
+MERGE_BATCH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts', 
+    'merge-batch.py')
+
+
+@pytest.fixture
+def ads_csv(tmp_path):
+    ''' Ads whose columns pandas infers differently per chunk of 2 rows: racialTermraw
+    all NAs in the first chunk, zip integers in the first and strings in the second, 
+    racialTermboolean booleans and then booleans with NAs, and year likewise integers. '''
+    filepath = str(tmp_path / 'NJG.csv')
+    pd.DataFrame({'raw_content':['ad one', 'ad two', 'ad three', 'ad four', 'ad five'],
+        'racialTermraw':[None, None, 'white', None, 'colored'],
+        'zip':['23501', '23502', 'norfolk 23501', None, '23503'],
+        'racialTermboolean':[False, False, True, None, True],
+        'year':pd.array([1950, 1950, None, 1951, 1951], dtype='Int64')}).to_csv(filepath)
+    return filepath
+
+def write_batches(filepath:str, tmp_path, dtypes:dict=None):
+    paths = []
+    for i, batch in enumerate(read_batches(filepath, 2, dtypes=dtypes)):
+        paths.append(str(tmp_path / 'batch-{}.gzip'.format(i)))
+        write_parquet(batch, paths[-1])
+    return paths
+
+def test_batches_without_dtypes_fail_to_assemble(ads_csv, tmp_path):
+    with pytest.raises((pa.ArrowInvalid, pa.ArrowNotImplementedError)):
+        concat_parquet(write_batches(ads_csv, tmp_path), str(tmp_path / 'out.gzip'))
+
+def test_csv_dtypes(ads_csv):
+    dtypes = csv_dtypes(ads_csv, 2)
+    assert dtypes['racialTermraw'] is str and dtypes['zip'] is str
+    assert dtypes['racialTermboolean'] == 'boolean' and dtypes['year'] == 'float64'
+    assert 'raw_content' not in dtypes
+
+def test_batches_with_dtypes_assemble_as_whole(ads_csv, tmp_path):
+    output = str(tmp_path / 'out.gzip')
+    paths = write_batches(ads_csv, tmp_path, csv_dtypes(ads_csv, 2))
+    assert concat_parquet(paths, output) == 5
+    whole = pd.read_csv(ads_csv, index_col=[0], dtype={'zip':str})
+    assembled = pq.read_table(output).to_pandas()
+    assert list(assembled.index) == list(whole.index)
+    for col in whole.columns:
+        assert [None if pd.isna(value) else value for value in assembled[col]] == \
+            [None if pd.isna(value) else value for value in whole[col]], col
+
+def test_batch_types_unify_batches_of_earlier_runs(tmp_path):
+    ''' Batches of a resumed run: wage all NAs in one, text in another written by an
+    earlier run, which read racialTermraw (all NAs) as numbers. '''
+    paths = [str(tmp_path / 'batch-{}.gzip'.format(i)) for i in range(2)]
+    write_parquet(pd.DataFrame({'racialTermraw':[float('nan')] * 2, 'wage':[None, None], 
+        'year':[1950, 1950]}), paths[0])
+    write_parquet(pd.DataFrame({'racialTermraw':['white', None], 'wage':['$60 per hour', None], 
+        'year':[1951.0, None]}, index=[2, 3]), paths[1])
+    types = batch_types(paths)
+    assert types == {'racialTermraw':pa.string(), 'wage':pa.string(), 'year':pa.float64()}
+    output = str(tmp_path / 'out.gzip')
+    assert concat_parquet(paths, output, types=types) == 4
+    assembled = pq.read_table(output).to_pandas()
+    assert assembled.racialTermraw.tolist() == [None, None, 'white', None]
+    assert assembled.wage.tolist() == [None, None, '$60 per hour', None]
+
+def write_run(template:str, tmp_path, nrows:int, batch_size:int, stream:bool=False):
+    ''' Batches (with a manifest) of a run extracting the first nrows ads of template, 
+    which if streamed also have the template's columns. '''
+    manifest = Manifest(str(tmp_path / 'NJG-extract-manifest-{}.json'.format(nrows)), 
+        params={'filepath':os.path.abspath(template), 'nrows':nrows, 'batch_size':batch_size,
+            'stream':stream})
+    ads = list(read_batches(template, batch_size, nrows=nrows, dtypes=csv_dtypes(template, 
+        batch_size) if template.endswith('.csv') else None)) if stream else None
+    for i, start in enumerate(range(0, nrows, batch_size)):
+        end = min(start + batch_size, nrows)
+        batch = pd.DataFrame({'wage':['run of {}'.format(nrows)] * (end - start)}, 
+            index=range(start, end))
+        if stream: batch = ads[i].join(batch)
+        manifest.write_batch(batch, start, str(tmp_path / 'NJG-extract-batch-{}-{}.gzip'.format(
+            nrows, end)))
+
+def merge_batch(template:str, tmp_path, *extra):
+    return subprocess.run([sys.executable, MERGE_BATCH, '--filepath={}'.format(template), 
+        '--batch_dir={}'.format(tmp_path), '--suffix=extract', '--stream=1', '-b', '2', 
+        '--delete=0', '--output_dir={}'.format(tmp_path), *extra], capture_output=True, text=True)
+
+def test_merge_leaves_out_manifests_of_other_runs(tmp_path):
+    template, other = str(tmp_path / 'NJG-template.gzip'), str(tmp_path / 'NJG-other.gzip')
+    for filepath in [template, other]:
+        write_parquet(pd.DataFrame({'raw_content':['ad {}'.format(i) for i in range(5)]}), 
+            filepath)
+    write_run(template, tmp_path, 5, 2)
+    write_run(other, tmp_path, 3, 2)
+    merged = merge_batch(template, tmp_path)
+    assert merged.returncode == 0, merged.stderr
+    output = pq.read_table(str(tmp_path / 'NJG-extract-merged-5.gzip')).to_pandas()
+    assert output.wage.tolist() == ['run of 5'] * 5
+
+    # An earlier run on the same template has to be told apart with --manifest
+    write_run(template, tmp_path, 4, 2)
+    merged = merge_batch(template, tmp_path)
+    assert merged.returncode != 0 and 'choose one with --manifest' in merged.stderr
+    merged = merge_batch(template, tmp_path, '--manifest={}'.format(
+        tmp_path / 'NJG-extract-manifest-4.json'), '-n', '2')
+    assert merged.returncode == 0, merged.stderr
+    output = pq.read_table(str(tmp_path / 'NJG-extract-merged-4.gzip')).to_pandas()
+    assert output.wage.tolist() == ['run of 4'] * 4
+
+def test_manifest_of_other_rules_version_starts_afresh(tmp_path):
+    filepath = str(tmp_path / 'NJG-extract-manifest-all.json')
+    params = {'filepath':'NJG.csv', 'nrows':None, 'batch_size':2, 'version':'v1'}
+    manifest = Manifest(filepath, params=params)
+    manifest.write_batch(pd.DataFrame({'wage':['$60 per week'] * 2}), 0, 
+        str(tmp_path / 'NJG-extract-batch-2.gzip'))
+    assert Manifest(filepath, params=params).completed(0, 2)
+    rerun = Manifest(filepath, params=dict(params, version='v2'))
+    assert not rerun.batches and rerun.params['version'] == 'v2'
+    with pytest.raises(AssertionError):
+        Manifest(filepath, params=dict(params, batch_size=3))
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_merge_on_csv_template(ads_csv, tmp_path, stream):
+    write_run(ads_csv, tmp_path, 5, 2, stream)
+    merged = merge_batch(ads_csv, tmp_path)
+    assert merged.returncode == 0, merged.stderr
+    output = pq.read_table(str(tmp_path / 'NJG-extract-merged-5.gzip')).to_pandas()
+    assert output.wage.tolist() == ['run of 5'] * 5
+    assert output.racialTermraw.tolist() == [None, None, 'white', None, 'colored']
+    assert output.zip.tolist() == ['23501', '23502', 'norfolk 23501', None, '23503']
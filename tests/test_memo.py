@@ -0,0 +1,47 @@
+import pickle
+from common import LRUMemo
+
+
+def test_memo_saved_and_loaded_with_version(tmp_path):
+    filepath = str(tmp_path / 'memo.pkl')
+    memo = LRUMemo().load(filepath, 'v1')
+    memo.set('city', 'norfolk', 'Norfolk')
+    memo.save(filepath)
+    assert LRUMemo().load(filepath, 'v1').get('city', 'norfolk') == 'Norfolk'
+
+def test_memo_of_other_version_discarded(tmp_path):
+    filepath = str(tmp_path / 'memo.pkl')
+    memo = LRUMemo().load(filepath, 'v1')
+    memo.set('sentence', 'stret', 'street')
+    memo.save(filepath)
+    assert LRUMemo().load(filepath, 'v2').get('sentence', 'stret') is None
+    # Memos saved before they were versioned
+    with open(filepath, 'wb') as f:
+        pickle.dump([(('sentence', 'stret'), 'street')], f)
+    assert LRUMemo().load(filepath, 'v1').get('sentence', 'stret') is None
+
+def test_memo_bounded_when_merging_and_setting():
+    worker, parent = LRUMemo(10), LRUMemo(10)
+    for i in range(25):
+        worker.set('city', i, i)
+        if i % 5 == 4: parent.merge(worker.drain())
+    assert len(parent.entries) == 10 and not parent.new_entries
+    assert parent.get('city', 24) == 24 and parent.get('city', 0) is None
+    # Serially, nothing ever drains the memo
+    for i in range(25): parent.set('state_id', i, i)
+    assert len(parent.entries) == 10 and len(parent.new_entries) == 10
+    assert list(parent.new_entries) == [('state_id', i) for i in range(15, 25)]
+
+def test_memoized_extractions_equal_unmemoized(newspaper, sample_ads):
+    ''' Addresses (extract_tokens) and wages of the sample ads are the same without memos 
+    (of size 0), with empty memos and with the memos those filled. '''
+    def extract_all():
+        return [newspaper.extract_all(ad_text, True, True) for ad_text in sample_ads]
+    memos = newspaper.US_DATA.TOKEN_MEMO, newspaper.TEXT_HELP.CORRECTIONS
+    newspaper.US_DATA.TOKEN_MEMO, newspaper.TEXT_HELP.CORRECTIONS = LRUMemo(0), LRUMemo(0)
+    unmemoized = extract_all()
+    newspaper.US_DATA.TOKEN_MEMO, newspaper.TEXT_HELP.CORRECTIONS = memos
+    assert extract_all() == unmemoized
+    for memo in memos: memo.drain()
+    assert extract_all() == unmemoized
+    assert all(sum(memo.hits.values()) for memo in memos)
@@ -0,0 +1,70 @@
+import asyncio
+import time
+import aiohttp
+from aiohttp import web
+import resolve
+
+
+async def get(handler, **kwargs):
+    ''' async_get_wrapper's output for a request to a local server answering with handler. '''
+    app = web.Application()
+    app.router.add_get('/search', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        async with aiohttp.ClientSession() as session:
+            return await resolve.async_get_wrapper(session, 
+                'http://127.0.0.1:{}/search'.format(port), **kwargs)
+    finally:
+        await runner.cleanup()
+
+def test_answer_that_isnt_json_is_failed_request():
+    async def handler(request):
+        return web.Response(text='<html>Down for maintenance</html>')
+    output = asyncio.run(get(handler))
+    assert output['status_code'] == 404 and output['attempts'] == 1
+    assert resolve.parse_nominatum(output, [])[1] is None
+    assert resolve.parse_geoapify(output, [])[1] is None
+
+def test_retry_after_capped():
+    calls = []
+    async def handler(request):
+        calls.append(request)
+        if len(calls) == 1:
+            return web.Response(status=429, headers={'Retry-After':'3600'})
+        return web.json_response([])
+    start = time.time()
+    output = asyncio.run(get(handler, max_delay=0.1))
+    assert output['status_code'] == 200 and output['attempts'] == 2
+    assert time.time() - start < 5
+
+class LocalTables(object):
+    ''' Local tables knowing only the county of Norfolk. '''
+    biggest_nearby_cities = []
+    def local_county(self, address_fields:dict):
+        if address_fields.get('street'): return None
+        if address_fields.get('city') == 'Norfolk': 
+            return 'Norfolk, Virginia, USA', 'Norfolk', None
+        return None, None, None
+    def counties_from_zips(self, zipcodes:list):
+        return []
+
+def test_offline_misses_geocoded(monkeypatch):
+    requested = []
+    def cached_request(provider, query, US_DATA, **kwargs):
+        requested.append(query)
+        return query, 'Geocoded', None, {'status_code':200, 'type':'Response'}
+    monkeypatch.setattr(resolve, 'cached_request', cached_request)
+    address_lists = [[{'city':'Norfolk', 'state':'Virginia'}], [{'zipcode':'99999'}], 
+        [{'housenumber':'1805', 'street':'Airline Blvd'}]]
+    outputs, counts = resolve.resolve_batch(address_lists, LocalTables(), offline=1)
+    assert sorted(requested) == ['1805 Airline Blvd, USA', '99999, USA']
+    assert [output['geo_county'] for output in outputs] == ['Norfolk', 'Geocoded', 'Geocoded']
+    assert counts['offline'] == 1 and counts['offline_misses'] == 2
+    requested.clear()
+    outputs, _ = resolve.resolve_batch(address_lists, LocalTables(), offline=2)
+    assert not requested
+    assert [output['geo_county'] for output in outputs] == ['Norfolk', None, None]
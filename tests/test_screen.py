@@ -0,0 +1,17 @@
+import pandas as pd
+import extract
+
+
+def test_screened_extractions_equal_unscreened(newspaper, sample_ads, monkeypatch):
+    screened = extract.extract_batch(sample_ads, newspaper, extract_address=True, 
+        extract_wage=True, dedup=False)
+    screens, skipped = extract.screen_batch(sample_ads, newspaper, True, True)
+    assert not screens.all().all(), "The sample ads should have some screened out."
+
+    def screen_nothing(texts, NEWSPAPER, extract_address=True, extract_wage=False):
+        return pd.DataFrame({'address':extract_address, 'wage':extract_wage}, 
+            index=texts.index), {}
+    monkeypatch.setattr(extract, 'screen_batch', screen_nothing)
+    unscreened = extract.extract_batch(sample_ads, newspaper, extract_address=True, 
+        extract_wage=True, dedup=False)
+    pd.testing.assert_frame_equal(screened, unscreened)
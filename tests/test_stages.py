@@ -0,0 +1,21 @@
+from common import StageTimer
+
+
+def test_prometheus_totals_kept_per_series(tmp_path):
+    filepath = str(tmp_path / 'stages.prom')
+    timer = StageTimer()
+    timer.enabled = True
+    # As extract-all.py: the papers in turn, each over two batches
+    for paper, seconds in [('LAT', 2.0), ('NJG', 0.5)]:
+        for _ in range(2):
+            timer.add('tokenize', seconds)
+            timer.emit(filepath, {'script':'extract', 'newspaper':paper})
+    with open(filepath) as f:
+        lines = f.read().splitlines()
+    assert 'newspaper_stage_seconds_total{script="extract",newspaper="LAT",stage="tokenize"} ' \
+        '4.0' in lines
+    assert 'newspaper_stage_seconds_total{script="extract",newspaper="NJG",stage="tokenize"} ' \
+        '1.0' in lines
+    assert 'newspaper_stage_calls_total{script="extract",newspaper="NJG",stage="tokenize"} ' \
+        '2' in lines
+    assert timer.total_seconds['tokenize'] == 5.0
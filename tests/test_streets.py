@@ -0,0 +1,29 @@
+from common import HOUSE_NUMBER, KeywordMatcher
+
+
+def test_variants_only_found_after_house_number():
+    matcher = KeywordMatcher({'street':'street', 'blvd':'blvd', 'stre et':'street', 
+        'bivd':'blvd'}, variant_context=HOUSE_NUMBER)
+    assert matcher.normalize('625 Church Stre et , Norfolk') == '625 Church street , Norfolk'
+    assert matcher.normalize('1805 Airline Bivd .') == '1805 Airline blvd .'
+    assert matcher.find('1805 Airline Blvd.') == [(13, 17, 'blvd')]
+    for junk in ['00 , Bivd HELP WANTED', 'call Stre et', '12 a b c Bivd']:
+        assert matcher.normalize(junk) == junk
+        assert not matcher.find(junk)
+    # Markers themselves need no house number
+    assert matcher.find('call Street') == [(5, 11, 'street')]
+
+def test_misread_markers_of_junk_give_no_addresses(newspaper):
+    # Excerpts of NJG sample ads, whose "STreel" and "Avc" gave "00 Of Street" and "A Of Ave"
+    junk = ['5300100 CNTERClan tr an 130 . 5i d4 7 . 1 41 00 . 00 , STreel HELP WANTED SE7TLE',
+        'NO DISCRIMINATION ANYONE CAN BUY HAMPTON-NEWPORT NEWS 115 Avc -6 RM 3 BB 817 . 50']
+    for ad in junk:
+        assert newspaper.extract_all(ad, True, False)['addresses'] == []
+    assert 'Avc' in newspaper.TEXT_HELP.tokenize('115 Avc -6 RM')
+
+def test_misread_markers_after_house_number_give_addresses(newspaper):
+    for ad, street in [('apply at 1805 Airline Bivd .', 'Airline Blvd'), 
+            ('apply at 1805 Airline Blvd. Norfolk', 'Airline Blvd'),
+            ('apply at 625 Church Stre et today', 'Church Street')]:
+        assert [address['street'] for address in newspaper.extract_all(ad, True, False)[
+            'addresses']] == [street], ad